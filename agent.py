@@ -1,16 +1,21 @@
 import random
 from collections import defaultdict
-from itertools import product, chain
+
+import numpy as np
 
 class Student():
-    def __init__(self, student_id, n_courses, year = 0, department = None, credit_limit = 4):
+    def __init__(self, student_id, n_courses, year = 0, department = None, credit_limit = 4,
+                 course_prefs = None):
         self.year = year
         self.dept = department
         self.n_courses = n_courses
         self.credit_limit = credit_limit
         self.student_id = student_id
         
-        self._generate_preferences() # indices in the course_list
+        if course_prefs is None:
+            self._generate_preferences() # indices in the course_list
+        else:
+            self.course_prefs = course_prefs
         
         self.eligible = True
         self.course_enroll = [] # indices in the course_list
@@ -24,13 +29,30 @@ class Student():
     def __repr__(self):
         return f"y{self.year}d{self.dept:02d}s{self.student_id:04d}"
         
+    @property
+    def course_prefs(self):
+        return self._course_prefs
+
+    @course_prefs.setter
+    def course_prefs(self, course_prefs):
+        # course_ranks[c] is the position of course c in course_prefs (inverse permutation);
+        # course_prefs may rank only some of the courses, the others get rank -1. Both are
+        # read-only (a tuple and a frozen array) so that the ranks can't go stale: change the
+        # preferences by assigning a new list
+        self._course_prefs = tuple(course_prefs)
+        self.course_ranks = np.full(self.n_courses, -1, dtype = np.int32)
+        self.course_ranks[list(self._course_prefs)] = np.arange(len(self._course_prefs), dtype = np.int32)
+        self.course_ranks.flags.writeable = False
+        
     def _generate_preferences(self):
-        self.course_prefs = list(range(self.n_courses))
-        random.shuffle(self.course_prefs) # randomly shuffle course preferences
+        course_prefs = list(range(self.n_courses))
+        random.shuffle(course_prefs) # randomly shuffle course preferences
+        self.course_prefs = course_prefs
         
-    def update_current_course_prefs(self, index):
+    def update_current_course_prefs(self, index, n_prefs = None):
+        # ineligible once the list being walked (course_prefs by default) is exhausted
         self.current_course_propose = index
-        if self.current_course_propose >= self.n_courses:
+        if self.current_course_propose >= (len(self.course_prefs) if n_prefs is None else n_prefs):
             self.eligible = False
     
     def make_proposals(self):
@@ -38,7 +60,7 @@ class Student():
         if (len(self.course_enroll) < self.credit_limit) and self.eligible:
             start = self.current_course_propose
             end = min(self.current_course_propose + (self.credit_limit - len(self.course_enroll)),
-                      self.n_courses)
+                      len(self.course_prefs))
             course_indices = self.course_prefs[start: end]
             self.update_current_course_prefs(end)
             return course_indices
@@ -53,11 +75,10 @@ class Student():
             self.course_enroll.remove(course_id)
             
     def get_utilities(self):
-        util = sum([self.n_courses - self.course_prefs.index(c) for c in self.course_enroll])
-        return util
+        return self.get_utilities_from_courses(self.course_enroll)
     
     def get_utilities_from_courses(self, courses):
-        util = sum([self.n_courses - self.course_prefs.index(c) for c in courses])
+        util = self.n_courses * len(courses) - int(self.course_ranks[list(courses)].sum())
         return util
 
     def get_enrollment_info(self):
@@ -70,18 +91,15 @@ class Student():
         enroll_course_schedules = defaultdict(list) # time: c_list
         for c in self.course_enroll:
             enroll_course_schedules[course_list[c].time].append(c)
-        conflict_courses = {t: c_list for t, c_list in enroll_course_schedules.items() if len(c_list) > 1}
-        nonconflict_courses = [c for c in self.course_enroll if c not in list(chain(*conflict_courses.values()))]
+        nonconflict_courses = [c for c in self.course_enroll 
+                               if len(enroll_course_schedules[course_list[c].time]) == 1]
         
-        # keep non-conflicting most-preferred courses (providing the highest total utility)
+        # keep non-conflicting most-preferred courses (providing the highest total utility):
+        # utilities are additive and distinct, so the best combination takes the
+        # most preferred course of every conflicting time slot
         self.unavailable_times = enroll_course_schedules.keys()
-        max_util = -1
-        to_keep_courses = []
-        for comb in product(*conflict_courses.values()):
-            util = self.get_utilities_from_courses(nonconflict_courses) + self.get_utilities_from_courses(list(comb))
-            if util > max_util:
-                max_util = util
-                to_keep_courses = list(comb)
+        to_keep_courses = [min(c_list, key = self.course_ranks.__getitem__)
+                           for c_list in enroll_course_schedules.values() if len(c_list) > 1]
 
         # update courses to keep enrollment
         old_courses = self.course_enroll.copy()
@@ -98,20 +116,25 @@ class Student():
         course_indices = []
         while (len(course_indices) + len(self.course_enroll) < self.credit_limit) and self.eligible:
             c_index = self.current_course_propose
-            if course_list[c_index].time not in self.unavailable_times: # no conflict
+            # no conflict, and a course the student ranks
+            if course_list[c_index].time not in self.unavailable_times and self.course_ranks[c_index] >= 0:
                 course_indices.append(c_index)
-            self.update_current_course_prefs(c_index + 1)
+            self.update_current_course_prefs(c_index + 1, self.n_courses)
         return course_indices
         
 # =============================================================================== # 
 
 class Course():
-    def __init__(self, course_id, student_list, department = None, enroll_limit = 80):
+    def __init__(self, course_id, student_list, department = None, enroll_limit = 80,
+                 student_prefs = None):
         self.dept = department
         self.course_id = course_id
         self.enroll_limit = enroll_limit
         
-        self._generate_preferences(student_list)
+        if student_prefs is None:
+            self._generate_preferences(student_list)
+        else:
+            self.set_preferences(student_prefs)
         self.student_enroll = []
         self.second_student_enroll = []
 
@@ -133,15 +156,37 @@ class Course():
     def set_time(self, time):
         self.time = time
         
+    def set_preferences(self, student_prefs):
+        self.student_prefs = student_prefs
+        self.student_prefs_dict = {student.student_id: index 
+                                   for index, student in enumerate(self.student_prefs)}
+        
+    def get_student_ids(self):
+        # student ids in priority order
+        return list(self.student_prefs_dict)
+    
+    def get_priority(self, student):
+        return self.student_prefs_dict[student.student_id]
+
+    def ranks(self, student):
+        return student.student_id in self.student_prefs_dict
+
+    def split_unranked(self, proposals):
+        # a course only admits students it ranks: the others are rejected outright
+        ranked = [student for student in proposals if self.ranks(student)]
+        if len(ranked) == len(proposals):
+            return proposals, []
+        return ranked, [student for student in proposals if not self.ranks(student)]
+        
     def _generate_preferences(self, student_list):
-        self.student_prefs = []
+        student_prefs = []
         # add students from its own department first (ranked in decreasing order of class year)
         # break ties randomly
         same_dept_students = [student for student in student_list if student.dept == self.dept]
         for year in range(3, -1, -1):
             same_dept_year = [student for student in same_dept_students if student.year == year]
             random.shuffle(same_dept_year)
-            self.student_prefs += same_dept_year
+            student_prefs += same_dept_year
         
         # then students from other depts (ranked in decreasing order of class year)
         other_dept_students = [student for student in student_list if student.dept != self.dept]
@@ -149,44 +194,188 @@ class Course():
         for year in range(3, -1, -1):
             other_dept_year = [student for student in other_dept_students if student.year == year]
             random.shuffle(other_dept_year)
-            self.student_prefs += other_dept_year
+            student_prefs += other_dept_year
             
-        self.student_prefs_dict = {student.student_id: index 
-                                   for index, student in enumerate(self.student_prefs)}
+        self.set_preferences(student_prefs)
         
     def accept_proposals(self, proposals):
         # tentatively accept and returns whether accept or reject (return accepts, rejects tuple)
+        proposals, unranked = self.split_unranked(proposals)
         if (len(self.student_enroll) + len(proposals)) <= self.enroll_limit:
             # tentatively accept all
             self.student_enroll += proposals
-            return proposals, []
+            return proposals, unranked
         else:
             # find the most preferred students
             combined = self.student_enroll + proposals
-            combined = sorted(combined, key = lambda student: self.student_prefs_dict[student.student_id])
+            combined = sorted(combined, key = self.get_priority)
             accepts = combined[: self.enroll_limit]
             rejects = combined[self.enroll_limit: ]
             self.student_enroll = accepts
-            return accepts, rejects
+            return accepts, rejects + unranked
 
     def accept_resolving_proposals(self, proposals):
         # tentatively accept and returns whether accept or reject (return accepts, rejects tuple)
+        proposals, unranked = self.split_unranked(proposals)
         if (len(self.student_enroll) + len(self.second_student_enroll) + len(proposals)) <= self.enroll_limit:
             # tentatively accept all
             self.second_student_enroll += proposals
-            return proposals, []
+            return proposals, unranked
         else:
             # find the most preferred students
             combined = self.second_student_enroll + proposals
-            combined = sorted(combined, key = lambda student: self.student_prefs_dict[student.student_id])
+            combined = sorted(combined, key = self.get_priority)
             accepts = combined[: self.enroll_limit - len(self.student_enroll)]
             rejects = combined[self.enroll_limit - len(self.student_enroll): ]
             self.second_student_enroll = accepts
-            return accepts, rejects
+            return accepts, rejects + unranked
         
     def finalize_enrollment(self):
         self.student_enroll = self.student_enroll + self.second_student_enroll
         
     def get_enrollment_info(self):
         output = f"Course {self.__str__()} has {len(self.student_enroll)} students enrolling"
-        print(output)
\ No newline at end of file
+        print(output)
+
+# =============================================================================== # 
+
+class CompactStudent(Student):
+    # course preferences kept as bytes (2 or 4 per course) instead of a list, read as a
+    # read-only typed memoryview; a truncated list keeps its ranks as SortedRanks (no array
+    # over all courses). Attributes live in __slots__ (Student itself keeps its __dict__)
+    __slots__ = ('year', 'dept', 'n_courses', 'credit_limit', 'student_id', '_course_prefs', 'course_ranks',
+                 'eligible', 'course_enroll', 'current_course_propose', 'unavailable_times')
+
+    @property
+    def course_prefs(self):
+        return memoryview(self._course_prefs).cast('h' if self.n_courses < 2 ** 15 else 'i')
+
+    @course_prefs.setter
+    def course_prefs(self, course_prefs):
+        dtype = np.int16 if self.n_courses < 2 ** 15 else np.int32
+        course_prefs = np.asarray(course_prefs, dtype = dtype)
+        self._course_prefs = course_prefs.tobytes()
+        if len(course_prefs) < self.n_courses:
+            self.course_ranks = SortedRanks(course_prefs, self.n_courses)
+        else:
+            self.course_ranks = np.empty(len(course_prefs), dtype = dtype)
+            self.course_ranks[course_prefs] = np.arange(len(course_prefs), dtype = dtype)
+            self.course_ranks.flags.writeable = False
+
+
+class CompactCourse(Course):
+    # priorities kept as int32 arrays of student ids and ranks instead of a list of Student
+    # references plus a dict; student_prefs and student_prefs_dict are read-only views
+    __slots__ = ('dept', 'course_id', 'enroll_limit', 'student_enroll', 'second_student_enroll', 'time',
+                 'student_list', 'student_ids', 'student_ranks')
+
+    def __init__(self, course_id, student_list, department = None, enroll_limit = 80,
+                 student_prefs = None):
+        self.student_list = student_list
+        super().__init__(course_id, student_list, department, enroll_limit, student_prefs)
+
+    @property
+    def student_prefs(self):
+        return StudentView(self.student_ids, self.student_list)
+
+    @property
+    def student_prefs_dict(self):
+        return RankView(self.student_ids, self.student_ranks)
+
+    def set_preferences(self, student_prefs):
+        if not isinstance(student_prefs, np.ndarray):
+            student_prefs = [student.student_id for student in student_prefs]
+        self.student_ids = np.asarray(student_prefs, dtype = np.int32)
+        n_ranks = max(len(self.student_list), int(self.student_ids.max(initial = -1)) + 1)
+        if 4 * len(self.student_ids) < n_ranks:
+            # short priority list (e.g. only the students who listed the course)
+            self.student_ranks = SortedRanks(self.student_ids, n_ranks)
+        else:
+            self.student_ranks = np.full(n_ranks, -1, dtype = np.int32) # -1 for unranked students
+            self.student_ranks[self.student_ids] = np.arange(len(self.student_ids), dtype = np.int32)
+
+    def get_student_ids(self):
+        return self.student_ids
+
+    def get_priority(self, student):
+        return int(self.student_ranks[student.student_id])
+
+    def ranks(self, student):
+        return self.get_priority(student) >= 0
+
+
+class StudentView():
+    # read-only sequence of Student objects over an array of student ids
+    __slots__ = ('ids', 'student_list')
+
+    def __init__(self, ids, student_list):
+        self.ids = ids
+        self.student_list = student_list
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self.student_list[i] for i in self.ids[index].tolist()]
+        return self.student_list[self.ids[index]]
+
+    def __iter__(self):
+        return map(self.student_list.__getitem__, self.ids.tolist())
+
+
+class SortedRanks():
+    # ranks of a short preference list over n items, indexed like the dense inverse permutation
+    # (ranks[i] is the position of item i in the list, -1 if unlisted) but stored as the sorted
+    # item ids and their positions
+    __slots__ = ('ids', 'positions', 'n')
+
+    def __init__(self, prefs, n):
+        order = np.argsort(prefs, kind = 'stable')
+        self.ids = np.asarray(prefs)[order]
+        self.positions = order.astype(np.int32)
+        self.n = n
+
+    def __len__(self):
+        return self.n
+
+    def __getitem__(self, index):
+        index = np.asarray(index)
+        if len(self.ids) == 0:
+            ranks = np.full(index.shape, -1, dtype = np.int32)
+        else:
+            found = np.minimum(np.searchsorted(self.ids, index), len(self.ids) - 1)
+            ranks = np.where(self.ids[found] == index, self.positions[found], -1)
+        return ranks if ranks.ndim else int(ranks)
+
+
+class RankView():
+    # read-only mapping student_id: priority position over an array of ranks
+    __slots__ = ('ids', 'ranks')
+
+    def __init__(self, ids, ranks):
+        self.ids = ids
+        self.ranks = ranks
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __getitem__(self, student_id):
+        if student_id not in self:
+            raise KeyError(student_id)
+        return int(self.ranks[student_id])
+
+    def __contains__(self, student_id):
+        return 0 <= student_id < len(self.ranks) and self.ranks[student_id] >= 0
+
+    def __iter__(self):
+        return iter(self.ids.tolist())
+
+    def keys(self):
+        return self.ids.tolist()
+
+    def values(self):
+        return range(len(self.ids))
+
+    def items(self):
+        return zip(self.keys(), self.values())
@@ -0,0 +1,312 @@
+import argparse
+import json
+import os
+import sys
+import time
+
+import numpy as np
+
+from matching import (find_matching, find_matching_fast, resolve_conflicts, determine_conflicts_fast,
+                      resolve_conflicts_fast)
+from market import enrollment_from_objects
+from schedule import CutTreeCache, conflict_matrix, conflict_nodes, gomory_hu_slots, greedy_slots, assign_times
+from simulate import generate_data, generate_market
+from incremental import IncrementalMatching
+
+
+# (n_students, n_courses) ladders; enroll limits keep seats at 40% of the demand as in the
+# default experiment (5000 students x 4 credits, 100 courses x 80 seats)
+SIZES = {
+    'small': [(1000, 50), (2500, 100), (5000, 200), (10000, 500), (20000, 1000)],
+    'full': [(1000, 50), (2500, 100), (5000, 200), (10000, 500), (20000, 1000), (50000, 2000),
+             (100000, 5000)],
+}
+STAGES = ['generate_data', 'find_matching', 'gomory_hu', 'greedy_slots', 'determine_conflicts',
+          'resolve_conflicts']
+N_SLOTS = 12
+
+
+def enroll_limit_for(n_students, n_courses, credit_limit = 4, seat_ratio = 0.4):
+    return max(1, int(round(seat_ratio * credit_limit * n_students / n_courses)))
+
+
+def current_rss():
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+
+def reset_peak_rss():
+    # Linux: writing 5 to clear_refs resets the VmHWM high-water mark of this process
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def peak_rss():
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith('VmHWM:'):
+                return int(line.split()[1]) * 1024
+
+
+class Timer():
+    # wall time and peak RSS growth of one stage
+    def __enter__(self):
+        self.tracks_memory = reset_peak_rss()
+        self.rss_start = current_rss() if self.tracks_memory else None
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.seconds = time.perf_counter() - self.start
+        self.peak_memory = peak_rss() - self.rss_start if self.tracks_memory else None
+
+# =============================================================================== #
+
+def run_pipeline(n_students, n_courses, seed = 0, credit_limit = 4, n_depts = 15, compact = True):
+    # one pass of the array pipeline on a fixed-seed market; returns {stage: measurements}
+    enroll_limit = enroll_limit_for(n_students, n_courses, credit_limit)
+    stages = {}
+
+    with Timer() as t:
+        student_list, course_list = generate_data(n_students, n_courses, n_depts, credit_limit, enroll_limit,
+                                                  seed = seed, compact = compact)
+    stages['generate_data'] = {'seconds': t.seconds, 'peak_memory': t.peak_memory, 'items': n_students}
+
+    with Timer() as t:
+        student_list, course_list = find_matching_fast(student_list, course_list)
+    # every proposal advances the proposing student's pointer by one
+    n_proposals = sum(s.current_course_propose for s in student_list)
+    stages['find_matching'] = {'seconds': t.seconds, 'peak_memory': t.peak_memory, 'items': n_proposals}
+
+    enrollment = enrollment_from_objects(student_list, course_list)
+    conflicts = conflict_matrix(enrollment)
+    with Timer() as t:
+        # a fresh cache per pass: the shared tree_cache would turn every repeat after the first
+        # into a lookup
+        slots = gomory_hu_slots(conflicts, N_SLOTS, nodes = conflict_nodes(enrollment), cache = CutTreeCache())
+    stages['gomory_hu'] = {'seconds': t.seconds, 'peak_memory': t.peak_memory, 'items': n_courses}
+    with Timer() as t:
+        greedy_slots(conflicts, N_SLOTS)
+    stages['greedy_slots'] = {'seconds': t.seconds, 'peak_memory': t.peak_memory, 'items': n_courses}
+    assign_times(course_list, slots)
+
+    with Timer() as t:
+        student_list, course_list = determine_conflicts_fast(student_list, course_list)
+    stages['determine_conflicts'] = {'seconds': t.seconds, 'peak_memory': t.peak_memory, 'items': n_students}
+    with Timer() as t:
+        student_list, course_list = resolve_conflicts_fast(student_list, course_list)
+    stages['resolve_conflicts'] = {'seconds': t.seconds, 'peak_memory': t.peak_memory, 'items': n_students}
+
+    for stage in stages.values():
+        stage['throughput'] = stage['items'] / max(stage['seconds'], 1e-9)
+    return stages
+
+
+def run_benchmark(sizes, seed = 0, repeat = 1, compact = True, verbose = True):
+    # best of `repeat` passes for every size; returns {"SxC": {stage: measurements}}
+    results = {}
+    for n_students, n_courses in sizes:
+        best = None
+        for _ in range(repeat):
+            stages = run_pipeline(n_students, n_courses, seed = seed, compact = compact)
+            if best is None:
+                best = stages
+            else:
+                for name, stage in stages.items():
+                    if stage['seconds'] < best[name]['seconds']:
+                        best[name] = stage
+        results[f"{n_students}x{n_courses}"] = best
+        if verbose:
+            print(f"{n_students:>7} students x {n_courses:>5} courses: " +
+                  ", ".join(f"{name} {stage['seconds']:.3f}s" for name, stage in best.items()), flush = True)
+    return results
+
+
+def parallel_scaling(n_students, n_courses, workers, n_depts = 15, seed = 0, verbose = True):
+    # find_matching_fast with the rounds sharded over each number of worker processes, against
+    # the serial engine on the same market; returns {workers: {'seconds', 'speedup'}}
+    market = generate_market(n_students, n_courses, n_depts, 4, enroll_limit_for(n_students, n_courses), seed = seed)
+    timings = {}
+    for n_workers in [None] + list(workers):
+        student_list, course_list = market.to_objects(compact = True)
+        with Timer() as t:
+            find_matching_fast(student_list, course_list, n_workers = n_workers)
+        timings[n_workers or 'serial'] = {'seconds': t.seconds,
+                                          'speedup': timings['serial']['seconds'] / t.seconds if n_workers else 1.0}
+        if verbose:
+            print(f"find_matching {'serial' if n_workers is None else f'{n_workers} workers':>11}: "
+                  f"{t.seconds:.3f}s (x{timings[n_workers or 'serial']['speedup']:.2f})", flush = True)
+    return timings
+
+
+def scaling_exponents(results):
+    # slope of log(time) against log(n_students * n_courses) (log(n_courses) for slotting)
+    exponents = {}
+    keys = list(results)
+    students = np.array([int(k.split('x')[0]) for k in keys])
+    courses = np.array([int(k.split('x')[1]) for k in keys])
+    for stage in STAGES:
+        seconds = np.array([results[k][stage]['seconds'] for k in keys])
+        sizes = courses if stage in ('gomory_hu', 'greedy_slots') else students * courses
+        if len(keys) >= 2:
+            exponents[stage] = float(np.polyfit(np.log(sizes), np.log(np.maximum(seconds, 1e-6)), 1)[0])
+    return exponents
+
+
+def compare_to_baseline(results, baseline, tolerance = 0.25, min_seconds = 0.05):
+    # stages slower than baseline * (1 + tolerance), ignoring timings too short to be stable
+    regressions = []
+    for size, stages in results.items():
+        for stage, measured in stages.items():
+            reference = baseline.get(size, {}).get(stage)
+            if reference is None or measured['seconds'] < min_seconds:
+                continue
+            ratio = measured['seconds'] / max(reference['seconds'], 1e-9)
+            if ratio > 1 + tolerance:
+                regressions.append((size, stage, reference['seconds'], measured['seconds'], ratio))
+    return regressions
+
+
+def print_report(results, exponents):
+    print(f"\n{'size':>12} {'stage':>20} {'seconds':>9} {'throughput':>14} {'peak MB':>9}")
+    for size, stages in results.items():
+        for stage, m in stages.items():
+            unit = 'proposals/s' if stage == 'find_matching' else (
+                'courses/s' if stage in ('gomory_hu', 'greedy_slots') else 'students/s')
+            peak = f"{m['peak_memory'] / 2 ** 20:9.1f}" if m['peak_memory'] is not None else f"{'-':>9}"
+            print(f"{size:>12} {stage:>20} {m['seconds']:9.3f} {m['throughput']:10.3g} {unit:<12} {peak}")
+    print("\nScaling exponents (time ~ size^b; size = students x courses, courses for slotting):")
+    for stage, b in exponents.items():
+        print(f"\t{stage:>20}: {b:.2f}")
+
+# =============================================================================== #
+
+def _enrollments(student_list, course_list):
+    return ([sorted(s.course_enroll) for s in student_list],
+            [[s.student_id for s in c.student_enroll] for c in course_list])
+
+
+def check_engines(sizes, seeds = (0, 1, 2), verbose = True):
+    # every accelerated engine against the reference object code on the same markets;
+    # returns the list of failed checks
+    failures = []
+
+    def check(name, ok):
+        if not ok:
+            failures.append(name)
+        if verbose:
+            print(f"\t{'ok  ' if ok else 'FAIL'} {name}")
+
+    for n_students, n_courses in sizes:
+        for seed in seeds:
+            enroll_limit = enroll_limit_for(n_students, n_courses)
+            market = generate_market(n_students, n_courses, 5, 4, enroll_limit, seed = seed)
+            if verbose:
+                print(f"{n_students} students x {n_courses} courses, seed {seed}")
+
+            reference = find_matching(*market.to_objects())
+            expected = _enrollments(*reference)
+            for label, compact in [('array', False), ('array compact', True)]:
+                fast = find_matching_fast(*market.to_objects(compact = compact))
+                check(f"find_matching [{label}]", _enrollments(*fast) == expected and
+                      [s.current_course_propose for s in fast[0]] == [s.current_course_propose for s in reference[0]])
+            parallel = find_matching_fast(*market.to_objects(compact = True), n_workers = 3)
+            check("find_matching [parallel]", _enrollments(*parallel) == expected and
+                  [s.current_course_propose for s in parallel[0]] == [s.current_course_propose for s in reference[0]])
+            incremental = IncrementalMatching(*market.to_objects(compact = True))
+            check("find_matching [incremental]", _enrollments(incremental.student_list,
+                                                             incremental.course_list) == expected)
+
+            # slots for the conflict resolution checks (tests/test_schedule.py compares them with networkx)
+            enrollment = enrollment_from_objects(*reference)
+            slots = gomory_hu_slots(conflict_matrix(enrollment), N_SLOTS, nodes = conflict_nodes(enrollment),
+                                    cache = CutTreeCache())
+
+            # conflict resolution on identical matched markets with the same times
+            resolved = []
+            for engine in ['object', 'array', 'parallel']:
+                student_list, course_list = find_matching_fast(*market.to_objects())
+                assign_times(course_list, slots)
+                if engine == 'object':
+                    for s in student_list:
+                        s.determine_conflicts(course_list)
+                    student_list, course_list = resolve_conflicts(student_list, course_list)
+                else:
+                    student_list, course_list = determine_conflicts_fast(student_list, course_list)
+                    student_list, course_list = resolve_conflicts_fast(
+                        student_list, course_list, n_workers = 3 if engine == 'parallel' else None)
+                resolved.append(_enrollments(student_list, course_list))
+            check("determine + resolve_conflicts [array]", resolved[0] == resolved[1])
+            check("determine + resolve_conflicts [parallel]", resolved[0] == resolved[2])
+    return failures
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = 'Benchmark the matching pipeline')
+    parser.add_argument('--sizes', default = 'small',
+                        help = "Ladder name (small, full) or a list such as 1000x50,5000x200")
+    parser.add_argument('--max_students', type = int, default = None)
+    parser.add_argument('--seed', type = int, default = 0)
+    parser.add_argument('--repeat', type = int, default = 1, help = 'Best of this many passes per size')
+    parser.add_argument('--objects', action = 'store_true',
+                        help = 'Use the default Student/Course objects instead of the compact ones')
+    parser.add_argument('--output', default = "results/benchmark.json")
+    parser.add_argument('--baseline', default = "results/benchmark_baseline.json")
+    parser.add_argument('--save_baseline', action = 'store_true', help = 'Store this run as the new baseline')
+    parser.add_argument('--tolerance', type = float, default = 0.25,
+                        help = 'Flag stages slower than baseline * (1 + tolerance)')
+    parser.add_argument('--workers', type = int, nargs = '+', default = None,
+                        help = 'Parallel mode: time find_matching over these numbers of department shards '
+                               '(on the largest size)')
+    parser.add_argument('--n_depts', type = int, default = 15, help = 'Departments in --workers mode')
+    parser.add_argument('--check', action = 'store_true',
+                        help = 'Correctness mode: compare every accelerated engine with the object code')
+    args = parser.parse_args()
+
+    if args.sizes in SIZES:
+        sizes = SIZES[args.sizes]
+    else:
+        sizes = [tuple(int(x) for x in size.split('x')) for size in args.sizes.split(',')]
+    if args.max_students is not None:
+        sizes = [size for size in sizes if size[0] <= args.max_students]
+
+    if args.check:
+        if args.sizes == 'small':
+            sizes = [(200, 10), (1000, 30), (3000, 60)]
+        failures = check_engines(sizes)
+        print(f"\n{len(failures)} failed checks" + (f": {sorted(set(failures))}" if failures else ""))
+        sys.exit(1 if failures else 0)
+
+    if args.workers:
+        n_students, n_courses = sizes[-1]
+        timings = parallel_scaling(n_students, n_courses, args.workers, n_depts = args.n_depts, seed = args.seed)
+        os.makedirs(os.path.dirname(args.output) or '.', exist_ok = True)
+        with open(args.output, 'w') as f:
+            json.dump({'parallel': {str(k): v for k, v in timings.items()}}, f, indent = 1)
+        sys.exit(0)
+
+    results = run_benchmark(sizes, seed = args.seed, repeat = args.repeat, compact = not args.objects)
+    exponents = scaling_exponents(results)
+    print_report(results, exponents)
+
+    os.makedirs(os.path.dirname(args.output) or '.', exist_ok = True)
+    with open(args.output, 'w') as f:
+        json.dump({'results': results, 'scaling_exponents': exponents}, f, indent = 1)
+
+    status = 0
+    if args.save_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump(results, f, indent = 1)
+        print(f"\nBaseline saved to {args.baseline}")
+    elif os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            regressions = compare_to_baseline(results, json.load(f), tolerance = args.tolerance)
+        print(f"\n{len(regressions)} regressions against {args.baseline}")
+        for size, stage, before, after, ratio in regressions:
+            print(f"\t{size} {stage}: {before:.3f}s -> {after:.3f}s ({ratio:.2f}x)")
+        status = 1 if regressions else 0
+    sys.exit(status)
@@ -1,160 +1,251 @@
-import random
-from collections import defaultdict
-from itertools import combinations, product, chain
+import os
 
 import numpy as np
-import matplotlib.pyplot as plt
-import seaborn as sns
-
-import networkx as nx
 
 import argparse
 
-from agent import Student, Course
-from matching import *
-from simulate import * 
-
-
-def main(n_students = 5000, n_courses = 100, n_depts = 15, 
-        credit_limit = 4, enroll_limit = 80, n_slots = 12):
-
-    student_list, course_list = generate_data(n_students = n_students, 
-                                            n_courses = n_courses, 
-                                            n_depts = n_depts, 
-                                            credit_limit = credit_limit,
-                                            enroll_limit = enroll_limit)
-
-    student_list, course_list = find_matching(student_list, course_list)
-
-    student_utilities = [s.get_utilities() for s in student_list]
-    
-    plt.clf()
-    sns.histplot(student_utilities, stat = 'percent', color = 'seagreen')
-    plt.xlabel("Student utiltities")
-    filename = f"results/fig/utils_match_s{n_students}c{n_courses}d{n_depts}cl{credit_limit}el{enroll_limit}k{n_slots}"
-    plt.savefig(filename)
-
-    course_enroll_sizes = [len(c.student_enroll) for c in course_list]
-    plt.clf()
-    sns.histplot(course_enroll_sizes, stat = 'percent', color = 'seagreen')
-    plt.xlabel("Course sizes")
-    filename = f"results/fig/csizes_match_s{n_students}c{n_courses}d{n_depts}cl{credit_limit}el{enroll_limit}k{n_slots}"
-    plt.savefig(filename)
+import instrument
+from market import enrollment_matrix, enrollment_from_objects, student_welfare
+from matching import (find_matching, find_matching_fast, determine_conflicts_fast, resolve_conflicts,
+                      resolve_conflicts_fast, resolve_unmatched, resolve_pairs)
+from simulate import generate_market
+from schedule import (schedule_courses, conflict_matrix, count_conflicts, use_tree_cache, optimize_slots,
+                      assign_times)
+from plots import save_metrics, render_metrics, render_in_background
+from verify import check_invariants, verify_matching, verify_resolved
+from snapshot import (capture_rng, capture_state, apply_state, course_times, save_snapshot,
+                      load_snapshot)
+from replicates import run_replicates, summarize
+
+
+def get_student_utilities(student_list, course_list, course_ranks = None):
+    # bulk welfare from the enrollment matrix when the course rank matrix is available
+    if course_ranks is None:
+        return [s.get_utilities() for s in student_list]
+    return student_welfare(enrollment_from_objects(student_list, course_list), course_ranks)
+
+
+def sanity_check(student_list, course_list):
+    # capacity limits and matching back-references, vectorized (see verify.py)
+    report = check_invariants(student_list, course_list)
+    assert report.ok, report.summary()
+
+
+def run_experiment(n_students = 5000, n_courses = 100, n_depts = 15, 
+        credit_limit = 4, enroll_limit = 80, n_slots = 12, engine = 'array', seed = None,
+        compact = False, scheduler = 'gomory_hu', verbose = True, snapshot = None, snapshot_path = None,
+        n_workers = None, verify = False, slot_search = None, slot_steps = 200_000):
+    # matching, scheduling and the random-time baseline, without plotting; returns the student
+    # utilities and course sizes of every stage ('match', 'resolve', 'baseline') and the
+    # number of conflicts left by the schedule and by the random times.
+    # snapshot: fork from a loaded Snapshot (its market, random streams and, if saved, matching
+    # and schedule) instead of generating the market; snapshot_path: save this run's market,
+    # random streams, matching and schedule there.
+    # engine 'parallel' is the array engine with the rounds run in department shards by n_workers
+    # processes (default: one per CPU), with the same results.
+    # verify: also check the stability of the matching and of the resolving round and the time
+    # conflicts left (verify.py); the reports are returned under 'verification'.
+    # slot_search: refine the schedule's slots by local search ('descent' or 'anneal' with
+    # slot_steps candidate moves) before resolving; 'slot_search' then reports the conflicts and
+    # resolved welfare of the schedule's own slots for comparison
+    workers = (n_workers or os.cpu_count()) if engine == 'parallel' else None
+    array_engine = engine in ('array', 'parallel')
+    with instrument.phase('generate_data'):
+        if snapshot is None:
+            market = generate_market(n_students, n_courses, n_depts, credit_limit, enroll_limit, seed = seed)
+            rng_state = capture_rng() if snapshot_path is not None else None
+        else:
+            market = snapshot.market
+            snapshot.restore_rng()
+            rng_state = snapshot.rng_state
+        student_list, course_list = market.to_objects(compact = compact)
+
+    with instrument.phase('find_matching', engine = engine):
+        if snapshot is not None and snapshot.state is not None:
+            apply_state(student_list, course_list, snapshot.state, market.priority_ranks)
+        elif array_engine:
+            student_list, course_list = find_matching_fast(student_list, course_list, n_workers = workers)
+        else:
+            student_list, course_list = find_matching(student_list, course_list)
+    course_ranks = market.course_ranks if array_engine else None
+    state = capture_state(student_list, course_list) if snapshot_path is not None else None
+
+    utilities = {'match': np.asarray(get_student_utilities(student_list, course_list, course_ranks))}
+    course_sizes = {'match': np.array([len(c.student_enroll) for c in course_list])}
+    conflicts = conflict_matrix(enrollment_from_objects(student_list, course_list))
 
     # Sanity checks
-    for c in course_list:
-        for s in c.student_enroll:
-            assert c.course_id in s.course_enroll
-            
-        assert len(c.student_enroll) <= c.enroll_limit
-
-    for s in student_list:
-        assert len(s.course_enroll) <= s.credit_limit
-
-
-    # Course scheduling
-    conflict_counts = defaultdict(int)
+    sanity_check(student_list, course_list)
+    reports = {}
+    if verify:
+        with instrument.phase('verify'):
+            reports['match'] = verify_matching(student_list, course_list)
+
+    # Course scheduling: a snapshot with a matching resumes from the scheduler's saved slots if
+    # they were made with the same settings (any slot search is re-run, it is seeded)
+    schedule = {'n_slots': n_slots, 'scheduler': scheduler, 'seed': seed}
+    with instrument.phase('schedule', method = scheduler):
+        if snapshot is not None and snapshot.state is not None and snapshot.schedule_slots is not None and \
+                {key: (snapshot.schedule or {}).get(key) for key in schedule} == schedule:
+            slots = np.array(snapshot.schedule_slots)
+            assign_times(course_list, slots)
+            n_conflicts = count_conflicts(conflicts, slots)
+            if verbose:
+                print(f"saved schedule: {n_conflicts} conflicts over {n_slots} slots")
+        else:
+            slots, n_conflicts = schedule_courses(student_list, course_list, n_slots = n_slots, method = scheduler,
+                                                  seed = seed, verbose = verbose)
+    schedule_slots = slots
+    slot_report = None
+    if slot_search is not None:
+        with instrument.phase('optimize_slots', method = slot_search, steps = slot_steps):
+            search = optimize_slots(conflicts, slots, n_slots, method = slot_search, n_steps = slot_steps, seed = seed)
+            assign_times(course_list, search.slots)
+        with instrument.phase('evaluate_slots'):
+            # what resolving would give with the unrefined slots (unscheduled courses share a slot)
+            held_students, held_courses = resolve_pairs(
+                enrollment_from_objects(student_list, course_list), np.where(slots >= 0, slots, search.n_slots),
+                market.course_prefs, market.course_ranks, market.priority_ranks, market.enroll_limits,
+                market.credit_limits)
+            enrollment = enrollment_matrix(held_students, held_courses, market.n_students, market.n_courses)
+        slot_report = {'method': slot_search,
+                       'n_conflicts_schedule': n_conflicts,
+                       'welfare_schedule': student_welfare(enrollment, market.course_ranks),
+                       'n_evaluated': search.n_evaluated}
+        slots, n_conflicts = search.slots, search.cost
+    if snapshot_path is not None:
+        save_snapshot(snapshot_path, market, times = course_times(course_list), state = state,
+                      rng_state = rng_state, schedule_slots = schedule_slots,
+                      schedule = dict(schedule, slot_search = slot_search,
+                                      slot_steps = slot_steps if slot_search is not None else None))
+
+    # Resolve conflicts among students
+    with instrument.phase('determine_conflicts', engine = engine):
+        if array_engine:
+            student_list, course_list = determine_conflicts_fast(student_list, course_list)
+        else:
+            for s in student_list:
+                s.determine_conflicts(course_list)
+    kept = enrollment_from_objects(student_list, course_list) if verify else None
+
+    with instrument.phase('resolve_conflicts', engine = engine):
+        if array_engine:
+            student_list, course_list = resolve_conflicts_fast(student_list, course_list, n_workers = workers)
+        else:
+            student_list, course_list = resolve_conflicts(student_list, course_list)
 
-    for s in student_list:
-        for c1, c2 in combinations(sorted(s.course_enroll), 2):
-            conflict_counts[(c1, c2)] += 1
-
-    print(f"number of edges: {len(conflict_counts)}")
-    print(f"total number of conflicts: {sum(conflict_counts.values())}")
-
-    graph = nx.Graph()
-    graph.add_weighted_edges_from([(c[0], c[1], n * (-1) + max(conflict_counts.values())) 
-                                for c, n in conflict_counts.items()])
-    print(f"Number of nodes: {graph.number_of_nodes()}")
-    print(f"Number of edges: {graph.number_of_edges()}")
-
-    T = nx.gomory_hu_tree(graph, capacity = 'weight')
-    min_weight_k_edges = sorted([e for e in T.edges(data = True)], 
-                                key = lambda x: x[2]['weight'],
-                                reverse = False)[: n_slots - 1]
-    for node1, node2, data in min_weight_k_edges:
-        print(f"({node1}, {node2}) with weight {data['weight']}")
-
-    T.remove_edges_from(min_weight_k_edges)
-    components = list(nx.connected_components(T))
-    print(f"Number of components: {len(components)}")
-    for i, comp in enumerate(components):
-        print(f"Component {i}: size = {len(comp)} -> {list(comp)}")
-
-    # Assign time to courses and resolve conflicts among students
-    for t, c_list in enumerate(components):
-        for c in list(c_list):
-            course_list[c].set_time(t)
-
-    for s in student_list:
-        s.determine_conflicts(course_list)
+    # sanity checks
+    sanity_check(student_list, course_list)
+    if verify:
+        with instrument.phase('verify'):
+            reports['resolve'] = verify_resolved(student_list, course_list, kept)
+
+    utilities['resolve'] = np.asarray(get_student_utilities(student_list, course_list, course_ranks))
+    course_sizes['resolve'] = np.array([len(c.student_enroll) for c in course_list])
+
+
+    # Run baseline on a fresh copy of the market (same preferences and priorities, no enrollment)
+    with instrument.phase('baseline'):
+        # Randomly assign times for courses (the same draws as one randint per course)
+        baseline_slots = np.random.randint(n_slots, size = market.n_courses)
+
+        with instrument.phase('resolve_conflicts', engine = engine):
+            if array_engine:
+                # without enrollment nobody has unavailable times, so the times do not change the
+                # outcome and the market arrays are matched directly, without building objects
+                held_students, held_courses = resolve_unmatched(market.priority_ranks, market.enroll_limits,
+                                                                market.credit_limits)
+                enrollment = enrollment_matrix(held_students, held_courses, market.n_students, market.n_courses)
+                utilities['baseline'] = student_welfare(enrollment, course_ranks)
+                course_sizes['baseline'] = np.bincount(held_courses, minlength = market.n_courses)
+            else:
+                student_list_baseline, course_list_baseline = market.to_objects(compact = compact)
+                for c_baseline, t in zip(course_list_baseline, baseline_slots.tolist()):
+                    c_baseline.set_time(t)
+                student_list_baseline, course_list_baseline = resolve_conflicts(student_list_baseline,
+                                                                                course_list_baseline)
+                utilities['baseline'] = np.asarray(get_student_utilities(student_list_baseline,
+                                                                         course_list_baseline))
+                course_sizes['baseline'] = np.array([len(c.student_enroll) for c in course_list_baseline])
+
+    return {'utilities': utilities,
+            'course_sizes': course_sizes,
+            'n_conflicts': n_conflicts,
+            'n_conflicts_baseline': count_conflicts(conflicts, baseline_slots),
+            'verification': reports,
+            'slot_search': slot_report}
+
+
+def figure_suffix(n_students, n_courses, n_depts, credit_limit, enroll_limit, n_slots):
+    return f"s{n_students}c{n_courses}d{n_depts}cl{credit_limit}el{enroll_limit}k{n_slots}"
+
+
+def render_figures(metrics_path, figures = 'inline'):
+    # figures: 'inline' renders them now, 'background' in a child process, 'none' leaves the
+    # metrics file for `python plots.py` (headless runs)
+    if figures == 'inline':
+        render_metrics(metrics_path)
+    elif figures == 'background':
+        render_in_background(metrics_path)
+
+
+def replicate_conflicts(engine = 'array', compact = False, verify = False, snapshot = None, snapshot_path = None,
+                        slot_search = None, n_workers = None):
+    # options of a single run that the batched replicates (array engine, generated markets, no
+    # objects) do not support
+    used = {f'--engine {engine}': engine != 'array', '--compact': compact, '--verify': verify,
+            '--snapshot': snapshot is not None, '--save_snapshot': snapshot_path is not None,
+            '--slot_search': slot_search is not None, '--workers': n_workers is not None}
+    return [option for option, is_used in used.items() if is_used]
 
-    student_list, course_list = resolve_conflicts(student_list, course_list)
 
-    # sanity checks
-    for c in course_list:
-        for s in c.student_enroll:
-            assert c.course_id in s.course_enroll
-            
-        assert len(c.student_enroll) <= c.enroll_limit
-
-    for s in student_list:
-        assert len(s.course_enroll) <= s.credit_limit
-
-
-    student_utilities = [s.get_utilities() for s in student_list]
-    total_welfare = sum(student_utilities)
-    plt.clf()
-    sns.histplot(student_utilities, stat = 'percent', color = 'seagreen')
-    plt.xlabel("Student utiltities")
-    filename = f"results/fig/utils_resolve_s{n_students}c{n_courses}d{n_depts}cl{credit_limit}el{enroll_limit}k{n_slots}"
-    plt.savefig(filename)
-
-    course_enroll_sizes = [len(c.student_enroll) for c in course_list]
-    plt.clf()
-    sns.histplot(course_enroll_sizes, stat = 'percent', color = 'seagreen')
-    plt.xlabel("Course sizes")
-    filename = f"results/fig/csizes_resolve_s{n_students}c{n_courses}d{n_depts}cl{credit_limit}el{enroll_limit}k{n_slots}"
-    plt.savefig(filename)
-
-
-    # Run baseline
-    student_list_baseline = [Student(s.student_id, s.n_courses, s.year, s.dept, s.credit_limit)
-                            for s in student_list]
-    # copy course prefs
-    for s, s_baseline in zip(student_list, student_list_baseline):
-        s_baseline.course_prefs = s.course_prefs.copy()
-        
-
-    course_list_baseline = [Course(c.course_id, [], c.dept, c.enroll_limit)
-                            for c in course_list]
-    # copy student prefs
-    for c, c_baseline in zip(course_list, course_list_baseline):
-        c_baseline.student_prefs = [student_list_baseline[s.student_id] for s in c.student_prefs]
-        c_baseline.student_prefs_dict = {student.student_id: index 
-                                    for index, student in enumerate(c_baseline.student_prefs)}
-        
-    # Randomly assign times for courses
-    for c_baseline in course_list_baseline:
-        c_baseline.set_time(np.random.randint(n_slots))
-        
-    student_list_baseline, course_list_baseline = resolve_conflicts(student_list_baseline, course_list_baseline)
-
-
-    student_utilities_baseline = [s.get_utilities() for s in student_list_baseline]
-    total_welfare_baseline = sum(student_utilities_baseline)
-    plt.clf()
-    sns.histplot(student_utilities_baseline, stat = 'percent', color = 'seagreen')
-    plt.xlabel("Student utiltities")
-    filename = f"results/fig/utils_baseline_s{n_students}c{n_courses}d{n_depts}cl{credit_limit}el{enroll_limit}k{n_slots}"
-    plt.savefig(filename)
-
-    course_enroll_sizes_baseline = [len(c.student_enroll) for c in course_list_baseline]
-    plt.clf()
-    sns.histplot(course_enroll_sizes_baseline, stat = 'percent', color = 'seagreen')
-    plt.xlabel("Course sizes")
-    filename = f"results/fig/csizes_baseline_s{n_students}c{n_courses}d{n_depts}cl{credit_limit}el{enroll_limit}k{n_slots}"
-    plt.savefig(filename)
+def main(n_students = 5000, n_courses = 100, n_depts = 15, 
+        credit_limit = 4, enroll_limit = 80, n_slots = 12, engine = 'array', seed = None,
+        compact = False, scheduler = 'gomory_hu', profile = None, trace_allocations = True,
+        snapshot = None, snapshot_path = None, n_workers = None, replicates = 1, figures = 'inline',
+        metrics_dir = "results/metrics", verify = False, tree_cache = None, slot_search = None,
+        slot_steps = 200_000):
+    # profile: write phase timings and per-round counters to profile.json, profile.trace.json
+    # (Chrome trace) and profile.folded (flame graph stacks).
+    # snapshot: directory of a saved snapshot to fork from (memory-mapped, the market sizes
+    # come from the snapshot); snapshot_path: directory to save this run's snapshot to.
+    # replicates: number of independent markets, solved together as one batch (array engine);
+    # the welfare is reported as mean and 95% confidence interval over the replicates.
+    # figures: see render_figures; the metrics they are drawn from are saved to metrics_dir.
+    # verify: print the stability / time conflict checks of verify.py.
+    # tree_cache: directory caching Gomory-Hu trees, reused by runs with the same conflict graph.
+    # slot_search, slot_steps: see run_experiment
+    if tree_cache is not None:
+        use_tree_cache(tree_cache)
+    if replicates > 1:
+        conflicts = replicate_conflicts(engine, compact, verify, snapshot, snapshot_path, slot_search, n_workers)
+        if conflicts:
+            raise ValueError(f"replicates > 1 does not support {', '.join(conflicts)}")
+        return main_replicates(replicates, n_students, n_courses, n_depts, credit_limit, enroll_limit, n_slots,
+                               seed, scheduler, profile, trace_allocations, figures, metrics_dir)
+    if profile is not None:
+        instrument.enable(trace_allocations = trace_allocations)
+
+    if snapshot is not None:
+        snapshot = load_snapshot(snapshot)
+        n_students, n_courses = snapshot.market.n_students, snapshot.market.n_courses
+
+    with instrument.phase('experiment'):
+        results = run_experiment(n_students = n_students, n_courses = n_courses, n_depts = n_depts,
+                                 credit_limit = credit_limit, enroll_limit = enroll_limit, n_slots = n_slots,
+                                 engine = engine, seed = seed, compact = compact, scheduler = scheduler,
+                                 snapshot = snapshot, snapshot_path = snapshot_path, n_workers = n_workers,
+                                 verify = verify, slot_search = slot_search, slot_steps = slot_steps)
+        with instrument.phase('plot', figures = figures):
+            suffix = figure_suffix(n_students, n_courses, n_depts, credit_limit, enroll_limit, n_slots)
+            metrics_path = save_metrics(f"{metrics_dir}/{suffix}.npz", results['utilities'], results['course_sizes'])
+            render_figures(metrics_path, figures)
+
+    if profile is not None:
+        instrument.disable().save(profile)
+
+    total_welfare = np.sum(results['utilities']['resolve'])
+    total_welfare_baseline = np.sum(results['utilities']['baseline'])
 
     print(f"\n\nParameters:")
     print(f"\ts={n_students}, c={n_courses}, d={n_depts}, cl={credit_limit}, el={enroll_limit}, k={n_slots}")
@@ -162,7 +253,61 @@ def main(n_students = 5000, n_courses = 100, n_depts = 15,
     print(f"\tproposed method: {1.0 * total_welfare / n_students : .2f}")
     print(f"\tbaseline: {1.0 * total_welfare_baseline / n_students : .2f}")
     print(f"\twelfare gain: {1.0 * (total_welfare - total_welfare_baseline) / n_students : .2f}\n")
+    if slot_search is not None:
+        # welfare lost to time conflicts: matching welfare minus welfare after resolving
+        report = results['slot_search']
+        welfare_match = np.mean(results['utilities']['match'])
+        lost_schedule = welfare_match - np.mean(report['welfare_schedule'])
+        lost = welfare_match - np.mean(results['utilities']['resolve'])
+        print(f"Slot search ({slot_search}, {report['n_evaluated']} candidate moves):")
+        print(f"\tconflicts: {report['n_conflicts_schedule']} -> {results['n_conflicts']}")
+        print(f"\twelfare lost to conflicts: {lost_schedule : .2f} -> {lost : .2f}"
+              f" ({lost - lost_schedule : .2f})\n")
+    if verify:
+        print("Verification:")
+        for report in results['verification'].values():
+            print("\t" + report.summary().replace("\n", "\n\t"))
+        print()
+
+
+def main_replicates(replicates, n_students, n_courses, n_depts, credit_limit, enroll_limit, n_slots,
+                    seed, scheduler, profile = None, trace_allocations = True, figures = 'inline',
+                    metrics_dir = "results/metrics"):
+    if profile is not None:
+        instrument.enable(trace_allocations = trace_allocations)
+
+    with instrument.phase('experiment'):
+        results = run_replicates(replicates, n_students = n_students, n_courses = n_courses, n_depts = n_depts,
+                                 credit_limit = credit_limit, enroll_limit = enroll_limit, n_slots = n_slots,
+                                 seed = seed, scheduler = scheduler)
+        summary = summarize(results)
+        with instrument.phase('plot', figures = figures):
+            # histograms pooled over the replicates
+            suffix = figure_suffix(n_students, n_courses, n_depts, credit_limit, enroll_limit, n_slots)
+            metrics_path = save_metrics(f"{metrics_dir}/{suffix}_r{replicates}.npz",
+                                        {stage: u.ravel() for stage, u in results['utilities'].items()},
+                                        {stage: sizes.ravel() for stage, sizes in results['course_sizes'].items()},
+                                        welfare_gain = summary['welfare_gain']['values'])
+            render_figures(metrics_path, figures)
+
+    if profile is not None:
+        instrument.disable().save(profile)
+
+    def interval(name):
+        values = summary[name]
+        return f"{values['mean'] : .2f} (95% CI {values['ci_low']:.2f} to {values['ci_high']:.2f})"
 
+    print(f"\n\nParameters:")
+    print(f"\ts={n_students}, c={n_courses}, d={n_depts}, cl={credit_limit}, el={enroll_limit}, k={n_slots}, "
+          f"r={replicates}")
+    print(f"Average welfare over {replicates} replicates:")
+    print(f"\tproposed method: {interval('welfare_resolve')}")
+    print(f"\tbaseline: {interval('welfare_baseline')}")
+    print(f"\twelfare gain: {interval('welfare_gain')}")
+    print(f"Conflicts:")
+    print(f"\t{scheduler}: {interval('n_conflicts')}")
+    print(f"\trandom times: {interval('n_conflicts_baseline')}\n")
+    return summary
 
 
 if __name__ == "__main__":
@@ -179,8 +324,51 @@ if __name__ == "__main__":
                     help='Enroll limit for each student')
     parser.add_argument('--n_slots', type = int, default = 12,
                     help='Number of time slots available')
+    parser.add_argument('--engine', choices = ['array', 'object', 'parallel'], default = 'array',
+                    help='Matching engine: NumPy rank arrays, Student/Course objects, or the array engine '
+                         'sharded by department over worker processes')
+    parser.add_argument('--workers', type = int, default = None,
+                    help='Worker processes of the parallel engine (default: one per CPU)')
+    parser.add_argument('--seed', type = int, default = None,
+                    help='Seed for both random and np.random')
+    parser.add_argument('--compact', action = 'store_true',
+                    help='Use the memory-compact Student/Course representation')
+    parser.add_argument('--scheduler', choices = ['gomory_hu', 'greedy', 'spectral'], default = 'gomory_hu',
+                    help='How courses are partitioned into time slots')
+    parser.add_argument('--profile', default = None,
+                    help='Record phase timings and per-round counters to PROFILE.json / .trace.json / .folded')
+    parser.add_argument('--no_tracemalloc', action = 'store_true',
+                    help='With --profile, skip allocation tracking (RSS and timings only)')
+    parser.add_argument('--snapshot', default = None,
+                    help='Fork from the market snapshot in this directory instead of generating one')
+    parser.add_argument('--save_snapshot', default = None,
+                    help='Save the market, random state, matching and schedule to this directory')
+    parser.add_argument('--figures', choices = ['inline', 'background', 'none'], default = 'inline',
+                    help='Render the histograms inline (default), in a background process, or not at all '
+                         '(headless: only results/metrics/*.npz is written; `python plots.py FILE` renders it later)')
+    parser.add_argument('--verify', action = 'store_true',
+                    help='Check stability and time conflicts of the matching and the resolving round')
+    parser.add_argument('--tree_cache', default = None,
+                    help='Cache Gomory-Hu trees in this directory (reused across n_slots and reruns)')
+    parser.add_argument('--slot_search', choices = ['descent', 'anneal'], default = None,
+                    help='Refine the slots by local search before resolving conflicts')
+    parser.add_argument('--slot_steps', type = int, default = 200_000,
+                    help='Candidate moves of --slot_search anneal')
+    parser.add_argument('--replicates', type = int, default = 1,
+                    help='Number of independent markets, matched together as one batch; reports the '
+                         'welfare mean and 95%% confidence interval')
     
     args = parser.parse_args()
+    if args.replicates > 1:
+        conflicts = replicate_conflicts(args.engine, args.compact, args.verify, args.snapshot, args.save_snapshot,
+                                        args.slot_search, args.workers)
+        if conflicts:
+            parser.error(f"--replicates does not support {', '.join(conflicts)}")
     main(n_students = args.n_students, n_courses = args.n_courses,
         n_depts = args.n_depts, credit_limit = args.credit_limit,
-        enroll_limit = args.enroll_limit, n_slots = args.n_slots)
+        enroll_limit = args.enroll_limit, n_slots = args.n_slots,
+        engine = args.engine, seed = args.seed, compact = args.compact,
+        scheduler = args.scheduler, profile = args.profile, trace_allocations = not args.no_tracemalloc,
+        snapshot = args.snapshot, snapshot_path = args.save_snapshot, n_workers = args.workers,
+        replicates = args.replicates, figures = args.figures, verify = args.verify,
+        tree_cache = args.tree_cache, slot_search = args.slot_search, slot_steps = args.slot_steps)
@@ -0,0 +1,279 @@
+from collections import Counter, deque
+
+import numpy as np
+
+from agent import CompactCourse
+from market import inverse_permutation
+from matching import (preference_arrays, deferred_acceptance, empty_seats, seated_pairs,
+                      run_proposal_rounds)
+
+
+class IncrementalMatching():
+    # Keeps the deferred-acceptance state of find_matching (seats, proposal pointers, eligibility)
+    # so that edits to the market update the existing matching instead of recomputing it.
+    #
+    # Edits are queued with add_student / withdraw_student / set_enroll_limit / update_preferences
+    # and applied by update() in two phases, each of which equals a from-scratch run:
+    #   1. edits that can only help students (withdrawals, capacity increases): the rejections that
+    #      may no longer hold are undone (see _undo_rejections) and the affected students resume
+    #      proposing from the first undone rejection;
+    #   2. edits that can only hurt students (new students, capacity decreases): the courses reject
+    #      their excess students and deferred acceptance simply continues from the current state.
+    # A change of preferences is a withdrawal in phase 1 followed by a new student in phase 2.
+    # New students are inserted into the arrays and the course priorities in one batch per update().
+    # Every student must rank every course and every course every student (complete lists).
+    def __init__(self, student_list, course_list, verbose = False):
+        self.student_list = student_list
+        self.course_list = course_list
+        self.verbose = verbose
+
+        (self.course_prefs, self.priority_ranks,
+         self.enroll_limits, self.credit_limits) = preference_arrays(student_list, course_list)
+        if not isinstance(self.priority_ranks, np.ndarray) or self.course_prefs.shape[1] != len(course_list) \
+                or (self.course_prefs < 0).any():
+            raise ValueError("IncrementalMatching needs complete preference and priority lists")
+        self.course_ranks = inverse_permutation(self.course_prefs)
+        self.pref_lengths = np.full(len(student_list), len(course_list), dtype = np.int64)
+
+        self.seats = empty_seats(self.enroll_limits)
+        self.pointers = np.zeros(len(student_list), dtype = np.int64)
+        self.eligible = np.ones(len(student_list), dtype = bool)
+        self.n_enrolled = np.zeros(len(student_list), dtype = np.int64)
+        run_proposal_rounds(self.course_prefs, self.priority_ranks, self.enroll_limits, self.credit_limits,
+                            self.pref_lengths, self.seats, self.pointers, self.eligible, self.n_enrolled,
+                            verbose = verbose)
+        self._write_back(np.arange(len(student_list)), np.arange(len(course_list)))
+
+        self._new_limits = {} # course_id: enroll_limit
+        self._withdrawn = set() # student_id
+        self._entering = [] # student_id, proposing from scratch in phase 2
+        self._adding = [] # (student, priority positions), inserted at the next update()
+        self._course_depts = np.array([c.dept for c in course_list])
+        self._group_counts = None # (dept, year): number of students, for _priority_positions
+
+    # ------------------------------------------------------------------------------- #
+
+    def add_student(self, student, priority_positions = None):
+        # student.student_id must equal len(student_list); priority_positions[c] is where the
+        # student enters the priority of course c (default: by department and year, random tiebreak)
+        # as it stands after the students added before it
+        assert student.student_id == len(self.student_list)
+        self._check_complete(student.course_prefs)
+        if priority_positions is None:
+            priority_positions = self._priority_positions(student)
+        priority_positions = np.asarray(priority_positions, dtype = np.int64)
+
+        self.student_list.append(student)
+        if self._group_counts is not None:
+            self._group_counts[(student.dept, student.year)] += 1
+        self._adding.append((student, priority_positions))
+        self._entering.append(student.student_id)
+
+    def withdraw_student(self, student_id):
+        self._withdrawn.add(student_id)
+        if student_id in self._entering:
+            self._entering.remove(student_id)
+
+    def set_enroll_limit(self, course_id, new_limit):
+        self.course_list[course_id].set_enroll_limit(new_limit)
+        self._new_limits[course_id] = new_limit
+
+    def update_preferences(self, student_id, course_prefs):
+        self._check_complete(course_prefs)
+        self.student_list[student_id].course_prefs = course_prefs
+        if student_id >= len(self.pointers):
+            # added since the last update(): inserted with these preferences
+            return
+        course_prefs = np.asarray(course_prefs, dtype = self.course_prefs.dtype)
+        self.course_prefs[student_id] = course_prefs
+        self.course_ranks[student_id] = inverse_permutation(course_prefs[None, :])[0]
+        self.pref_lengths[student_id] = len(course_prefs)
+        self._withdrawn.add(student_id)
+        self._entering.append(student_id)
+
+    def _check_complete(self, course_prefs):
+        course_prefs = np.asarray(course_prefs)
+        if len(course_prefs) != len(self.course_list) or \
+                not np.array_equal(np.sort(course_prefs), np.arange(len(self.course_list))):
+            raise ValueError(f"course_prefs must rank each of the {len(self.course_list)} courses once")
+
+    def _priority_positions(self, student):
+        # same rule as Course._generate_preferences: own department first, then by decreasing year.
+        # Students fall into 2 x n_years keys per course (same department or not, year), counted
+        # from the (dept, year) group sizes instead of a pass over all students
+        n_years = 4
+        if self._group_counts is None:
+            self._group_counts = Counter((s.dept, s.year) for s in self.student_list)
+        rows = np.arange(len(self.course_list))
+        key_counts = np.zeros((len(self.course_list), 2 * n_years), dtype = np.int64)
+        for (dept, year), n in self._group_counts.items():
+            key_counts[rows, (dept != self._course_depts) * n_years + (n_years - 1 - year)] += n
+        key = (student.dept != self._course_depts) * n_years + (n_years - 1 - student.year)
+        n_before = np.cumsum(key_counts, axis = 1)[rows, key] - key_counts[rows, key]
+        n_tied = key_counts[rows, key]
+        return n_before + np.floor(np.random.random(len(self.course_list)) * (n_tied + 1)).astype(np.int64)
+
+    def _insert_students(self):
+        # the students queued by add_student, in one pass over the priority matrix: positions[j, c]
+        # is where student j enters course c after the students before it, final[j, c] its
+        # position once all of them are in
+        if not self._adding:
+            return
+        students = [student for student, _ in self._adding]
+        positions = np.array([positions for _, positions in self._adding], dtype = np.int64)
+        self._adding = []
+        n_old, n_new = self.priority_ranks.shape[1], len(students)
+        final = positions.copy()
+        for j in range(1, n_new):
+            final[:j] += final[:j] >= positions[j]
+
+        n_courses = len(self.course_list)
+        new_ids = np.arange(n_old, n_old + n_new, dtype = self.priority_ranks.dtype)
+        student_prefs = np.empty((n_courses, n_old + n_new), dtype = self.priority_ranks.dtype)
+        inserted = np.zeros(student_prefs.shape, dtype = bool)
+        inserted[np.arange(n_courses), final] = True
+        student_prefs[np.arange(n_courses), final] = new_ids[:, None]
+        student_prefs[~inserted] = inverse_permutation(self.priority_ranks).ravel()
+        self.priority_ranks = inverse_permutation(student_prefs)
+        for c, prefs in zip(self.course_list, student_prefs):
+            if isinstance(c, CompactCourse):
+                c.set_preferences(prefs)
+            else:
+                c.set_preferences([self.student_list[s] for s in prefs.tolist()])
+
+        course_prefs = np.array([s.course_prefs for s in students], dtype = self.course_prefs.dtype)
+        self.course_prefs = np.vstack([self.course_prefs, course_prefs])
+        self.course_ranks = np.vstack([self.course_ranks, inverse_permutation(course_prefs)])
+        self.pref_lengths = np.append(self.pref_lengths, np.full(n_new, n_courses))
+        self.credit_limits = np.append(self.credit_limits, [s.credit_limit for s in students])
+        self.pointers = np.append(self.pointers, np.zeros(n_new, dtype = np.int64))
+        self.eligible = np.append(self.eligible, np.zeros(n_new, dtype = bool))
+        self.n_enrolled = np.append(self.n_enrolled, np.zeros(n_new, dtype = np.int64))
+
+    # ------------------------------------------------------------------------------- #
+
+    def update(self):
+        # apply all queued edits; returns the number of proposals that had to be re-made
+        n_old = len(self.pointers)
+        self._insert_students()
+        old_seats = self.seats.copy()
+        old_pointers, old_eligible = self.pointers[:n_old].copy(), self.eligible[:n_old].copy()
+        widest = max([self.seats.shape[1]] + list(self._new_limits.values()))
+        if widest > self.seats.shape[1]:
+            padding = ((0, 0), (0, widest - self.seats.shape[1]))
+            self.seats = np.pad(self.seats, padding, constant_values = -1)
+            old_seats = np.pad(old_seats, padding, constant_values = -1)
+
+        # phase 1: withdrawals and capacity increases
+        withdrawn = np.array(sorted(self._withdrawn), dtype = np.int64)
+        leaving = np.isin(self.seats, withdrawn)
+        freed_courses = np.flatnonzero(leaving.any(axis = 1)).tolist()
+        self._remove_seated(leaving)
+        self.pointers[withdrawn] = 0
+        self.eligible[withdrawn] = False
+        self.pref_lengths[sorted(self._withdrawn.difference(self._entering))] = 0
+        for c, limit in self._new_limits.items():
+            if limit > self.enroll_limits[c]:
+                self.enroll_limits[c] = limit
+                freed_courses.append(c)
+        self._undo_rejections(freed_courses)
+        n_proposals = self._run()
+
+        # phase 2: capacity decreases and students proposing from scratch
+        for c, limit in self._new_limits.items():
+            self.enroll_limits[c] = limit
+        self._remove_seated(np.arange(self.seats.shape[1])[None, :] >= self.enroll_limits[:, None])
+        entering = np.array(self._entering, dtype = np.int64)
+        self.pointers[entering] = 0
+        self.eligible[entering] = True
+        n_proposals += self._run()
+        self._new_limits, self._withdrawn, self._entering = {}, set(), []
+
+        changed_courses = np.flatnonzero((self.seats != old_seats).any(axis = 1))
+        changed_students = np.concatenate([
+            old_seats[changed_courses].ravel(), self.seats[changed_courses].ravel(),
+            np.flatnonzero((self.pointers[:n_old] != old_pointers) | (self.eligible[:n_old] != old_eligible)),
+            np.arange(n_old, len(self.pointers))])
+        changed_students = np.unique(changed_students[changed_students >= 0])
+        self._write_back(changed_students, changed_courses)
+        return n_proposals
+
+    def _run(self):
+        return run_proposal_rounds(self.course_prefs, self.priority_ranks, self.enroll_limits,
+                                   self.credit_limits, self.pref_lengths, self.seats, self.pointers,
+                                   self.eligible, self.n_enrolled, verbose = self.verbose)
+
+    def _remove_seated(self, mask):
+        # empty the masked seats, keeping each affected row packed in priority order
+        rows = np.flatnonzero(mask.any(axis = 1))
+        if len(rows) == 0:
+            return
+        removed = self.seats[mask]
+        self.n_enrolled -= np.bincount(removed[removed >= 0], minlength = len(self.n_enrolled))
+        seats = np.where(mask[rows], -1, self.seats[rows])
+        order = np.argsort(seats < 0, axis = 1, kind = 'stable')
+        self.seats[rows] = np.take_along_axis(seats, order, axis = 1)
+
+    def _undo_rejections(self, freed_courses):
+        # a course that may gain a seat may take back any student it rejected (directly or through a
+        # cycle of students trading up), and those students may in turn leave the courses they hold
+        # further down their list; undo_from[s] is the first rejection of s that may no longer hold
+        n_students, n_prefs = len(self.pointers), self.course_prefs.shape[1]
+        held_students, held_courses = seated_pairs(self.seats)
+        undo_from = np.full(n_students, n_prefs)
+        queue = deque(sorted(set(freed_courses)))
+        visited = set(queue)
+        while queue:
+            c = queue.popleft()
+            ranks = self.course_ranks[:, c]
+            row = self.seats[c]
+            rejected = np.flatnonzero(ranks < self.pointers)
+            rejected = rejected[~np.isin(rejected, row)]
+            rejected = rejected[ranks[rejected] < undo_from[rejected]]
+            if len(rejected) == 0:
+                continue
+            undo_from[rejected] = ranks[rejected]
+            leaving = np.isin(held_students, rejected)
+            leaving[leaving] = (self.course_ranks[held_students[leaving], held_courses[leaving]]
+                                > undo_from[held_students[leaving]])
+            for d in np.unique(held_courses[leaving]).tolist():
+                if d not in visited:
+                    visited.add(d)
+                    queue.append(d)
+        affected = np.flatnonzero(undo_from < n_prefs)
+        if len(affected) == 0:
+            return
+
+        seated = self.seats >= 0
+        seat_students = np.where(seated, self.seats, 0)
+        seat_ranks = self.course_ranks[seat_students, np.arange(self.seats.shape[0])[:, None]]
+        self._remove_seated(seated & (seat_ranks > undo_from[seat_students]))
+        self.pointers[affected] = undo_from[affected]
+        self.eligible[affected] = True
+
+    def _write_back(self, students, courses):
+        # copy the changed part of the matching into the Student / Course objects
+        for c in courses.tolist():
+            row = self.seats[c]
+            self.course_list[c].student_enroll = [self.student_list[s] for s in row[row >= 0].tolist()]
+        held_students, held_courses = seated_pairs(self.seats)
+        changed = np.isin(held_students, students)
+        holds = {s: [] for s in students.tolist()}
+        for s, c in zip(held_students[changed].tolist(), held_courses[changed].tolist()):
+            holds[s].append(c)
+        for s, courses in holds.items():
+            student = self.student_list[s]
+            student.course_enroll = sorted(courses, key = student.course_ranks.__getitem__)
+            student.current_course_propose = int(self.pointers[s])
+            student.eligible = bool(self.eligible[s])
+
+    # ------------------------------------------------------------------------------- #
+
+    def matching(self):
+        # (students, courses) pairs of the current matching
+        return seated_pairs(self.seats)
+
+    def rematch(self):
+        # from-scratch deferred acceptance on the current market, for checking update()
+        return deferred_acceptance(self.course_prefs, self.priority_ranks, self.enroll_limits,
+                                   self.credit_limits, pref_lengths = self.pref_lengths)
@@ -0,0 +1,167 @@
+import json
+import os
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+
+class Recorder():
+    # Wall time, allocations and memory of nested phases, and counters recorded inside them
+    # (one entry per deferred-acceptance round). Enabled with instrument.enable(); while no
+    # recorder is active instrument.phase / instrument.count do nothing.
+    def __init__(self, trace_allocations = True):
+        self.trace_allocations = trace_allocations
+        self.phases = [] # finished phases, in the order they end
+        self.counters = [] # per-round counters
+        self._stack = []
+        self._origin = time.perf_counter()
+
+    def start(self):
+        if self.trace_allocations and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    def stop(self):
+        if self.trace_allocations and tracemalloc.is_tracing():
+            tracemalloc.stop()
+
+    def _now(self):
+        return time.perf_counter() - self._origin
+
+    @contextmanager
+    def phase(self, name, **args):
+        frame = {'name': name,
+                 'path': [f['name'] for f in self._stack] + [name],
+                 'args': args,
+                 'start': self._now(),
+                 'rss_start': current_rss()}
+        if self.trace_allocations:
+            # the peak counter is shared: fold the parent's peak so far into the parent before resetting
+            allocated, peak = tracemalloc.get_traced_memory()
+            if self._stack:
+                self._stack[-1]['peak'] = max(self._stack[-1]['peak'], peak)
+            tracemalloc.reset_peak()
+            frame['allocated_start'] = allocated
+            frame['peak'] = allocated
+        self._stack.append(frame)
+        try:
+            yield frame
+        finally:
+            self._stack.pop()
+            frame['end'] = self._now()
+            frame['wall'] = frame['end'] - frame['start']
+            frame['rss_end'] = current_rss()
+            if self.trace_allocations:
+                allocated, peak = tracemalloc.get_traced_memory()
+                frame['allocated'] = allocated - frame.pop('allocated_start')
+                frame['peak'] = max(frame['peak'], peak) - (allocated - frame['allocated'])
+                if self._stack:
+                    self._stack[-1]['peak'] = max(self._stack[-1]['peak'], peak)
+            self.phases.append(frame)
+
+    def count(self, **counters):
+        self.counters.append({'phase': '/'.join(f['name'] for f in self._stack),
+                              'time': self._now(), **counters})
+
+    # ------------------------------------------------------------------------------- #
+
+    def summary(self):
+        # phases (wall time in seconds, memory in bytes) and per-round counters
+        phases = []
+        for frame in sorted(self.phases, key = lambda f: f['start']):
+            phase = {'phase': '/'.join(frame['path']),
+                     'wall': frame['wall'],
+                     'rss_start': frame['rss_start'],
+                     'rss_end': frame['rss_end']}
+            if self.trace_allocations:
+                phase['allocated'] = frame['allocated']
+                phase['peak_allocated'] = frame['peak']
+            phase.update(frame['args'])
+            phases.append(phase)
+        return {'phases': phases, 'rounds': self.counters}
+
+    def to_json(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.summary(), f, indent = 1, default = str)
+
+    def to_chrome_trace(self, path):
+        # Trace Event Format (chrome://tracing, Perfetto, speedscope): one complete event per
+        # phase, one counter event per round
+        pid = os.getpid()
+        events = []
+        for frame in sorted(self.phases, key = lambda f: f['start']):
+            args = {k: frame[k] for k in ['rss_start', 'rss_end', 'allocated', 'peak'] if k in frame}
+            args.update({k: str(v) for k, v in frame['args'].items()})
+            events.append({'name': frame['name'], 'ph': 'X', 'pid': pid, 'tid': 0,
+                           'ts': frame['start'] * 1e6, 'dur': frame['wall'] * 1e6, 'args': args})
+        for counter in self.counters:
+            values = {k: v for k, v in counter.items() if k not in ('phase', 'time', 'round')}
+            events.append({'name': counter['phase'], 'ph': 'C', 'pid': pid, 'tid': 0,
+                           'ts': counter['time'] * 1e6, 'args': values})
+        with open(path, 'w') as f:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+
+    def to_folded(self, path):
+        # collapsed stacks ("outer;inner microseconds", self time) for flamegraph.pl / speedscope
+        self_time = {}
+        for frame in self.phases:
+            key = ';'.join(frame['path'])
+            self_time[key] = self_time.get(key, 0) + frame['wall']
+            if len(frame['path']) > 1:
+                parent = ';'.join(frame['path'][:-1])
+                self_time[parent] = self_time.get(parent, 0) - frame['wall']
+        with open(path, 'w') as f:
+            for key, seconds in self_time.items():
+                f.write(f"{key} {max(int(round(seconds * 1e6)), 0)}\n")
+
+    def save(self, prefix):
+        # prefix.json, prefix.trace.json and prefix.folded
+        self.to_json(f"{prefix}.json")
+        self.to_chrome_trace(f"{prefix}.trace.json")
+        self.to_folded(f"{prefix}.folded")
+
+# =============================================================================== #
+
+_recorder = None
+
+
+def enable(trace_allocations = True):
+    global _recorder
+    _recorder = Recorder(trace_allocations = trace_allocations)
+    _recorder.start()
+    return _recorder
+
+
+def disable():
+    global _recorder
+    recorder, _recorder = _recorder, None
+    if recorder is not None:
+        recorder.stop()
+    return recorder
+
+
+def enabled():
+    return _recorder is not None
+
+
+@contextmanager
+def phase(name, **args):
+    if _recorder is None:
+        yield None
+    else:
+        with _recorder.phase(name, **args) as frame:
+            yield frame
+
+
+def count(**counters):
+    if _recorder is not None:
+        _recorder.count(**counters)
+
+
+def current_rss():
+    # resident set size in bytes (peak RSS where /proc is not available)
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
@@ -0,0 +1,212 @@
+import argparse
+import os
+import resource
+import time
+
+import numpy as np
+import pandas as pd
+
+import instrument
+from agent import CompactStudent, CompactCourse
+from market import enrollment_from_objects, rank_table, student_welfare
+from matching import find_matching_fast, determine_conflicts_fast, resolve_conflicts_fast
+from schedule import schedule_courses
+from simulate import set_seed
+
+
+# Long-format input files (CSV or Parquet), one row per ranked pair; ids can be any integers or
+# strings. Without a rank column a list follows the file order. The student and course files
+# are optional (defaults: year 0, department 0, the credit and enroll limits given to load_data)
+PREFERENCE_COLUMNS = ['student_id', 'course_id', 'rank']
+PRIORITY_COLUMNS = ['course_id', 'student_id', 'rank']
+STUDENT_COLUMNS = ['student_id', 'year', 'dept', 'credit_limit']
+COURSE_COLUMNS = ['course_id', 'dept', 'enroll_limit']
+
+
+def read_chunks(path, columns, chunksize = 1_000_000):
+    # DataFrames of at most chunksize rows, with the columns of the file that are in `columns`
+    if path.endswith('.parquet'):
+        import pyarrow.parquet as pq
+        parquet_file = pq.ParquetFile(path)
+        present = [c for c in columns if c in parquet_file.schema_arrow.names]
+        for batch in parquet_file.iter_batches(batch_size = chunksize, columns = present):
+            yield batch.to_pandas()
+    else:
+        yield from pd.read_csv(path, usecols = lambda c: c in columns, chunksize = chunksize)
+
+
+def encode_ids(values, index, extend = True):
+    # positions of the ids in index; unseen ids are appended to the index (extend) or get -1
+    if index is None:
+        index = pd.Index(pd.unique(values) if extend else [])
+    codes = index.get_indexer(values)
+    if extend and (codes < 0).any():
+        index = index.append(pd.Index(pd.unique(values[codes < 0])))
+        codes = index.get_indexer(values)
+    return codes.astype(np.int32), index
+
+
+def read_pairs(path, row_index, col_index, columns, extend = True, chunksize = 1_000_000):
+    # (row, col, rank key) codes of a long-format preference or priority file, read chunk by
+    # chunk so only the int32 codes of the pairs are ever held; pairs with an unknown id are
+    # dropped when extend is False
+    rows, cols, keys = [], [], []
+    n_read = 0
+    for chunk in read_chunks(path, columns, chunksize):
+        row_codes, row_index = encode_ids(chunk[columns[0]].to_numpy(), row_index, extend)
+        col_codes, col_index = encode_ids(chunk[columns[1]].to_numpy(), col_index, extend)
+        if columns[2] in chunk:
+            rank_keys = chunk[columns[2]].to_numpy(dtype = np.float64)
+        else:
+            rank_keys = np.arange(n_read, n_read + len(chunk), dtype = np.float64)
+        n_read += len(chunk)
+        known = (row_codes >= 0) & (col_codes >= 0)
+        rows.append(row_codes[known])
+        cols.append(col_codes[known])
+        keys.append(rank_keys[known])
+    empty = [np.zeros(0, dtype = np.int32)]
+    return (np.concatenate(rows + empty), np.concatenate(cols + empty),
+            np.concatenate(keys + [np.zeros(0)]), row_index, col_index)
+
+
+def sorted_lists(rows, cols, keys, n_rows, n_cols):
+    # columns of every row ordered by rank key (first occurrence of a repeated pair kept), as
+    # (cols, row start offsets)
+    order = np.lexsort((keys, rows))
+    rows, cols = rows[order], cols[order]
+    _, first = np.unique(rows.astype(np.int64) * n_cols + cols, return_index = True)
+    keep = np.sort(first)
+    rows, cols = rows[keep], cols[keep]
+    return cols, np.searchsorted(rows, np.arange(n_rows + 1))
+
+
+def read_attributes(path, index, columns, defaults, chunksize = 1_000_000):
+    # per-id attribute arrays from a student or course file, defaults for missing ids / columns
+    values = {column: np.full(len(index), default, dtype = np.int64) for column, default in defaults.items()}
+    if path is None:
+        return values
+    for chunk in read_chunks(path, columns, chunksize):
+        codes, _ = encode_ids(chunk[columns[0]].to_numpy(), index, extend = False)
+        known = codes >= 0
+        for column in defaults:
+            if column in chunk:
+                values[column][codes[known]] = chunk[column].to_numpy()[known]
+    return values
+
+
+def file_ids(path, column, chunksize = 1_000_000):
+    index = None
+    if path is not None:
+        for chunk in read_chunks(path, [column], chunksize):
+            _, index = encode_ids(chunk[column].to_numpy(), index)
+    return index
+
+
+def rule_priorities(pref_rows, pref_cols, years, depts, course_depts):
+    # priorities of the original generator, restricted to the students who list a course:
+    # its own department first, then decreasing class year, ties broken randomly
+    other_dept = depts[pref_rows] != course_depts[pref_cols]
+    order = np.lexsort((np.random.random(len(pref_rows)), -years[pref_rows], other_dept, pref_cols))
+    return pref_cols[order], pref_rows[order]
+
+# =============================================================================== #
+
+def load_data(preferences, priorities = None, students = None, courses = None, credit_limit = 4,
+              enroll_limit = 80, seed = None, chunksize = 1_000_000):
+    # CompactStudent / CompactCourse objects with truncated preference lists from long-format
+    # files, in memory proportional to the number of ranked pairs (never students x courses).
+    # Courses rank the students of the priorities file, or by the generator's rule the students
+    # who listed them. Returns (student_list, course_list, student ids, course ids), the ids
+    # being the original ids of the objects' indices
+    if seed is not None:
+        set_seed(seed)
+    student_index = file_ids(students, 'student_id', chunksize)
+    course_index = file_ids(courses, 'course_id', chunksize)
+    pref_rows, pref_cols, pref_keys, student_index, course_index = read_pairs(
+        preferences, student_index, course_index, PREFERENCE_COLUMNS, chunksize = chunksize)
+    n_students, n_courses = len(student_index), len(course_index)
+    pref_cols, pref_starts = sorted_lists(pref_rows, pref_cols, pref_keys, n_students, n_courses)
+    pref_rows = np.repeat(np.arange(n_students, dtype = np.int32), np.diff(pref_starts))
+
+    student_values = read_attributes(students, student_index, STUDENT_COLUMNS,
+                                     {'year': 0, 'dept': 0, 'credit_limit': credit_limit}, chunksize)
+    course_values = read_attributes(courses, course_index, COURSE_COLUMNS,
+                                    {'dept': 0, 'enroll_limit': enroll_limit}, chunksize)
+
+    if priorities is None:
+        prio_rows, prio_cols = rule_priorities(pref_rows, pref_cols, student_values['year'],
+                                               student_values['dept'], course_values['dept'])
+        prio_starts = np.searchsorted(prio_rows, np.arange(n_courses + 1))
+    else:
+        prio_rows, prio_cols, prio_keys, _, _ = read_pairs(priorities, course_index, student_index,
+                                                           PRIORITY_COLUMNS, extend = False,
+                                                           chunksize = chunksize)
+        prio_cols, prio_starts = sorted_lists(prio_rows, prio_cols, prio_keys, n_courses, n_students)
+
+    student_list = [CompactStudent(i, n_courses, year, dept, limit, course_prefs = pref_cols[start: end])
+                    for i, (year, dept, limit, start, end) in enumerate(zip(
+                        student_values['year'].tolist(), student_values['dept'].tolist(),
+                        student_values['credit_limit'].tolist(),
+                        pref_starts[:-1].tolist(), pref_starts[1:].tolist()))]
+    course_list = [CompactCourse(i, student_list, dept, limit, student_prefs = prio_cols[start: end])
+                   for i, (dept, limit, start, end) in enumerate(zip(
+                       course_values['dept'].tolist(), course_values['enroll_limit'].tolist(),
+                       prio_starts[:-1].tolist(), prio_starts[1:].tolist()))]
+    return student_list, course_list, student_index.to_numpy(), course_index.to_numpy()
+
+
+def write_enrollment_file(student_list, student_ids, course_ids, path):
+    # one (student_id, course_id) row per enrolled pair, with the original ids
+    students = np.repeat(np.arange(len(student_list)), [len(s.course_enroll) for s in student_list])
+    courses = np.array([c for s in student_list for c in s.course_enroll], dtype = np.int64)
+    table = pd.DataFrame({'student_id': student_ids[students], 'course_id': course_ids[courses]})
+    os.makedirs(os.path.dirname(path) or '.', exist_ok = True)
+    if path.endswith('.parquet'):
+        table.to_parquet(path, index = False)
+    else:
+        table.to_csv(path, index = False)
+
+
+if __name__ == "__main__":
+    # matching, scheduling and conflict resolution on preference files
+    parser = argparse.ArgumentParser(description = 'Enroll and schedule students from preference files')
+    parser.add_argument('preferences', help = 'student_id, course_id[, rank] (CSV or Parquet)')
+    parser.add_argument('--priorities', default = None,
+                        help = 'course_id, student_id[, rank] (default: own department, then class year)')
+    parser.add_argument('--students', default = None, help = 'student_id[, year, dept, credit_limit]')
+    parser.add_argument('--courses', default = None, help = 'course_id[, dept, enroll_limit]')
+    parser.add_argument('--credit_limit', type = int, default = 4)
+    parser.add_argument('--enroll_limit', type = int, default = 80)
+    parser.add_argument('--n_slots', type = int, default = 12)
+    parser.add_argument('--scheduler', choices = ['gomory_hu', 'greedy', 'spectral'], default = 'greedy',
+                        help = 'Slotting method (the Gomory-Hu k-cut scales poorly to thousands of sections)')
+    parser.add_argument('--seed', type = int, default = None)
+    parser.add_argument('--chunksize', type = int, default = 1_000_000, help = 'Rows read at a time')
+    parser.add_argument('--output', default = None, help = 'Write the final enrollment to this file')
+    args = parser.parse_args()
+
+    start = time.time()
+    with instrument.phase('load_data'):
+        student_list, course_list, student_ids, course_ids = load_data(
+            args.preferences, priorities = args.priorities, students = args.students, courses = args.courses,
+            credit_limit = args.credit_limit, enroll_limit = args.enroll_limit, seed = args.seed,
+            chunksize = args.chunksize)
+    course_ranks = rank_table([s.course_prefs for s in student_list], len(course_list))
+    print(f"loaded {len(student_list)} students, {len(course_list)} courses, "
+          f"{sum(len(s.course_prefs) for s in student_list)} ranked courses ({time.time() - start:.1f}s)")
+
+    student_list, course_list = find_matching_fast(student_list, course_list)
+    welfare_match = student_welfare(enrollment_from_objects(student_list, course_list), course_ranks)
+    _, n_conflicts = schedule_courses(student_list, course_list, n_slots = args.n_slots,
+                                      method = args.scheduler, seed = args.seed)
+    student_list, course_list = determine_conflicts_fast(student_list, course_list)
+    student_list, course_list = resolve_conflicts_fast(student_list, course_list)
+    welfare = student_welfare(enrollment_from_objects(student_list, course_list), course_ranks)
+
+    print(f"average welfare: matching {welfare_match.mean():.2f}, after resolving {welfare.mean():.2f}")
+    print(f"{args.scheduler}: {n_conflicts} conflicts over {args.n_slots} slots")
+    print(f"enrolled pairs: {sum(len(s.course_enroll) for s in student_list)}, "
+          f"time {time.time() - start:.1f}s, "
+          f"peak RSS {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:.0f} MB")
+    if args.output is not None:
+        write_enrollment_file(student_list, student_ids, course_ids, args.output)
@@ -0,0 +1,176 @@
+import numpy as np
+import scipy.sparse as sp
+
+from agent import Student, Course, CompactStudent, CompactCourse
+
+
+class Market():
+    def __init__(self, course_prefs, student_prefs, years, depts, course_depts,
+                 credit_limits, enroll_limits):
+        self.course_prefs = course_prefs # (n_students, n_courses) proposal order of each student
+        self.student_prefs = student_prefs # (n_courses, n_students) priority order of each course
+        self.years = years
+        self.depts = depts
+        self.course_depts = course_depts
+        self.credit_limits = credit_limits
+        self.enroll_limits = enroll_limits
+
+        self._priority_ranks = None
+
+    def __repr__(self):
+        return f"Market(s={self.n_students}, c={self.n_courses})"
+
+    @property
+    def n_students(self):
+        return len(self.years)
+
+    @property
+    def n_courses(self):
+        return len(self.course_depts)
+
+    @property
+    def course_ranks(self):
+        # course_ranks[s, c] is the position of course c in the preferences of student s
+        return inverse_permutation(self.course_prefs)
+
+    @property
+    def priority_ranks(self):
+        # priority_ranks[c, s] is the position of student s in the priority of course c
+        if self._priority_ranks is None:
+            self._priority_ranks = inverse_permutation(self.student_prefs)
+        return self._priority_ranks
+
+    def to_objects(self, compact = False):
+        # compact: __slots__ classes with array-backed preferences and id-based priorities
+        student_class, course_class = (CompactStudent, CompactCourse) if compact else (Student, Course)
+        student_list = [student_class(i, self.n_courses, year, dept, credit_limit, course_prefs = prefs)
+                        for i, (year, dept, credit_limit, prefs) in enumerate(zip(
+                            self.years.tolist(), self.depts.tolist(),
+                            self.credit_limits.tolist(),
+                            self.course_prefs if compact else self.course_prefs.tolist()))]
+        if compact:
+            course_list = [course_class(i, student_list, dept, enroll_limit, student_prefs = prefs)
+                           for i, (dept, enroll_limit, prefs) in enumerate(zip(
+                               self.course_depts.tolist(), self.enroll_limits.tolist(), self.student_prefs))]
+        else:
+            course_list = [course_class(i, [], dept, enroll_limit,
+                                        student_prefs = [student_list[s] for s in prefs])
+                           for i, (dept, enroll_limit, prefs) in enumerate(zip(
+                               self.course_depts.tolist(), self.enroll_limits.tolist(),
+                               self.student_prefs.tolist()))]
+        return student_list, course_list
+
+    @classmethod
+    def from_objects(cls, student_list, course_list):
+        course_prefs = np.array([s.course_prefs for s in student_list], dtype = np.int32)
+        student_prefs = np.empty((len(course_list), len(student_list)), dtype = np.int32)
+        for c in course_list:
+            student_prefs[c.course_id] = c.get_student_ids()
+        return cls(course_prefs.reshape(len(student_list), -1), student_prefs,
+                   np.array([s.year for s in student_list]),
+                   np.array([s.dept for s in student_list]),
+                   np.array([c.dept for c in course_list]),
+                   np.array([s.credit_limit for s in student_list]),
+                   np.array([c.enroll_limit for c in course_list]))
+
+# =============================================================================== #
+
+class SparseRanks():
+    # (n_rows, n_cols) rank matrix of preference lists that rank only a few columns each, for
+    # markets too large for the dense matrix: stored as the sorted keys row * n_cols + col of
+    # the ranked pairs and their ranks. ranks[rows, cols] looks up pairs like the dense matrix,
+    # with -1 for unranked pairs
+    def __init__(self, rows, cols, ranks, shape):
+        keys = np.asarray(rows, dtype = np.int64) * shape[1] + cols
+        order = np.argsort(keys, kind = 'stable')
+        self.keys = keys[order]
+        self.ranks = np.asarray(ranks, dtype = np.int32)[order]
+        self.shape = shape
+
+    def __repr__(self):
+        return f"SparseRanks(shape={self.shape}, nnz={len(self.keys)})"
+
+    @classmethod
+    def from_lists(cls, lists, n_cols):
+        # row i ranks the columns lists[i] in that order
+        lengths = np.array([len(l) for l in lists], dtype = np.int64)
+        rows = np.repeat(np.arange(len(lists)), lengths)
+        cols = np.concatenate([np.asarray(l, dtype = np.int64) for l in lists] + [np.zeros(0, dtype = np.int64)])
+        ranks = np.arange(len(rows)) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+        return cls(rows, cols, ranks, (len(lists), n_cols))
+
+    @classmethod
+    def from_sorted(cls, keys, ranks, shape):
+        # over already sorted keys (e.g. the arrays of another SparseRanks in shared memory)
+        table = cls.__new__(cls)
+        table.keys, table.ranks, table.shape = keys, ranks, shape
+        return table
+
+    def __getitem__(self, index):
+        rows, cols = index
+        keys = np.asarray(rows, dtype = np.int64) * self.shape[1] + cols
+        if len(self.keys) == 0:
+            return np.full(keys.shape, -1, dtype = np.int32)
+        found = np.minimum(np.searchsorted(self.keys, keys), len(self.keys) - 1)
+        return np.where(self.keys[found] == keys, self.ranks[found], -1).astype(np.int32)
+
+
+class BlockRanks():
+    # rank matrices of independent markets stacked along a first axis, (n_blocks, n_rows, n_cols),
+    # indexed with global ids (row b * n_rows + i, column b * n_cols + j) like the
+    # (n_blocks * n_rows, n_blocks * n_cols) block-diagonal matrix; -1 outside the blocks
+    def __init__(self, ranks):
+        self.ranks = ranks
+        n_blocks, self.n_rows, self.n_cols = ranks.shape
+        self.shape = (n_blocks * self.n_rows, n_blocks * self.n_cols)
+
+    def __repr__(self):
+        return f"BlockRanks(blocks={self.ranks.shape[0]}, shape={self.ranks.shape[1:]})"
+
+    def __getitem__(self, index):
+        rows, cols = index
+        blocks, local_rows = np.divmod(np.asarray(rows, dtype = np.int64), self.n_rows)
+        local_cols = np.asarray(cols, dtype = np.int64) - blocks * self.n_cols
+        inside = (local_cols >= 0) & (local_cols < self.n_cols)
+        ranks = self.ranks[blocks, local_rows, np.where(inside, local_cols, 0)]
+        return np.where(inside, ranks, -1)
+
+
+def rank_table(lists, n_cols):
+    # rank matrix of row-wise preference lists: the dense inverse permutation when every list is
+    # complete, SparseRanks otherwise
+    lengths = np.array([len(l) for l in lists], dtype = np.int64)
+    if len(lists) and (lengths == n_cols).all():
+        orders = np.array(lists, dtype = np.int32).reshape(len(lists), n_cols)
+        return inverse_permutation(orders)
+    return SparseRanks.from_lists(lists, n_cols)
+
+
+def inverse_permutation(orders):
+    # row-wise inverse: ranks[i, orders[i, j]] = j
+    ranks = np.empty_like(orders)
+    rows = np.arange(orders.shape[0])[:, None]
+    ranks[rows, orders] = np.arange(orders.shape[1], dtype = orders.dtype)
+    return ranks
+
+
+def enrollment_matrix(students, courses, n_students, n_courses):
+    # (n_students, n_courses) sparse 0/1 matrix with a one for every enrolled pair
+    data = np.ones(len(students), dtype = np.int32)
+    return sp.csr_matrix((data, (students, courses)), shape = (n_students, n_courses))
+
+
+def enrollment_from_objects(student_list, course_list):
+    students = np.repeat(np.arange(len(student_list)), [len(s.course_enroll) for s in student_list])
+    courses = np.array([c for s in student_list for c in s.course_enroll], dtype = np.int64)
+    return enrollment_matrix(students, courses, len(student_list), len(course_list))
+
+
+def student_welfare(enrollment, course_ranks):
+    # utility of every student (n_courses - rank, summed over enrolled courses) in one pass;
+    # course_ranks is the dense (n_students, n_courses) matrix or SparseRanks
+    enrollment = enrollment.tocoo()
+    n_courses = course_ranks.shape[1]
+    utilities = np.bincount(enrollment.row, weights = n_courses - course_ranks[enrollment.row, enrollment.col],
+                            minlength = enrollment.shape[0])
+    return utilities.astype(np.int64)
@@ -1,6 +1,10 @@
 from collections import defaultdict
 
+import numpy as np
+
+import instrument
 from agent import Student, Course
+from market import enrollment_matrix, enrollment_from_objects, rank_table
 
 
 def find_matching(student_list, course_list, verbose = False):
@@ -42,6 +46,10 @@ def find_matching(student_list, course_list, verbose = False):
                 n_rejects += 1
         if verbose:
             print(f"\tNumber of proposals being rejected: {n_rejects}")
+        if instrument.enabled():
+            instrument.count(round = da_round, proposals = n_proposals, rejections = n_rejects,
+                             full_courses = sum(len(c.student_enroll) >= c.enroll_limit for c in course_list),
+                             active_students = len(set(s for p in proposals.values() for s in p)))
     
     return student_list, course_list
 
@@ -88,5 +96,318 @@ def resolve_conflicts(student_list, course_list, verbose = False):
                 n_rejects += 1
         if verbose:
             print(f"\tNumber of proposals being rejected: {n_rejects}")
+        if instrument.enabled():
+            instrument.count(round = da_round, proposals = n_proposals, rejections = n_rejects,
+                             full_courses = sum(len(c.student_enroll) + len(c.second_student_enroll)
+                                                >= c.enroll_limit for c in course_list),
+                             active_students = len(set(s for p in proposals.values() for s in p)))
             
     return student_list, course_list
+
+# =============================================================================== # 
+
+def preference_arrays(student_list, course_list):
+    # course_prefs[s] is the proposal order of student s (course indices; a truncated list is
+    # padded with -1 after its preference_lengths[s] courses),
+    # priority_ranks[c, s] is the position of student s in the priority of course c (dense when
+    # every course ranks every student, otherwise SparseRanks with -1 for unranked students)
+    pref_lengths = preference_lengths(student_list)
+    if (pref_lengths == len(course_list)).all():
+        course_prefs = np.array([s.course_prefs for s in student_list], dtype = np.int32)
+        course_prefs = course_prefs.reshape(len(student_list), -1)
+    else:
+        course_prefs = np.full((len(student_list), int(pref_lengths.max(initial = 0))), -1, dtype = np.int32)
+        listed = np.arange(course_prefs.shape[1]) < pref_lengths[:, None]
+        course_prefs[listed] = np.concatenate([np.asarray(s.course_prefs, dtype = np.int32) for s in student_list]
+                                              + [np.zeros(0, dtype = np.int32)])
+    priority_ranks = rank_table([c.get_student_ids() for c in course_list], len(student_list))
+    enroll_limits = np.array([c.enroll_limit for c in course_list], dtype = np.int64)
+    credit_limits = np.array([s.credit_limit for s in student_list], dtype = np.int64)
+    return course_prefs, priority_ranks, enroll_limits, credit_limits
+
+
+def preference_lengths(student_list):
+    return np.array([len(s.course_prefs) for s in student_list], dtype = np.int64)
+
+
+def _select_by_priority(pair_students, pair_courses, priority_ranks, enroll_limits, with_rejected = False):
+    # rank the candidate pairs within each course and keep the enroll_limit most preferred
+    # (students the course does not rank are dropped); returns the kept pairs ordered by
+    # course and then by priority (and with_rejected, the students of the other pairs)
+    ranks = priority_ranks[pair_courses, pair_students].astype(np.int64)
+    ranked = ranks >= 0
+    unranked = pair_students[:0]
+    if not ranked.all():
+        unranked = pair_students[~ranked]
+        pair_students, pair_courses, ranks = pair_students[ranked], pair_courses[ranked], ranks[ranked]
+    order = np.argsort(pair_courses * (int(ranks.max(initial = 0)) + 1) + ranks)
+    sorted_courses = pair_courses[order]
+    group_starts = np.flatnonzero(np.r_[True, sorted_courses[1:] != sorted_courses[:-1]])
+    group_sizes = np.diff(np.r_[group_starts, len(sorted_courses)])
+    position = np.arange(len(sorted_courses)) - np.repeat(group_starts, group_sizes)
+    keep = position < enroll_limits[sorted_courses]
+    sorted_students = pair_students[order]
+    if with_rejected:
+        return (sorted_students[keep], sorted_courses[keep], position[keep],
+                np.concatenate([sorted_students[~keep], unranked]))
+    return sorted_students[keep], sorted_courses[keep], position[keep]
+
+
+def deferred_acceptance(course_prefs, priority_ranks, enroll_limits, credit_limits,
+                        pref_lengths = None, verbose = False):
+    # same rounds as find_matching, with every proposal of a round handled in one batch
+    # (student s only proposes to course_prefs[s, :pref_lengths[s]])
+    n_students, n_prefs = course_prefs.shape
+    if pref_lengths is None:
+        pref_lengths = np.full(n_students, n_prefs)
+    pointers = np.zeros(n_students, dtype = np.int64)
+    eligible = np.ones(n_students, dtype = bool)
+    n_enrolled = np.zeros(n_students, dtype = np.int64)
+    seats = empty_seats(enroll_limits)
+
+    run_proposal_rounds(course_prefs, priority_ranks, enroll_limits, credit_limits, pref_lengths,
+                        seats, pointers, eligible, n_enrolled, verbose = verbose)
+    held_students, held_courses = seated_pairs(seats)
+    return held_students, held_courses, pointers, eligible
+
+
+def empty_seats(enroll_limits):
+    # seats[c] holds the students tentatively accepted by course c in priority order (-1 for an empty seat)
+    return np.full((len(enroll_limits), max(int(enroll_limits.max(initial = 0)), 1)), -1, dtype = np.int64)
+
+
+def seated_pairs(seats):
+    held_courses, held_positions = np.nonzero(seats >= 0)
+    return seats[held_courses, held_positions], held_courses
+
+
+def run_proposal_rounds(course_prefs, priority_ranks, enroll_limits, credit_limits, pref_lengths,
+                        seats, pointers, eligible, n_enrolled, verbose = False):
+    # advance a deferred-acceptance state (seats, pointers, eligible, n_enrolled) in place
+    # until no student can propose; returns the number of proposals made
+    n_students = len(pointers)
+    total_proposals = 0
+    da_round = 0
+
+    while True:
+        da_round += 1
+        if verbose:
+            print(f"Round: {da_round}")
+
+        # students propose to the next (credit_limit - enrolled) courses on their list
+        active = np.flatnonzero(eligible & (n_enrolled < credit_limits))
+        starts = pointers[active]
+        ends = np.minimum(starts + credit_limits[active] - n_enrolled[active], pref_lengths[active])
+        pointers[active] = ends
+        eligible[active] = ends < pref_lengths[active]
+
+        counts = ends - starts
+        n_proposals = int(counts.sum())
+        if n_proposals == 0: # check if no proposals can be made, terminate
+            if verbose:
+                print("\tDA terminates and all proposals have been finalized.")
+            break
+
+        total_proposals += n_proposals
+        if verbose:
+            print(f"\tNumber of proposals made: {n_proposals}")
+
+        offsets = np.arange(n_proposals) - np.repeat(np.cumsum(counts) - counts, counts)
+        proposal_students = np.repeat(active, counts)
+        proposal_courses = course_prefs[proposal_students, np.repeat(starts, counts) + offsets].astype(np.int64)
+
+        # courses receiving proposals tentatively accept the most preferred among
+        # their held and proposing students; other courses are left untouched
+        touched = np.unique(proposal_courses)
+        held = seats[touched]
+        held_mask = held >= 0
+        held_students = held[held_mask]
+        held_courses = np.broadcast_to(touched[:, None], held.shape)[held_mask]
+
+        kept_students, kept_courses, kept_positions = _select_by_priority(
+            np.concatenate([held_students, proposal_students]),
+            np.concatenate([held_courses, proposal_courses]),
+            priority_ranks, enroll_limits)
+        seats[touched] = -1
+        seats[kept_courses, kept_positions] = kept_students
+
+        n_enrolled -= np.bincount(held_students, minlength = n_students)
+        n_enrolled += np.bincount(kept_students, minlength = n_students)
+        n_rejects = len(held_students) + n_proposals - len(kept_students)
+        if verbose:
+            print(f"\tNumber of proposals being rejected: {n_rejects}")
+        if instrument.enabled():
+            instrument.count(round = da_round, proposals = n_proposals, rejections = n_rejects,
+                             full_courses = int(np.count_nonzero((seats >= 0).sum(axis = 1) >= enroll_limits)),
+                             active_students = int(np.count_nonzero(counts)))
+
+    return total_proposals
+
+
+def write_enrollment(student_list, course_list, held_students, held_courses, priority_ranks):
+    # store an array matching back into the Student / Course objects
+    order = np.lexsort((held_courses, held_students))
+    student_ptr = np.searchsorted(held_students[order], np.arange(len(student_list) + 1))
+    enrolled_courses = held_courses[order].tolist()
+    for s, start, end in zip(student_list, student_ptr[:-1].tolist(), student_ptr[1:].tolist()):
+        s.course_enroll = enrolled_courses[start: end]
+
+    ranks = priority_ranks[held_courses, held_students]
+    order = np.lexsort((ranks, held_courses))
+    course_ptr = np.searchsorted(held_courses[order], np.arange(len(course_list) + 1))
+    enrolled_students = held_students[order].tolist()
+    for c, start, end in zip(course_list, course_ptr[:-1].tolist(), course_ptr[1:].tolist()):
+        c.student_enroll = [student_list[i] for i in enrolled_students[start: end]]
+
+
+def sharded_acceptance(student_list, course_list, course_prefs, priority_ranks, enroll_limits, credit_limits,
+                       pref_lengths = None, n_workers = None, verbose = False):
+    # deferred_acceptance, or with n_workers its department-sharded parallel version (same result)
+    if n_workers is None:
+        return deferred_acceptance(course_prefs, priority_ranks, enroll_limits, credit_limits,
+                                   pref_lengths = pref_lengths, verbose = verbose)
+    from parallel import deferred_acceptance_parallel, department_shards
+    student_shards, course_shards = department_shards([s.dept for s in student_list],
+                                                      [c.dept for c in course_list], n_workers)
+    return deferred_acceptance_parallel(course_prefs, priority_ranks, enroll_limits, credit_limits,
+                                        student_shards, course_shards, pref_lengths = pref_lengths,
+                                        verbose = verbose)
+
+
+def find_matching_fast(student_list, course_list, verbose = False, n_workers = None):
+    # array-backed equivalent of find_matching, producing the same enrollments
+    # (n_workers: run the rounds in that many department shards, see parallel.py)
+    course_prefs, priority_ranks, enroll_limits, credit_limits = preference_arrays(student_list, course_list)
+    held_students, held_courses, pointers, eligible = sharded_acceptance(
+        student_list, course_list, course_prefs, priority_ranks, enroll_limits, credit_limits,
+        pref_lengths = preference_lengths(student_list), n_workers = n_workers, verbose = verbose)
+
+    write_enrollment(student_list, course_list, held_students, held_courses, priority_ranks)
+    for s, pointer, is_eligible in zip(student_list, pointers.tolist(), eligible.tolist()):
+        s.current_course_propose = pointer
+        s.eligible = is_eligible
+    return student_list, course_list
+
+# =============================================================================== # 
+
+def slot_indices(course_list):
+    # integer time slot of every course (unscheduled courses share their own slot)
+    slots = {}
+    return np.array([slots.setdefault(c.time, len(slots)) for c in course_list], dtype = np.int64)
+
+
+def determine_conflicts_batch(enrollment, course_ranks, slots):
+    # for every student and time slot keep only the most preferred enrolled course
+    # (the same choice as Student.determine_conflicts), for all students at once
+    enrollment = enrollment.tocoo()
+    students, courses = enrollment.row.astype(np.int64), enrollment.col.astype(np.int64)
+    groups = students * (int(slots.max(initial = 0)) + 1) + slots[courses]
+    order = np.lexsort((course_ranks[students, courses], groups))
+    first = np.r_[True, groups[order][1:] != groups[order][:-1]]
+    keep = order[first]
+    return enrollment_matrix(students[keep], courses[keep], *enrollment.shape)
+
+
+def determine_conflicts_fast(student_list, course_list):
+    # array-backed equivalent of calling Student.determine_conflicts for every student
+    slots = slot_indices(course_list)
+    course_ranks = rank_table([s.course_prefs for s in student_list], len(course_list))
+    enrollment = enrollment_from_objects(student_list, course_list)
+    kept = determine_conflicts_batch(enrollment, course_ranks, slots)
+
+    slot_values = [c.time for c in course_list]
+    for s, kept_courses in zip(student_list, kept.tolil().rows):
+        s.unavailable_times = dict.fromkeys(slot_values[c] for c in s.course_enroll).keys()
+        kept_courses = set(kept_courses)
+        for c in s.course_enroll:
+            if c not in kept_courses:
+                course_list[c].drop_student(s)
+        s.course_enroll = [c for c in s.course_enroll if c in kept_courses]
+        s.eligible = True
+        s.current_course_propose = 0
+    return student_list, course_list
+
+
+def unavailable_slot_matrix(student_list, course_list):
+    # (n_students, n_slots) True where the slot (as numbered by slot_indices) is in the
+    # student's unavailable times
+    slots = slot_indices(course_list)
+    slot_of = dict(zip((c.time for c in course_list), slots.tolist()))
+    unavailable_slots = np.zeros((len(student_list), int(slots.max(initial = 0)) + 1), dtype = bool)
+    for s in student_list:
+        unavailable_slots[s.student_id, [slot_of[t] for t in s.unavailable_times if t in slot_of]] = True
+    return unavailable_slots
+
+
+def resolving_preferences(listed_prefs, slots, unavailable_slots):
+    # proposal order of the resolving round: the listed courses outside the student's unavailable
+    # slots, in course index order; returns (course_prefs, pref_lengths), the rest of each row
+    # being padding
+    n_students, n_courses = len(unavailable_slots), len(slots)
+    if listed_prefs.shape[1] == n_courses and (listed_prefs >= 0).all():
+        unavailable = unavailable_slots[:, slots]
+        course_prefs = np.argsort(unavailable, axis = 1, kind = 'stable').astype(np.int32)
+    else:
+        # truncated lists: the listed courses in course index order, padding (n_courses) last
+        candidates = np.sort(np.where(listed_prefs >= 0, listed_prefs, n_courses), axis = 1)
+        unlisted = candidates == n_courses
+        candidates[unlisted] = 0
+        unavailable = unavailable_slots[np.arange(n_students)[:, None], slots[candidates]] | unlisted
+        order = np.argsort(unavailable, axis = 1, kind = 'stable')
+        course_prefs = np.take_along_axis(candidates, order, axis = 1).astype(np.int32)
+    return course_prefs, course_prefs.shape[1] - unavailable.sum(axis = 1)
+
+
+def resolve_conflicts_fast(student_list, course_list, verbose = False, n_workers = None):
+    # array-backed equivalent of resolve_conflicts: after determine_conflicts every student
+    # proposes, in course index order, to the courses it ranks outside its unavailable times
+    listed_prefs, priority_ranks, enroll_limits, credit_limits = preference_arrays(student_list, course_list)
+    course_prefs, pref_lengths = resolving_preferences(listed_prefs, slot_indices(course_list),
+                                                       unavailable_slot_matrix(student_list, course_list))
+
+    enroll_limits = enroll_limits - np.array([len(c.student_enroll) for c in course_list])
+    credit_limits = credit_limits - np.array([len(s.course_enroll) for s in student_list])
+    held_students, held_courses, _, _ = sharded_acceptance(
+        student_list, course_list, course_prefs, priority_ranks, enroll_limits, credit_limits,
+        pref_lengths = pref_lengths, n_workers = n_workers, verbose = verbose)
+
+    ranks = priority_ranks[held_courses, held_students]
+    order = np.lexsort((ranks, held_courses))
+    held_students, held_courses = held_students[order].tolist(), held_courses[order].tolist()
+    for c in course_list:
+        c.second_student_enroll = []
+    for s, c in zip(held_students, held_courses):
+        student_list[s].add_course(c)
+        course_list[c].second_student_enroll.append(student_list[s])
+    for c in course_list:
+        c.finalize_enrollment()
+    return student_list, course_list
+
+
+def resolve_pairs(enrollment, slots, course_prefs, course_ranks, priority_ranks, enroll_limits, credit_limits):
+    # determine_conflicts_fast and resolve_conflicts_fast on arrays, for a matching (enrollment
+    # matrix) and a candidate slot assignment (integer slots as slot_indices numbers them);
+    # course_prefs padded with -1 as in preference_arrays. Returns the final (student, course) pairs
+    kept = determine_conflicts_batch(enrollment, course_ranks, slots).tocoo()
+    pairs = enrollment.tocoo()
+    unavailable_slots = np.zeros((enrollment.shape[0], int(slots.max(initial = 0)) + 1), dtype = bool)
+    unavailable_slots[pairs.row, slots[pairs.col]] = True
+    resolve_prefs, pref_lengths = resolving_preferences(course_prefs, slots, unavailable_slots)
+    held_students, held_courses, _, _ = deferred_acceptance(
+        resolve_prefs, priority_ranks,
+        np.asarray(enroll_limits) - np.bincount(kept.col, minlength = enrollment.shape[1]),
+        np.asarray(credit_limits) - np.bincount(kept.row, minlength = enrollment.shape[0]),
+        pref_lengths = pref_lengths)
+    return np.r_[kept.row, held_students], np.r_[kept.col, held_courses]
+
+
+def resolve_unmatched(priority_ranks, enroll_limits, credit_limits, verbose = False):
+    # resolve_conflicts_fast on students with no enrollment and no unavailable times (the
+    # random-time baseline), straight from the market arrays: every student proposes to every
+    # course in course index order. Returns the (student, course) pairs held at the end
+    n_courses, n_students = priority_ranks.shape
+    course_prefs = np.broadcast_to(np.arange(n_courses, dtype = np.int32), (n_students, n_courses))
+    held_students, held_courses, _, _ = deferred_acceptance(
+        course_prefs, priority_ranks, np.asarray(enroll_limits, dtype = np.int64),
+        np.asarray(credit_limits, dtype = np.int64), verbose = verbose)
+    return held_students, held_courses
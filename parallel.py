@@ -0,0 +1,242 @@
+import multiprocessing as mp
+from multiprocessing.shared_memory import SharedMemory
+
+import numpy as np
+
+import instrument
+from market import SparseRanks
+from matching import empty_seats, seated_pairs, _select_by_priority
+
+
+# Deferred acceptance with the market split into shards (groups of departments) handled by
+# worker processes over shared memory. Every round has the same three steps as
+# run_proposal_rounds, separated by barriers:
+#   1. each worker makes the proposals of its students and writes them out grouped by the
+#      shard owning the course,
+#   2. each worker selects, for its courses, the most preferred among held and proposing
+#      students and writes out the rejected students grouped by the shard owning the student,
+#   3. each worker takes the rejections of its students off their enrollment count.
+# A student's proposals only depend on its own pointer and enrollment count, and a course's
+# selection only on its held students and the proposals of the round (priorities are strict),
+# so the rounds, and the final seats, pointers and eligibility, are those of the serial
+# deferred_acceptance whatever the sharding.
+
+
+def department_shards(student_depts, course_depts, n_shards):
+    # departments grouped into at most n_shards shards of similar work (share of students plus
+    # share of courses), largest departments first; returns the shard of every student and course
+    student_depts, course_depts = np.asarray(student_depts), np.asarray(course_depts)
+    all_depts = np.union1d(student_depts, course_depts)
+    student_index = np.searchsorted(all_depts, student_depts)
+    course_index = np.searchsorted(all_depts, course_depts)
+    weights = (np.bincount(student_index, minlength = len(all_depts)) / max(len(student_depts), 1) +
+               np.bincount(course_index, minlength = len(all_depts)) / max(len(course_depts), 1))
+
+    n_shards = max(1, min(n_shards, len(all_depts)))
+    shard_of = np.zeros(len(all_depts), dtype = np.int32)
+    loads = np.zeros(n_shards)
+    for d in np.argsort(-weights, kind = 'stable').tolist():
+        shard_of[d] = int(np.argmin(loads))
+        loads[shard_of[d]] += weights[d]
+    return shard_of[student_index], shard_of[course_index]
+
+
+class SharedArrays():
+    # numpy arrays in named shared memory blocks; spec() is what a worker needs to attach them
+    def __init__(self):
+        self.blocks = []
+        self.arrays = {}
+
+    def add(self, name, values):
+        values = np.ascontiguousarray(values)
+        block = SharedMemory(create = True, size = max(values.nbytes, 1))
+        self.blocks.append(block)
+        self.arrays[name] = np.ndarray(values.shape, dtype = values.dtype, buffer = block.buf)
+        self.arrays[name][...] = values
+        return self.arrays[name]
+
+    def spec(self):
+        return {name: (block.name, array.shape, array.dtype.str)
+                for block, (name, array) in zip(self.blocks, self.arrays.items())}
+
+    def close(self):
+        self.arrays = {}
+        for block in self.blocks:
+            block.close()
+            block.unlink()
+        self.blocks = []
+
+
+def attach(spec):
+    blocks, arrays = [], {}
+    for name, (block_name, shape, dtype) in spec.items():
+        block = SharedMemory(name = block_name)
+        blocks.append(block)
+        arrays[name] = np.ndarray(shape, dtype = np.dtype(dtype), buffer = block.buf)
+    return blocks, arrays
+
+# =============================================================================== #
+
+def deferred_acceptance_parallel(course_prefs, priority_ranks, enroll_limits, credit_limits,
+                                 student_shards, course_shards, pref_lengths = None, verbose = False):
+    # deferred_acceptance with one worker process per shard (student_shards[s] / course_shards[c]
+    # is the shard handling student s / course c); same return values
+    n_students, n_prefs = course_prefs.shape
+    n_shards = int(max(student_shards.max(initial = 0), course_shards.max(initial = 0))) + 1
+    if pref_lengths is None:
+        pref_lengths = np.full(n_students, n_prefs)
+    credit_limits = np.asarray(credit_limits, dtype = np.int64)
+    n_credits = int(credit_limits.clip(min = 0).sum())
+
+    shared = SharedArrays()
+    try:
+        shared.add('course_prefs', course_prefs)
+        if isinstance(priority_ranks, SparseRanks):
+            shared.add('priority_keys', priority_ranks.keys)
+            shared.add('priority_values', priority_ranks.ranks)
+        else:
+            shared.add('priority_ranks', priority_ranks)
+        shared.add('enroll_limits', np.asarray(enroll_limits, dtype = np.int64))
+        shared.add('credit_limits', credit_limits)
+        shared.add('pref_lengths', np.asarray(pref_lengths, dtype = np.int64))
+        # int16 shard ids: stable argsorts of them are radix sorts
+        shared.add('student_shards', np.asarray(student_shards, dtype = np.int16))
+        shared.add('course_shards', np.asarray(course_shards, dtype = np.int16))
+        # matching state
+        shared.add('seats', empty_seats(np.asarray(enroll_limits)))
+        shared.add('pointers', np.zeros(n_students, dtype = np.int64))
+        shared.add('eligible', np.ones(n_students, dtype = bool))
+        shared.add('n_enrolled', np.zeros(n_students, dtype = np.int64))
+        # exchange buffers: a round has at most n_credits proposals and as many rejections;
+        # shard w writes its proposals from proposal_starts[w] and its rejections after those of
+        # the shards before it, and offsets[w, d] .. offsets[w, d + 1] is the part for shard d
+        own_credits = np.bincount(student_shards, weights = credit_limits.clip(min = 0), minlength = n_shards)
+        shared.add('proposal_starts', np.r_[0, np.cumsum(own_credits)].astype(np.int64))
+        shared.add('proposal_students', np.zeros(n_credits, dtype = np.int64))
+        shared.add('proposal_courses', np.zeros(n_credits, dtype = np.int64))
+        shared.add('proposal_offsets', np.zeros((n_shards, n_shards + 1), dtype = np.int64))
+        shared.add('rejections', np.zeros(n_credits, dtype = np.int64))
+        shared.add('rejection_offsets', np.zeros((n_shards, n_shards + 1), dtype = np.int64))
+        shared.add('totals', np.zeros((n_shards, 3), dtype = np.int64)) # rounds, proposals, rejections
+
+        context = mp.get_context('fork' if 'fork' in mp.get_all_start_methods() else 'spawn')
+        barrier = context.Barrier(n_shards)
+        spec = shared.spec()
+        workers = [context.Process(target = _shard_worker,
+                                   args = (shard, n_shards, spec, priority_ranks.shape, barrier, verbose))
+                   for shard in range(n_shards)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        if any(worker.exitcode != 0 for worker in workers):
+            raise RuntimeError(f"deferred acceptance worker failed: exit codes {[w.exitcode for w in workers]}")
+
+        # copies only: the shared blocks are released below
+        totals = shared.arrays['totals'].copy()
+        held_students, held_courses = seated_pairs(shared.arrays['seats'])
+        pointers, eligible = shared.arrays['pointers'].copy(), shared.arrays['eligible'].copy()
+    finally:
+        shared.close()
+
+    if instrument.enabled():
+        instrument.count(round = int(totals[:, 0].max(initial = 0)), proposals = int(totals[:, 1].sum()),
+                         rejections = int(totals[:, 2].sum()), shards = n_shards)
+    return held_students, held_courses, pointers, eligible
+
+
+def _shard_worker(shard, n_shards, spec, priority_shape, barrier, verbose):
+    blocks, arrays = attach(spec)
+    try:
+        _run_shard(shard, n_shards, arrays, priority_shape, barrier, verbose)
+    except BaseException:
+        barrier.abort() # release the other workers instead of leaving them waiting
+        raise
+    finally:
+        arrays.clear()
+        for block in blocks:
+            block.close()
+
+
+def _run_shard(shard, n_shards, arrays, priority_shape, barrier, verbose):
+    if 'priority_ranks' in arrays:
+        priority_ranks = arrays['priority_ranks']
+    else:
+        priority_ranks = SparseRanks.from_sorted(arrays['priority_keys'], arrays['priority_values'], priority_shape)
+    course_prefs, seats = arrays['course_prefs'], arrays['seats']
+    enroll_limits, credit_limits = arrays['enroll_limits'], arrays['credit_limits']
+    pref_lengths, pointers = arrays['pref_lengths'], arrays['pointers']
+    eligible, n_enrolled = arrays['eligible'], arrays['n_enrolled']
+    course_shards, student_shards = arrays['course_shards'], arrays['student_shards']
+    proposal_students, proposal_courses = arrays['proposal_students'], arrays['proposal_courses']
+    proposal_offsets, rejection_offsets = arrays['proposal_offsets'], arrays['rejection_offsets']
+    rejections, totals = arrays['rejections'], arrays['totals']
+
+    my_students = np.flatnonzero(student_shards == shard)
+    start = int(arrays['proposal_starts'][shard])
+    da_round = 0
+    while True:
+        da_round += 1
+        # 1. proposals of this shard's students, grouped by the shard of the course
+        active = my_students[eligible[my_students] & (n_enrolled[my_students] < credit_limits[my_students])]
+        starts = pointers[active]
+        ends = np.minimum(starts + credit_limits[active] - n_enrolled[active], pref_lengths[active])
+        pointers[active] = ends
+        eligible[active] = ends < pref_lengths[active]
+        counts = ends - starts
+        n_proposals = int(counts.sum())
+        offsets = np.arange(n_proposals) - np.repeat(np.cumsum(counts) - counts, counts)
+        students = np.repeat(active, counts)
+        courses = course_prefs[students, np.repeat(starts, counts) + offsets].astype(np.int64)
+        # proposals are counted as enrollments until they are rejected
+        n_enrolled[active] += counts
+
+        destinations = course_shards[courses]
+        order = np.argsort(destinations, kind = 'stable')
+        proposal_students[start: start + n_proposals] = students[order]
+        proposal_courses[start: start + n_proposals] = courses[order]
+        proposal_offsets[shard] = np.searchsorted(destinations[order], np.arange(n_shards + 1))
+        barrier.wait()
+
+        received = np.diff(proposal_offsets, axis = 1)
+        total_proposals = int(received.sum())
+        if total_proposals == 0:
+            break
+        if verbose and shard == 0:
+            print(f"Round: {da_round}\n\tNumber of proposals made: {total_proposals}")
+
+        # 2. selection in this shard's courses among held and proposing students
+        segments = [slice(int(arrays['proposal_starts'][w] + proposal_offsets[w, shard]),
+                          int(arrays['proposal_starts'][w] + proposal_offsets[w, shard + 1]))
+                    for w in range(n_shards)]
+        new_students = np.concatenate([proposal_students[s] for s in segments])
+        new_courses = np.concatenate([proposal_courses[s] for s in segments])
+        touched = np.unique(new_courses)
+        held = seats[touched]
+        held_mask = held >= 0
+        held_students = held[held_mask]
+        held_courses = np.broadcast_to(touched[:, None], held.shape)[held_mask]
+        kept_students, kept_courses, kept_positions, rejected = _select_by_priority(
+            np.concatenate([held_students, new_students]), np.concatenate([held_courses, new_courses]),
+            priority_ranks, enroll_limits, with_rejected = True)
+        seats[touched] = -1
+        seats[kept_courses, kept_positions] = kept_students
+
+        # rejected students (held or proposing), grouped by the student's shard
+        rejected_shards = student_shards[rejected]
+        order = np.argsort(rejected_shards, kind = 'stable')
+        rejection_start = int(received[:, :shard].sum())
+        rejections[rejection_start: rejection_start + len(rejected)] = rejected[order]
+        rejection_offsets[shard] = np.searchsorted(rejected_shards[order], np.arange(n_shards + 1))
+        totals[shard] = [da_round, totals[shard, 1] + n_proposals, totals[shard, 2] + len(rejected)]
+        barrier.wait()
+
+        # 3. rejections of this shard's students
+        for d in range(n_shards):
+            d_start = int(received[:, :d].sum())
+            mine = rejections[d_start + rejection_offsets[d, shard]: d_start + rejection_offsets[d, shard + 1]]
+            np.subtract.at(n_enrolled, mine, 1)
+        if verbose and shard == 0:
+            print(f"\tNumber of proposals being rejected: {int(rejection_offsets[:, -1].sum())}")
+    if verbose and shard == 0:
+        print("\tDA terminates and all proposals have been finalized.")
@@ -0,0 +1,73 @@
+import argparse
+import multiprocessing as mp
+import os
+
+import numpy as np
+
+
+# Figures are drawn from metrics files (.npz with utilities_{stage}, course_sizes_{stage} and,
+# for replicates, welfare_gain), so a run only saves its metrics and the rendering happens in a
+# background process or later with `python plots.py results/metrics/*.npz`. matplotlib and
+# seaborn are only imported when a figure is drawn.
+
+
+def plot_histogram(values, xlabel, filename):
+    import matplotlib.pyplot as plt
+    import seaborn as sns
+    plt.clf()
+    sns.histplot(values, stat = 'percent', color = 'seagreen')
+    plt.xlabel(xlabel)
+    plt.savefig(filename)
+
+
+def plot_results(utilities, course_sizes, suffix, fig_dir = "results/fig"):
+    # utils_{stage}_{suffix} and csizes_{stage}_{suffix} histograms for every stage
+    os.makedirs(fig_dir, exist_ok = True)
+    for stage in utilities:
+        plot_histogram(utilities[stage], "Student utiltities", f"{fig_dir}/utils_{stage}_{suffix}")
+        plot_histogram(course_sizes[stage], "Course sizes", f"{fig_dir}/csizes_{stage}_{suffix}")
+
+
+def save_metrics(path, utilities, course_sizes, **extra):
+    os.makedirs(os.path.dirname(path) or '.', exist_ok = True)
+    arrays = {f'utilities_{stage}': np.asarray(values) for stage, values in utilities.items()}
+    arrays.update({f'course_sizes_{stage}': np.asarray(values) for stage, values in course_sizes.items()})
+    arrays.update(extra)
+    np.savez(path, **arrays)
+    return path
+
+
+def load_metrics(path):
+    # (utilities, course sizes, other arrays) as saved by save_metrics
+    with np.load(path) as f:
+        arrays = dict(f)
+    utilities = {name[len('utilities_'):]: arrays.pop(name) for name in list(arrays) if name.startswith('utilities_')}
+    course_sizes = {name[len('course_sizes_'):]: arrays.pop(name)
+                    for name in list(arrays) if name.startswith('course_sizes_')}
+    return utilities, course_sizes, arrays
+
+
+def render_metrics(path, fig_dir = "results/fig"):
+    # the figures of a metrics file, named after it
+    suffix = os.path.splitext(os.path.basename(path))[0]
+    utilities, course_sizes, extra = load_metrics(path)
+    plot_results(utilities, course_sizes, suffix, fig_dir)
+    if 'welfare_gain' in extra:
+        plot_histogram(extra['welfare_gain'], "Welfare gain", f"{fig_dir}/gain_{suffix}")
+
+
+def render_in_background(path, fig_dir = "results/fig"):
+    # rendered by a child process while the caller goes on; the interpreter joins it at exit
+    context = mp.get_context('fork' if 'fork' in mp.get_all_start_methods() else 'spawn')
+    process = context.Process(target = render_metrics, args = (path, fig_dir))
+    process.start()
+    return process
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = 'Render the figures of saved experiment metrics')
+    parser.add_argument('metrics', nargs = '+', help = 'Metrics files (.npz) written by experiment.py')
+    parser.add_argument('--fig_dir', default = 'results/fig')
+    args = parser.parse_args()
+    for path in args.metrics:
+        render_metrics(path, args.fig_dir)
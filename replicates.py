@@ -0,0 +1,200 @@
+import numpy as np
+
+import instrument
+from market import Market, BlockRanks, inverse_permutation, enrollment_matrix
+from matching import deferred_acceptance, determine_conflicts_batch
+from schedule import SCHEDULERS, conflict_matrix, conflict_nodes, count_conflicts
+from simulate import set_seed
+
+
+# Monte Carlo replicates of run_experiment solved together: the R markets are stacked along a
+# first array axis, and matching and conflict resolution run once on the block-diagonal market
+# (replicate r's students only rank replicate r's courses, so the blocks never interact and
+# every replicate gets the result it would get alone). Global ids: student r * n_students + s,
+# course r * n_courses + c.
+STAGES = ['match', 'resolve', 'baseline']
+
+
+class MarketBatch():
+    # every array of Market with a leading replicate axis
+    def __init__(self, course_prefs, student_prefs, years, depts, course_depts,
+                 credit_limits, enroll_limits):
+        self.course_prefs = course_prefs # (n_replicates, n_students, n_courses)
+        self.student_prefs = student_prefs # (n_replicates, n_courses, n_students)
+        self.years = years
+        self.depts = depts
+        self.course_depts = course_depts
+        self.credit_limits = credit_limits
+        self.enroll_limits = enroll_limits
+
+    def __repr__(self):
+        return f"MarketBatch(r={self.n_replicates}, s={self.n_students}, c={self.n_courses})"
+
+    @property
+    def n_replicates(self):
+        return self.years.shape[0]
+
+    @property
+    def n_students(self):
+        return self.years.shape[1]
+
+    @property
+    def n_courses(self):
+        return self.course_depts.shape[1]
+
+    @property
+    def course_ranks(self):
+        # as BlockRanks over global (student, course) ids
+        n_courses = self.n_courses
+        return BlockRanks(inverse_permutation(self.course_prefs.reshape(-1, n_courses)).reshape(
+            self.course_prefs.shape))
+
+    @property
+    def priority_ranks(self):
+        # as BlockRanks over global (course, student) ids
+        n_students = self.n_students
+        return BlockRanks(inverse_permutation(self.student_prefs.reshape(-1, n_students)).reshape(
+            self.student_prefs.shape))
+
+    def market(self, r):
+        return Market(self.course_prefs[r], self.student_prefs[r], self.years[r], self.depts[r],
+                      self.course_depts[r], self.credit_limits[r], self.enroll_limits[r])
+
+
+def generate_markets(n_replicates, n_students = 5000, n_courses = 100, n_depts = 15, credit_limit = 4,
+                     enroll_limit = 80, seed = None, block_size = 256):
+    # n_replicates independent draws of generate_market, as stacked arrays
+    if seed is not None:
+        set_seed(seed)
+
+    n_years = 4
+    years = np.random.randint(n_years, size = (n_replicates, n_students))
+    depts = np.random.randint(n_depts, size = (n_replicates, n_students))
+    course_depts = np.random.randint(n_depts, size = (n_replicates, n_courses))
+    course_prefs = np.argsort(np.random.random((n_replicates, n_students, n_courses)), axis = 2).astype(np.int32)
+
+    # own department first, then decreasing class year, ties broken randomly; about block_size
+    # (replicate, course) rows at a time
+    student_prefs = np.empty((n_replicates, n_courses, n_students), dtype = np.int32)
+    year_key = n_years - 1 - years
+    step = max(1, block_size // n_replicates)
+    for start in range(0, n_courses, step):
+        block = course_depts[:, start: start + step]
+        keys = (depts[:, None, :] != block[:, :, None]) * n_years + year_key[:, None, :]
+        keys = keys + np.random.random(keys.shape)
+        student_prefs[:, start: start + step] = np.argsort(keys, axis = 2)
+
+    return MarketBatch(course_prefs, student_prefs, years, depts, course_depts,
+                       np.full((n_replicates, n_students), credit_limit),
+                       np.full((n_replicates, n_courses), enroll_limit))
+
+# =============================================================================== #
+
+def run_replicates(n_replicates, n_students = 5000, n_courses = 100, n_depts = 15, credit_limit = 4,
+                   enroll_limit = 80, n_slots = 12, seed = None, scheduler = 'gomory_hu', verbose = True):
+    # run_experiment for n_replicates independent markets at once; same results layout with a
+    # replicate axis: utilities (R, n_students) and course sizes (R, n_courses) per stage,
+    # conflicts (R,)
+    with instrument.phase('generate_data', replicates = n_replicates):
+        batch = generate_markets(n_replicates, n_students, n_courses, n_depts, credit_limit, enroll_limit,
+                                 seed = seed)
+    n_total_students, n_total_courses = n_replicates * n_students, n_replicates * n_courses
+    offsets = (np.arange(n_replicates, dtype = np.int32) * n_courses)[:, None, None]
+    priority_ranks = batch.priority_ranks
+    course_ranks = batch.course_ranks
+    enroll_limits = batch.enroll_limits.reshape(-1).astype(np.int64)
+    credit_limits = batch.credit_limits.reshape(-1).astype(np.int64)
+
+    def pairs_matrix(students, courses):
+        return enrollment_matrix(students, courses, n_total_students, n_total_courses)
+
+    def welfare(enrollment):
+        enrollment = enrollment.tocoo()
+        utilities = np.bincount(enrollment.row, minlength = n_total_students,
+                                weights = n_courses - course_ranks[enrollment.row, enrollment.col])
+        return utilities.astype(np.int64).reshape(n_replicates, n_students)
+
+    def sizes(enrollment):
+        return np.asarray(enrollment.sum(axis = 0)).ravel().reshape(n_replicates, n_courses)
+
+    with instrument.phase('find_matching', replicates = n_replicates):
+        held_students, held_courses, _, _ = deferred_acceptance(
+            (batch.course_prefs + offsets).reshape(n_total_students, n_courses), priority_ranks,
+            enroll_limits, credit_limits)
+    matched = pairs_matrix(held_students, held_courses).tocsr()
+    utilities, course_sizes = {'match': welfare(matched)}, {'match': sizes(matched)}
+
+    # one conflict graph and slot partition per replicate
+    with instrument.phase('schedule', method = scheduler, replicates = n_replicates):
+        slots = np.empty((n_replicates, n_courses), dtype = np.int64)
+        n_conflicts = np.empty(n_replicates, dtype = np.int64)
+        conflicts = []
+        for r in range(n_replicates):
+            enrollment = matched[r * n_students: (r + 1) * n_students, r * n_courses: (r + 1) * n_courses]
+            conflicts.append(conflict_matrix(enrollment))
+            nodes = conflict_nodes(enrollment) if scheduler == 'gomory_hu' else None
+            slots[r] = SCHEDULERS[scheduler](conflicts[r], n_slots, nodes, seed)
+            n_conflicts[r] = count_conflicts(conflicts[r], slots[r])
+    if verbose:
+        print(f"{scheduler}: {n_conflicts.mean():.1f} conflicts over {n_slots} slots on average")
+    # courses left out of the partition have no time: they share one more slot
+    slots[slots < 0] = n_slots
+
+    with instrument.phase('determine_conflicts', replicates = n_replicates):
+        course_slots = slots.reshape(-1)
+        kept = determine_conflicts_batch(matched, course_ranks, course_slots).tocoo()
+        # the slots of every matched course become unavailable to the student
+        pairs = matched.tocoo()
+        unavailable_slots = np.zeros((n_total_students, n_slots + 1), dtype = bool)
+        unavailable_slots[pairs.row, course_slots[pairs.col]] = True
+
+    with instrument.phase('resolve_conflicts', replicates = n_replicates):
+        unavailable = np.take_along_axis(unavailable_slots.reshape(n_replicates, n_students, -1),
+                                         np.broadcast_to(slots[:, None, :], (n_replicates, n_students, n_courses)),
+                                         axis = 2)
+        course_prefs = np.argsort(unavailable, axis = 2, kind = 'stable').astype(np.int32) + offsets
+        new_students, new_courses, _, _ = deferred_acceptance(
+            course_prefs.reshape(n_total_students, n_courses), priority_ranks,
+            enroll_limits - np.bincount(kept.col, minlength = n_total_courses),
+            credit_limits - np.bincount(kept.row, minlength = n_total_students),
+            pref_lengths = n_courses - unavailable.sum(axis = 2).reshape(-1))
+    resolved = pairs_matrix(np.r_[kept.row, new_students], np.r_[kept.col, new_courses])
+    utilities['resolve'], course_sizes['resolve'] = welfare(resolved), sizes(resolved)
+
+    # baseline: random times, every student proposing to every course in course index order
+    with instrument.phase('baseline', replicates = n_replicates):
+        baseline_slots = np.random.randint(n_slots, size = (n_replicates, n_courses))
+        with instrument.phase('resolve_conflicts'):
+            course_prefs = np.broadcast_to(np.arange(n_courses, dtype = np.int32) + offsets,
+                                           (n_replicates, n_students, n_courses))
+            held_students, held_courses, _, _ = deferred_acceptance(
+                course_prefs.reshape(n_total_students, n_courses), priority_ranks, enroll_limits, credit_limits)
+    baseline = pairs_matrix(held_students, held_courses)
+    utilities['baseline'], course_sizes['baseline'] = welfare(baseline), sizes(baseline)
+
+    return {'utilities': utilities,
+            'course_sizes': course_sizes,
+            'n_conflicts': n_conflicts,
+            'n_conflicts_baseline': np.array([count_conflicts(conflicts[r], baseline_slots[r])
+                                              for r in range(n_replicates)])}
+
+
+def summarize(results, confidence = 0.95):
+    # average welfare of every stage, welfare gain and conflicts of every replicate, with their
+    # mean, standard deviation and Student t confidence interval over the replicates
+    from scipy import stats
+    metrics = {f'welfare_{stage}': results['utilities'][stage].mean(axis = 1) for stage in STAGES}
+    metrics['welfare_gain'] = metrics['welfare_resolve'] - metrics['welfare_baseline']
+    metrics['n_conflicts'] = results['n_conflicts']
+    metrics['n_conflicts_baseline'] = results['n_conflicts_baseline']
+
+    summary = {}
+    for name, values in metrics.items():
+        values = np.asarray(values, dtype = np.float64)
+        n = len(values)
+        mean = values.mean()
+        std = values.std(ddof = 1) if n > 1 else 0.0
+        half_width = stats.t.ppf((1 + confidence) / 2, n - 1) * std / np.sqrt(n) if n > 1 else np.nan
+        summary[name] = {'mean': mean, 'std': std, 'ci_low': mean - half_width, 'ci_high': mean + half_width,
+                         'values': values}
+    return summary
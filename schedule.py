@@ -0,0 +1,496 @@
+import argparse
+import hashlib
+import os
+from collections import OrderedDict
+
+import numpy as np
+import scipy.sparse as sp
+from scipy.sparse.csgraph import maximum_flow, breadth_first_order
+
+import instrument
+from market import enrollment_from_objects
+
+
+def conflict_matrix(enrollment):
+    # (n_courses, n_courses) symmetric co-enrollment counts: entry (c1, c2) is the number of
+    # students enrolled in both courses (zero diagonal)
+    enrollment = sp.csr_matrix(enrollment, dtype = np.int64)
+    conflicts = (enrollment.T @ enrollment).tocsr()
+    conflicts.setdiag(0)
+    conflicts.eliminate_zeros()
+    return conflicts
+
+
+def conflict_nodes(enrollment):
+    # courses of the conflict graph in the order the loop over students and
+    # combinations(sorted(course_enroll), 2) first meets them (= node order of the networkx graph)
+    enrollment = sp.csr_matrix(enrollment)
+    enrollment.sort_indices()
+    sizes = np.diff(enrollment.indptr)
+    students, firsts = [], []
+    for k in np.unique(sizes[sizes > 1]).tolist():
+        rows = np.flatnonzero(sizes == k)
+        courses = enrollment.indices[enrollment.indptr[rows][:, None] + np.arange(k)]
+        i, j = np.triu_indices(k, 1)
+        # a pair (c1, c2) introduces c1 before c2; within a student, c1 runs in sorted order
+        pairs = np.stack([courses[:, i], courses[:, j]], axis = 2).reshape(len(rows), -1)
+        students.append(np.repeat(rows, pairs.shape[1]))
+        firsts.append(pairs.ravel())
+    if not students:
+        return np.zeros(0, dtype = np.int64)
+    order = np.argsort(np.concatenate(students), kind = 'stable')
+    sequence = np.concatenate(firsts)[order]
+    nodes, first_seen = np.unique(sequence, return_index = True)
+    return nodes[np.argsort(first_seen)]
+
+# =============================================================================== #
+
+def gomory_hu_edges(capacities):
+    # Gomory-Hu cut tree of an undirected graph (Gusfield's algorithm, as nx.gomory_hu_tree)
+    # with every minimum cut computed by scipy's compiled max flow; capacities is a symmetric
+    # int32 csr matrix over nodes 0..n-1 in graph order. Returns (u, v, cut value) edges in the
+    # order networkx iterates the edges of the tree.
+    n_nodes = capacities.shape[0]
+    capacities = sp.csr_matrix(capacities, dtype = np.int32)
+    capacities.sort_indices()
+    tree = {n: 0 for n in range(1, n_nodes)}
+    labels = {}
+    for source in tree:
+        target = tree[source]
+        result = maximum_flow(capacities, source, target)
+        residual = (capacities - result.flow).tocsr()
+        residual.data[residual.data < 0] = 0
+        residual.eliminate_zeros()
+        # the target side is every node that can still reach the target in the residual network
+        target_side = np.zeros(n_nodes, dtype = bool)
+        target_side[breadth_first_order(residual.T.tocsr(), target, return_predecessors = False)] = True
+        cut_value = result.flow_value
+        labels[(source, target)] = cut_value
+        for node in np.flatnonzero(~target_side).tolist():
+            if node != source and node in tree and tree[node] == target:
+                tree[node] = source
+                labels[node, source] = labels.get((node, target), cut_value)
+        if target != 0 and not target_side[tree[target]]:
+            labels[source, tree[target]] = labels[target, tree[target]]
+            labels[target, source] = cut_value
+            tree[source] = tree[target]
+            tree[target] = source
+
+    adjacency = {n: [] for n in range(n_nodes)}
+    for u, v in tree.items():
+        adjacency[u].append((v, labels[u, v]))
+        adjacency[v].append((u, labels[u, v]))
+    edges, seen = [], set()
+    for u in range(n_nodes):
+        for v, weight in adjacency[u]:
+            if v not in seen:
+                edges.append((u, v, weight))
+        seen.add(u)
+    return edges
+
+
+def tree_components(n_nodes, edges):
+    # connected components of a forest, ordered by their first node (as nx.connected_components)
+    adjacency = {n: [] for n in range(n_nodes)}
+    for u, v, _ in edges:
+        adjacency[u].append(v)
+        adjacency[v].append(u)
+    labels = np.full(n_nodes, -1)
+    n_components = 0
+    for start in range(n_nodes):
+        if labels[start] >= 0:
+            continue
+        labels[start] = n_components
+        stack = [start]
+        while stack:
+            for v in adjacency[stack.pop()]:
+                if labels[v] < 0:
+                    labels[v] = n_components
+                    stack.append(v)
+        n_components += 1
+    return labels
+
+
+class CutTreeCache():
+    # Gomory-Hu trees by content hash of their capacity graph, kept in memory (least recently
+    # used evicted beyond max_entries) and, with cache_dir, on disk as one .npy of (u, v, cut value)
+    # rows per tree, shared by every process using the directory
+    def __init__(self, cache_dir = None, max_entries = 32):
+        self.cache_dir = cache_dir
+        self.max_entries = max_entries
+        self.trees = OrderedDict()
+        self.hits, self.disk_hits, self.misses = 0, 0, 0
+
+    def __repr__(self):
+        return (f"CutTreeCache({self.cache_dir!r}, entries={len(self.trees)}, hits={self.hits}, "
+                f"disk_hits={self.disk_hits}, misses={self.misses})")
+
+    @staticmethod
+    def key(capacities):
+        capacities = sp.csr_matrix(capacities, dtype = np.int32)
+        capacities.sort_indices()
+        digest = hashlib.sha1(np.array(capacities.shape, dtype = np.int64).tobytes())
+        for values in [capacities.indptr.astype(np.int64), capacities.indices.astype(np.int64), capacities.data]:
+            digest.update(values.tobytes())
+        return digest.hexdigest()
+
+    def edges(self, capacities):
+        # gomory_hu_edges(capacities), computed once per distinct graph
+        key = self.key(capacities)
+        if key in self.trees:
+            self.hits += 1
+            self.trees.move_to_end(key)
+            return self.trees[key]
+
+        path = os.path.join(self.cache_dir, f"{key}.npy") if self.cache_dir is not None else None
+        if path is not None and os.path.exists(path):
+            self.disk_hits += 1
+            edges = [tuple(e) for e in np.load(path).tolist()]
+        else:
+            self.misses += 1
+            with instrument.phase('gomory_hu_edges', nodes = capacities.shape[0]):
+                edges = gomory_hu_edges(capacities)
+            if path is not None:
+                # written under a temporary name and renamed: readers never see a partial file
+                os.makedirs(self.cache_dir, exist_ok = True)
+                tmp_path = f"{path}.tmp{os.getpid()}.npy"
+                np.save(tmp_path, np.array(edges, dtype = np.int64).reshape(-1, 3))
+                os.replace(tmp_path, path)
+
+        self.trees[key] = edges
+        while len(self.trees) > self.max_entries:
+            self.trees.popitem(last = False)
+        return edges
+
+
+tree_cache = CutTreeCache()
+
+
+def use_tree_cache(cache_dir = None, max_entries = 32):
+    # replace the cache gomory_hu_slots uses by default, e.g. with one backed by a directory
+    global tree_cache
+    tree_cache = CutTreeCache(cache_dir, max_entries)
+    return tree_cache
+
+
+def cut_tree(conflicts, nodes = None, cache = None):
+    # (nodes, Gomory-Hu tree edges over node positions) of the k-cut graph: edges weighted
+    # max(conflicts) - conflicts. The tree does not depend on the number of slots
+    conflicts = sp.triu(conflicts, k = 1).tocsr()
+    if nodes is None:
+        nodes = np.unique(conflicts.nonzero())
+    if len(nodes) == 0:
+        return nodes, []
+
+    position = np.empty(conflicts.shape[0], dtype = np.int64)
+    position[nodes] = np.arange(len(nodes))
+    pairs = conflicts.tocoo()
+    weights = (pairs.data.max() - pairs.data).astype(np.int32)
+    capacities = sp.csr_matrix((weights, (position[pairs.row], position[pairs.col])),
+                               shape = (len(nodes), len(nodes)))
+    capacities = (capacities + capacities.T).tocsr()
+    return nodes, (cache or tree_cache).edges(capacities)
+
+
+def tree_slots(n_courses, nodes, edges, n_slots, verbose = False):
+    # cut the n_slots - 1 lightest edges of the tree, one slot per remaining component;
+    # courses outside the graph get slot -1
+    slots = np.full(n_courses, -1)
+    if len(nodes) == 0:
+        return slots
+    order = sorted(range(len(edges)), key = lambda i: edges[i][2])
+    cut = set(order[: n_slots - 1])
+    if verbose:
+        for i in order[: n_slots - 1]:
+            print(f"({nodes[edges[i][0]]}, {nodes[edges[i][1]]}) with weight {edges[i][2]}")
+
+    components = tree_components(len(nodes), [e for i, e in enumerate(edges) if i not in cut])
+    slots[nodes] = components
+    if verbose:
+        print(f"Number of components: {components.max() + 1}")
+        for i in range(components.max() + 1):
+            comp = nodes[components == i]
+            print(f"Component {i}: size = {len(comp)} -> {comp.tolist()}")
+    return slots
+
+
+def gomory_hu_slots(conflicts, n_slots, nodes = None, verbose = False, cache = None):
+    # the k-cut of the original experiment: edges weighted max(conflicts) - conflicts, cut the
+    # n_slots - 1 lightest edges of the Gomory-Hu tree, one slot per remaining component.
+    # nodes gives the graph node order (conflict_nodes); courses outside the graph get slot -1.
+    # The tree comes from cache (default: tree_cache), so other slot counts and reruns on the
+    # same conflict graph reuse it
+    if verbose:
+        upper = sp.triu(conflicts, k = 1)
+        print(f"number of edges: {upper.nnz}")
+        print(f"total number of conflicts: {upper.sum()}")
+    nodes, edges = cut_tree(conflicts, nodes, cache)
+    if verbose and len(nodes):
+        print(f"Number of nodes: {len(nodes)}")
+        print(f"Number of edges: {sp.triu(conflicts, k = 1).nnz}")
+    return tree_slots(conflicts.shape[0], nodes, edges, n_slots, verbose)
+
+
+def gomory_hu_partitions(conflicts, slot_counts, nodes = None, cache = None):
+    # gomory_hu_slots for several numbers of slots from a single tree: {n_slots: slots}
+    nodes, edges = cut_tree(conflicts, nodes, cache)
+    return {n_slots: tree_slots(conflicts.shape[0], nodes, edges, n_slots) for n_slots in slot_counts}
+
+# =============================================================================== #
+
+def greedy_slots(conflicts, n_slots):
+    # weighted greedy colouring: courses by decreasing total conflicts, each placed in the slot
+    # where it adds the fewest conflicts; slot_weights[c, t] is the weight between c and slot t
+    conflicts = sp.csr_matrix(conflicts)
+    n_courses = conflicts.shape[0]
+    slots = np.full(n_courses, -1)
+    slot_weights = np.zeros((n_courses, n_slots))
+    slot_sizes = np.zeros(n_slots)
+    for c in np.argsort(-np.asarray(conflicts.sum(axis = 1)).ravel(), kind = 'stable').tolist():
+        # ties go to the emptiest slot, so conflict-free courses are spread evenly
+        t = int(np.lexsort((slot_sizes, slot_weights[c]))[0])
+        slots[c] = t
+        slot_sizes[t] += 1
+        row = slice(conflicts.indptr[c], conflicts.indptr[c + 1])
+        slot_weights[conflicts.indices[row], t] += conflicts.data[row]
+    return slots
+
+
+def spectral_slots(conflicts, n_slots, seed = None):
+    # courses that share many students should end up far apart: embed them with the eigenvectors
+    # of the smallest eigenvalues of the conflict matrix, cluster the embedding with k-means and
+    # fill the slots up to an even size, most confident courses first
+    from scipy.cluster.vq import kmeans2
+    from scipy.sparse.linalg import eigsh
+    conflicts = sp.csr_matrix(conflicts, dtype = np.float64)
+    n_courses = conflicts.shape[0]
+    if n_slots >= n_courses - 1:
+        return np.arange(n_courses) % n_slots
+    _, vectors = eigsh(conflicts, k = n_slots, which = 'SA', v0 = np.ones(n_courses))
+    centroids, _ = kmeans2(vectors, n_slots, minit = '++', seed = seed)
+    distances = ((vectors[:, None, :] - centroids[None, :, :]) ** 2).sum(axis = 2)
+
+    slot_size = -(-n_courses // n_slots)
+    slots = np.full(n_courses, -1)
+    slot_sizes = np.zeros(n_slots, dtype = np.int64)
+    choices = np.argsort(distances, axis = 1)
+    for c in np.argsort(distances.min(axis = 1), kind = 'stable').tolist():
+        t = next(t for t in choices[c].tolist() if slot_sizes[t] < slot_size)
+        slots[c] = t
+        slot_sizes[t] += 1
+    return slots
+
+
+def count_conflicts(conflicts, slots):
+    # number of (student, course pair) conflicts: co-enrollments between courses sharing a slot
+    conflicts = sp.triu(conflicts, k = 1).tocoo()
+    same = (slots[conflicts.row] == slots[conflicts.col]) & (slots[conflicts.row] >= 0)
+    return int(conflicts.data[same].sum())
+
+
+def assign_times(course_list, slots):
+    for c, t in zip(course_list, slots.tolist()):
+        if t >= 0:
+            c.set_time(t)
+    return course_list
+
+
+# =============================================================================== #
+
+def slot_weight_matrix(conflicts, slots, n_slots):
+    # slot_weights[c, t]: co-enrollments between course c and the courses in slot t
+    conflicts = sp.csr_matrix(conflicts, dtype = np.int64)
+    scheduled = np.flatnonzero(slots >= 0)
+    members = sp.csr_matrix((np.ones(len(scheduled), dtype = np.int64), (scheduled, slots[scheduled])),
+                            shape = (conflicts.shape[0], n_slots))
+    return (conflicts @ members).toarray()
+
+
+class SlotSearch():
+    # local search over the slots of the scheduled courses. The slot weight matrix is kept up to
+    # date, so the conflict delta of moving course c to slot t is one difference of its row,
+    # and applying a move only touches the edges of c (its row of the conflict matrix)
+    def __init__(self, conflicts, slots, n_slots):
+        self.conflicts = sp.csr_matrix(conflicts, dtype = np.int64)
+        self.conflicts.sort_indices()
+        self.slots = np.array(slots, dtype = np.int64)
+        self.n_slots = max(n_slots, int(self.slots.max(initial = -1)) + 1)
+        self.weights = slot_weight_matrix(self.conflicts, self.slots, self.n_slots)
+        self.cost = count_conflicts(self.conflicts, self.slots)
+        self.n_evaluated = 0
+        self.n_moves = 0
+
+    def __repr__(self):
+        return (f"SlotSearch(conflicts={self.cost}, evaluated={self.n_evaluated}, "
+                f"moves={self.n_moves})")
+
+    def move_delta(self, c, t):
+        return int(self.weights[c, t] - self.weights[c, self.slots[c]])
+
+    def swap_delta(self, c, d):
+        # c and d exchange slots; the pair itself stays apart
+        a, b = self.slots[c], self.slots[d]
+        return int(self.weights[c, b] - self.weights[c, a] + self.weights[d, a] - self.weights[d, b]
+                   - 2 * self.conflict(c, d))
+
+    def conflict(self, c, d):
+        start, end = self.conflicts.indptr[c], self.conflicts.indptr[c + 1]
+        i = start + np.searchsorted(self.conflicts.indices[start: end], d)
+        return int(self.conflicts.data[i]) if i < end and self.conflicts.indices[i] == d else 0
+
+    def move(self, c, t):
+        a = self.slots[c]
+        self.cost += self.move_delta(c, t)
+        start, end = self.conflicts.indptr[c], self.conflicts.indptr[c + 1]
+        neighbours, weights = self.conflicts.indices[start: end], self.conflicts.data[start: end]
+        self.weights[neighbours, a] -= weights
+        self.weights[neighbours, t] += weights
+        self.slots[c] = t
+        self.n_moves += 1
+
+    def swap(self, c, d):
+        a, b = self.slots[c], self.slots[d]
+        self.move(c, b)
+        self.move(d, a)
+
+    def descend(self, max_passes = 100):
+        # best single move of every course in turn, until a pass improves nothing
+        courses = np.flatnonzero(self.slots >= 0)
+        for _ in range(max_passes):
+            n_improved = 0
+            for c in courses.tolist():
+                row = self.weights[c]
+                t = int(row.argmin())
+                self.n_evaluated += self.n_slots
+                if row[t] < row[self.slots[c]]:
+                    self.move(c, t)
+                    n_improved += 1
+            if n_improved == 0:
+                break
+        return self
+
+    def anneal(self, n_steps = 1_000_000, temperature = None, final_temperature = 0.01, swap_rate = 0.2,
+               seed = None, chunk_size = 1 << 16):
+        # simulated annealing over random moves and swaps, geometric cooling from temperature
+        # (default: the mean co-enrollment of an edge) to final_temperature times it; ends with
+        # the best assignment seen. The random candidates are drawn chunk_size steps at a time
+        courses = np.flatnonzero(self.slots >= 0)
+        if len(courses) < 2 or self.n_slots < 2:
+            return self
+        rng = np.random.default_rng(seed)
+        if temperature is None:
+            temperature = float(self.conflicts.data.mean()) if self.conflicts.nnz else 1.0
+
+        # best_slots is None while the current assignment is the best seen
+        best_cost, best_slots = self.cost, None
+        for start in range(0, n_steps, chunk_size):
+            size = min(chunk_size, n_steps - start)
+            temperatures = (temperature * final_temperature ** (np.arange(start, start + size) / n_steps)).tolist()
+            firsts = rng.choice(courses, size).tolist()
+            seconds = rng.choice(courses, size).tolist()
+            targets = rng.integers(self.n_slots, size = size).tolist()
+            swaps = (rng.random(size) < swap_rate).tolist()
+            thresholds = (-np.log(rng.random(size))).tolist() # accept if delta < T * threshold
+
+            for c, d, t, swap, T, threshold in zip(firsts, seconds, targets, swaps, temperatures, thresholds):
+                if swap:
+                    if self.slots[c] == self.slots[d]:
+                        continue
+                    delta = self.swap_delta(c, d)
+                else:
+                    if self.slots[c] == t:
+                        continue
+                    delta = self.move_delta(c, t)
+                self.n_evaluated += 1
+                if delta > 0 and delta >= T * threshold:
+                    continue
+                if delta > 0 and best_slots is None:
+                    best_slots = self.slots.copy()
+                if swap:
+                    self.swap(c, d)
+                else:
+                    self.move(c, t)
+                if self.cost < best_cost:
+                    best_cost, best_slots = self.cost, None
+
+        if best_slots is not None:
+            self.slots = best_slots
+            self.weights = slot_weight_matrix(self.conflicts, self.slots, self.n_slots)
+            self.cost = best_cost
+        return self
+
+
+def optimize_slots(conflicts, slots, n_slots, method = 'anneal', n_steps = 1_000_000, seed = None):
+    # refine a slot assignment: 'descent' (best single moves until none improves) or 'anneal'
+    # (simulated annealing, then descent); courses without a slot keep none. Returns the
+    # SlotSearch (slots, cost, number of evaluated candidates)
+    search = SlotSearch(conflicts, slots, n_slots)
+    if method == 'anneal':
+        search.anneal(n_steps, seed = seed)
+    return search.descend()
+
+
+SCHEDULERS = {
+    'gomory_hu': lambda conflicts, n_slots, nodes, seed: gomory_hu_slots(conflicts, n_slots, nodes = nodes),
+    'greedy': lambda conflicts, n_slots, nodes, seed: greedy_slots(conflicts, n_slots),
+    'spectral': lambda conflicts, n_slots, nodes, seed: spectral_slots(conflicts, n_slots, seed = seed),
+}
+
+
+def schedule_courses(student_list, course_list, n_slots = 12, method = 'gomory_hu', seed = None,
+                     verbose = False):
+    # set the time of every course from the current enrollment; returns (slots, number of conflicts)
+    with instrument.phase('conflict_graph'):
+        enrollment = enrollment_from_objects(student_list, course_list)
+        conflicts = conflict_matrix(enrollment)
+        nodes = conflict_nodes(enrollment) if method == 'gomory_hu' else None
+    with instrument.phase('gomory_hu_tree' if method == 'gomory_hu' else f'{method}_slots', n_slots = n_slots):
+        if method == 'gomory_hu':
+            slots = gomory_hu_slots(conflicts, n_slots, nodes = nodes, verbose = verbose)
+        else:
+            slots = SCHEDULERS[method](conflicts, n_slots, None, seed)
+    assign_times(course_list, slots)
+    n_conflicts = count_conflicts(conflicts, slots)
+    if verbose:
+        print(f"{method}: {n_conflicts} conflicts over {n_slots} slots")
+    return slots, n_conflicts
+
+
+if __name__ == "__main__":
+    # scheduling step on its own (no Student/Course objects, no plotting): generate a market,
+    # match it and compare the slot partitions
+    import time
+
+    from market import enrollment_matrix
+    from matching import deferred_acceptance
+    from simulate import generate_market
+
+    parser = argparse.ArgumentParser(description = 'Partition courses into time slots')
+    parser.add_argument('--n_students', type = int, default = 5000)
+    parser.add_argument('--n_courses', type = int, default = 100)
+    parser.add_argument('--n_depts', type = int, default = 15)
+    parser.add_argument('--credit_limit', type = int, default = 4)
+    parser.add_argument('--enroll_limit', type = int, default = 80)
+    parser.add_argument('--n_slots', type = int, nargs = '+', default = [12],
+                        help = 'Slot counts to partition into (the Gomory-Hu tree is computed once)')
+    parser.add_argument('--tree_cache', default = None, help = 'Directory caching Gomory-Hu trees across runs')
+    parser.add_argument('--seed', type = int, default = None)
+    parser.add_argument('--methods', nargs = '+', choices = list(SCHEDULERS), default = list(SCHEDULERS))
+    args = parser.parse_args()
+
+    market = generate_market(args.n_students, args.n_courses, args.n_depts,
+                             args.credit_limit, args.enroll_limit, seed = args.seed)
+    held_students, held_courses, _, _ = deferred_acceptance(market.course_prefs, market.priority_ranks,
+                                                            market.enroll_limits, market.credit_limits)
+    enrollment = enrollment_matrix(held_students, held_courses, market.n_students, market.n_courses)
+    conflicts = conflict_matrix(enrollment)
+    nodes = conflict_nodes(enrollment)
+    print(f"total number of conflicts: {sp.triu(conflicts, k = 1).sum()}")
+    use_tree_cache(args.tree_cache)
+    for method in args.methods:
+        for n_slots in args.n_slots:
+            start = time.time()
+            slots = SCHEDULERS[method](conflicts, n_slots, nodes, args.seed)
+            print(f"{method}, {n_slots} slots: {count_conflicts(conflicts, slots)} conflicts "
+                  f"({time.time() - start:.2f}s)")
+    print(tree_cache)
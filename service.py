@@ -0,0 +1,332 @@
+import argparse
+import asyncio
+import json
+import logging
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import numpy as np
+
+from incremental import IncrementalMatching
+from simulate import generate_market
+
+logger = logging.getLogger(__name__)
+
+# Enrollment service: preference changes are queued and coalesced (the last submission of a
+# student wins) into matching rounds run every batch_interval seconds by an IncrementalMatching
+# that lives in a single executor worker, so a round never blocks the event loop. Each round
+# returns the committed matching already indexed both ways; it becomes the front buffer that
+# every query reads, while the previous one stays valid for readers that still hold it.
+# Protocol: one JSON object per line each way, e.g.
+#   {"op": "courses", "student": 3}          -> {"ok": true, "round": 7, "courses": [...]}
+#   {"op": "roster", "course": 5}            -> {"ok": true, "round": 7, "students": [...]}
+#   {"op": "submit", "student": 3, "prefs": [...], "wait": false}
+#                                            -> {"ok": true, "round": 8} (the round that will commit it)
+#   {"op": "stats"}
+# Errors are answered as {"ok": false, "error": "..."}. If a round fails, the engine state is
+# unknown: the service logs it, fails the submissions waiting for any round and rejects new ones,
+# and keeps answering queries from the last committed matching.
+
+
+class EnrollmentIndex():
+    # a committed matching as two CSR-like indexes: courses of every student, students of every course
+    def __init__(self, round_id, students, courses, n_students, n_courses):
+        self.round = round_id
+        order = np.lexsort((courses, students))
+        self.student_courses = courses[order]
+        self.student_starts = np.searchsorted(students[order], np.arange(n_students + 1))
+        order = np.lexsort((students, courses))
+        self.course_students = students[order]
+        self.course_starts = np.searchsorted(courses[order], np.arange(n_courses + 1))
+
+    def __repr__(self):
+        return f"EnrollmentIndex(round={self.round}, pairs={len(self.student_courses)})"
+
+    @property
+    def n_students(self):
+        return len(self.student_starts) - 1
+
+    @property
+    def n_courses(self):
+        return len(self.course_starts) - 1
+
+    def courses_of(self, student):
+        return self.student_courses[self.student_starts[student]: self.student_starts[student + 1]].tolist()
+
+    def students_of(self, course):
+        return self.course_students[self.course_starts[course]: self.course_starts[course + 1]].tolist()
+
+# =============================================================================== #
+# matching engine, one per executor worker
+
+_engine = None
+
+
+def _start_engine(market):
+    global _engine
+    student_list, course_list = market.to_objects(compact = True)
+    _engine = IncrementalMatching(student_list, course_list)
+
+
+def _engine_round(round_id, edits):
+    # apply the coalesced preference changes, update the matching and index it
+    start = time.perf_counter()
+    for student, prefs in edits.items():
+        _engine.update_preferences(student, prefs)
+    n_proposals = _engine.update() if edits else 0
+    students, courses = _engine.matching()
+    index = EnrollmentIndex(round_id, students, courses, len(_engine.student_list), len(_engine.course_list))
+    return index, n_proposals, time.perf_counter() - start
+
+
+class EnrollmentService():
+    def __init__(self, market, batch_interval = 0.2, executor = 'process'):
+        self.n_students, self.n_courses = market.n_students, market.n_courses
+        self.batch_interval = batch_interval
+        executor_class = ProcessPoolExecutor if executor == 'process' else ThreadPoolExecutor
+        self.executor = executor_class(max_workers = 1, initializer = _start_engine, initargs = (market,))
+        self.front = None # EnrollmentIndex read by queries
+        self.back = None # the previous one
+        self.pending = {} # student: preference list, for the next round
+        self.waiting = {} # round: future resolved when the round commits
+        self.next_round = 1 # the round pending submissions go into
+        self.stats = {'rounds': 0, 'submissions': 0, 'coalesced': 0, 'proposals': 0, 'round_time': 0.0}
+        self.error = None # the exception of a failed round, once the service stopped matching
+        self._task = None
+
+    async def start(self):
+        # initial matching, then the batching loop
+        await self._commit(0, {})
+        self._task = asyncio.create_task(self._batch_loop())
+        return self
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+        for future in self.waiting.values():
+            future.cancel()
+        self.waiting = {}
+        self.executor.shutdown()
+
+    async def _batch_loop(self):
+        while True:
+            await asyncio.sleep(self.batch_interval)
+            if self.pending:
+                edits, self.pending = self.pending, {}
+                round_id, self.next_round = self.next_round, self.next_round + 1
+                try:
+                    await self._commit(round_id, edits)
+                except Exception as e:
+                    self._fail(round_id, e)
+                    return
+                if round_id in self.waiting:
+                    self.waiting.pop(round_id).set_result(round_id)
+
+    def _fail(self, round_id, error):
+        # stop matching: the engine may hold a partly applied round
+        logger.exception("matching round %d failed, no further submissions are accepted", round_id)
+        self.error = RuntimeError(f"matching round {round_id} failed: {error!r}")
+        for future in self.waiting.values():
+            if not future.done():
+                future.set_exception(self.error)
+        self.waiting = {}
+        self.pending = {}
+
+    async def _commit(self, round_id, edits):
+        loop = asyncio.get_running_loop()
+        index, n_proposals, elapsed = await loop.run_in_executor(self.executor, _engine_round, round_id, edits)
+        self.front, self.back = index, self.front
+        self.stats['rounds'] += 1
+        self.stats['proposals'] += n_proposals
+        self.stats['round_time'] += elapsed
+
+    # ------------------------------------------------------------------------------- #
+
+    def enrolled_courses(self, student):
+        index = self.front
+        return index.round, index.courses_of(student)
+
+    def course_roster(self, course):
+        index = self.front
+        return index.round, index.students_of(course)
+
+    def submit(self, student, prefs):
+        # queue a complete preference list (a permutation of the courses); returns the round
+        # that will commit it
+        if self.error is not None:
+            raise self.error
+        if not 0 <= student < self.n_students:
+            raise ValueError(f"unknown student {student}")
+        # checked as Python ints before converting: floats would be truncated, large ints overflow
+        if not isinstance(prefs, (list, tuple)) or len(prefs) != self.n_courses or \
+                not all(type(c) is int for c in prefs) or sorted(prefs) != list(range(self.n_courses)):
+            raise ValueError(f"prefs must rank each of the {self.n_courses} courses once")
+        self.stats['submissions'] += 1
+        self.stats['coalesced'] += student in self.pending
+        self.pending[student] = np.array(prefs, dtype = np.int32)
+        return self.next_round
+
+    async def committed(self, round_id):
+        # wait until the round is the front buffer (or a later one)
+        if self.front.round >= round_id:
+            return self.front.round
+        if self.error is not None:
+            raise self.error
+        if round_id not in self.waiting:
+            self.waiting[round_id] = asyncio.get_running_loop().create_future()
+        return await self.waiting[round_id]
+
+    # ------------------------------------------------------------------------------- #
+
+    async def handle(self, request):
+        op = request.get('op')
+        if op == 'courses':
+            round_id, courses = self.enrolled_courses(self._id(request, 'student', self.n_students))
+            return {'ok': True, 'round': round_id, 'courses': courses}
+        if op == 'roster':
+            round_id, students = self.course_roster(self._id(request, 'course', self.n_courses))
+            return {'ok': True, 'round': round_id, 'students': students}
+        if op == 'submit':
+            round_id = self.submit(self._id(request, 'student', self.n_students), request.get('prefs', []))
+            if request.get('wait'):
+                await self.committed(round_id)
+            return {'ok': True, 'round': round_id}
+        if op == 'stats':
+            return {'ok': True, 'round': self.front.round, 'pending': len(self.pending),
+                    'error': None if self.error is None else str(self.error), **self.stats}
+        raise ValueError(f"unknown op {op!r}")
+
+    @staticmethod
+    def _id(request, key, n):
+        value = request.get(key)
+        if type(value) is not int or not 0 <= value < n:
+            raise ValueError(f"{key} must be an integer in [0, {n})")
+        return value
+
+    async def serve_client(self, reader, writer):
+        try:
+            while line := await reader.readline():
+                try:
+                    response = await self.handle(json.loads(line))
+                except (ValueError, TypeError, AttributeError, RuntimeError) as e:
+                    response = {'ok': False, 'error': str(e)}
+                writer.write(json.dumps(response).encode() + b'\n')
+                await writer.drain()
+        except (ConnectionError, asyncio.CancelledError):
+            # client gone, or the service shutting down
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, host = '127.0.0.1', port = 8765):
+        return await asyncio.start_server(self.serve_client, host, port, limit = 1 << 20)
+
+# =============================================================================== #
+
+async def run_load(host, port, n_students, n_courses, clients = 32, duration = 10.0, write_fraction = 0.05,
+                   seed = None):
+    # clients each keep one connection and send requests back to back for duration seconds:
+    # reads split between student and course queries, write_fraction random preference changes.
+    # Returns requests per second and latency percentiles (ms) per kind of request
+    rng = np.random.default_rng(seed)
+    latencies = {'courses': [], 'roster': [], 'submit': []}
+    errors = 0
+    deadline = time.perf_counter() + duration
+
+    async def client(client_seed):
+        nonlocal errors
+        client_rng = np.random.default_rng(client_seed)
+        reader, writer = await asyncio.open_connection(host, port, limit = 1 << 20)
+        while time.perf_counter() < deadline:
+            if client_rng.random() < write_fraction:
+                request = {'op': 'submit', 'student': int(client_rng.integers(n_students)),
+                           'prefs': client_rng.permutation(n_courses).tolist()}
+            elif client_rng.random() < 0.5:
+                request = {'op': 'courses', 'student': int(client_rng.integers(n_students))}
+            else:
+                request = {'op': 'roster', 'course': int(client_rng.integers(n_courses))}
+            start = time.perf_counter()
+            writer.write(json.dumps(request).encode() + b'\n')
+            response = json.loads(await reader.readline())
+            latencies[request['op']].append(time.perf_counter() - start)
+            errors += not response['ok']
+        writer.close()
+
+    start = time.perf_counter()
+    await asyncio.gather(*[client(s) for s in rng.integers(2 ** 32, size = clients).tolist()])
+    elapsed = time.perf_counter() - start
+
+    summary = {'requests': sum(len(l) for l in latencies.values()), 'errors': errors, 'seconds': elapsed}
+    summary['rps'] = summary['requests'] / elapsed
+    for op, values in latencies.items():
+        if values:
+            values = np.array(values) * 1000
+            summary[op] = {'n': len(values), 'p50_ms': float(np.percentile(values, 50)),
+                           'p99_ms': float(np.percentile(values, 99)), 'max_ms': float(values.max())}
+    return summary
+
+
+async def main(args):
+    if args.snapshot is not None:
+        from snapshot import load_snapshot
+        market = load_snapshot(args.snapshot).market
+    else:
+        market = generate_market(args.n_students, args.n_courses, args.n_depts, args.credit_limit,
+                                 args.enroll_limit, seed = args.seed)
+    service = await EnrollmentService(market, batch_interval = args.batch_interval,
+                                      executor = args.executor).start()
+    server = await service.serve(args.host, args.port)
+    print(f"serving {market} on {args.host}:{args.port}, round {service.front.round}")
+    try:
+        if args.load:
+            summary = await run_load(args.host, args.port, market.n_students, market.n_courses,
+                                     clients = args.clients, duration = args.duration,
+                                     write_fraction = args.write_fraction, seed = args.seed)
+            print(f"{summary['requests']} requests in {summary['seconds']:.1f}s: {summary['rps']:.0f} requests/s, "
+                  f"{summary['errors']} errors")
+            for op in ['courses', 'roster', 'submit']:
+                if op in summary:
+                    print(f"\t{op}: n={summary[op]['n']}, p50 {summary[op]['p50_ms']:.2f} ms, "
+                          f"p99 {summary[op]['p99_ms']:.2f} ms, max {summary[op]['max_ms']:.2f} ms")
+            stats = service.stats
+            print(f"rounds: {stats['rounds']}, submissions: {stats['submissions']} "
+                  f"({stats['coalesced']} coalesced), proposals: {stats['proposals']}, "
+                  f"matching time: {stats['round_time']:.2f}s")
+            if args.output is not None:
+                with open(args.output, 'w') as f:
+                    json.dump({'load': summary, 'service': stats}, f, indent = 2)
+        else:
+            await server.serve_forever()
+    finally:
+        server.close()
+        await service.stop()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = 'Enrollment service with batched matching rounds')
+    parser.add_argument('--snapshot', default = None, help = 'Serve the market of this snapshot')
+    parser.add_argument('--n_students', type = int, default = 5000)
+    parser.add_argument('--n_courses', type = int, default = 100)
+    parser.add_argument('--n_depts', type = int, default = 15)
+    parser.add_argument('--credit_limit', type = int, default = 4)
+    parser.add_argument('--enroll_limit', type = int, default = 80)
+    parser.add_argument('--seed', type = int, default = None)
+    parser.add_argument('--host', default = '127.0.0.1')
+    parser.add_argument('--port', type = int, default = 8765)
+    parser.add_argument('--batch_interval', type = float, default = 0.2,
+                        help = 'Seconds between matching rounds (submissions in between are coalesced)')
+    parser.add_argument('--executor', choices = ['process', 'thread'], default = 'process',
+                        help = 'Where matching rounds run, off the event loop')
+    parser.add_argument('--load', action = 'store_true',
+                        help = 'Run the load generator against the service and report throughput and latency')
+    parser.add_argument('--clients', type = int, default = 32, help = 'Concurrent load generator connections')
+    parser.add_argument('--duration', type = float, default = 10.0, help = 'Seconds of load')
+    parser.add_argument('--write_fraction', type = float, default = 0.05,
+                        help = 'Share of load requests that submit preference changes')
+    parser.add_argument('--output', default = None, help = 'Write the load results to this JSON file')
+    args = parser.parse_args()
+    asyncio.run(main(args))
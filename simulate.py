@@ -1,11 +1,59 @@
+import random
 from collections import defaultdict
 from itertools import combinations, product, chain
 
 import numpy as np
 
 from agent import Student, Course
+from market import Market
+
+def set_seed(seed):
+    # one seed for both the `random` (object generators) and `np.random` (bulk generator) streams
+    random.seed(seed)
+    np.random.seed(seed)
+
+def generate_market(n_students = 5000, n_courses = 100, n_depts = 15, credit_limit = 4, enroll_limit = 80,
+                    seed = None, block_size = 256):
+    if seed is not None:
+        set_seed(seed)
+
+    n_years = 4
+    years = np.random.randint(n_years, size = n_students)
+    depts = np.random.randint(n_depts, size = n_students)
+    course_depts = np.random.randint(n_depts, size = n_courses)
+
+    # every student ranks all courses in a uniformly random order
+    course_prefs = np.argsort(np.random.random((n_students, n_courses)), axis = 1).astype(np.int32)
+
+    # every course ranks students from its own department first, then by decreasing class year,
+    # breaking ties randomly (same order as Course._generate_preferences)
+    student_prefs = np.empty((n_courses, n_students), dtype = np.int32)
+    year_key = n_years - 1 - years
+    for start in range(0, n_courses, block_size):
+        block = course_depts[start: start + block_size]
+        keys = (depts[None, :] != block[:, None]) * n_years + year_key[None, :]
+        keys = keys + np.random.random(keys.shape)
+        student_prefs[start: start + block_size] = np.argsort(keys, axis = 1)
+
+    return Market(course_prefs, student_prefs, years, depts, course_depts,
+                  np.full(n_students, credit_limit), np.full(n_courses, enroll_limit))
+
+def generate_data(n_students = 5000, n_courses = 100, n_depts = 15, credit_limit = 4, enroll_limit = 80,
+                  seed = None, compact = False):
+    market = generate_market(n_students = n_students,
+                             n_courses = n_courses,
+                             n_depts = n_depts,
+                             credit_limit = credit_limit,
+                             enroll_limit = enroll_limit,
+                             seed = seed)
+    return market.to_objects(compact = compact)
+
+def generate_data_objects(n_students = 5000, n_courses = 100, n_depts = 15, credit_limit = 4, enroll_limit = 80,
+                          seed = None):
+    # per-object generator, scanning the student list once per course
+    if seed is not None:
+        set_seed(seed)
 
-def generate_data(n_students = 5000, n_courses = 100, n_depts = 15, credit_limit = 4, enroll_limit = 80):
     student_list = []
     course_list = []
 
@@ -18,7 +66,7 @@ def generate_data(n_students = 5000, n_courses = 100, n_depts = 15, credit_limit
             department = np.random.randint(n_depts),
             credit_limit = credit_limit
         ))
-        
+
     for i in range(n_courses):
         course_list.append(Course(
             course_id = i,
@@ -26,4 +74,4 @@ def generate_data(n_students = 5000, n_courses = 100, n_depts = 15, credit_limit
             department = np.random.randint(n_depts),
             enroll_limit = enroll_limit
         ))
-    return student_list, course_list
\ No newline at end of file
+    return student_list, course_list
@@ -0,0 +1,159 @@
+import json
+import os
+import random
+import shutil
+
+import numpy as np
+
+from market import Market
+from matching import preference_arrays, write_enrollment
+
+
+# A snapshot is a directory of .npy files (one per array, loadable with mmap_mode) and a
+# meta.json written last, so a directory without meta.json is an unfinished snapshot.
+MARKET_FIELDS = ['course_prefs', 'student_prefs', 'years', 'depts', 'course_depts',
+                 'credit_limits', 'enroll_limits']
+STATE_FIELDS = ['held_students', 'held_courses', 'pointers', 'eligible']
+FORMAT_VERSION = 1
+
+
+class Snapshot():
+    def __init__(self, market, times = None, state = None, rng_state = None, schedule = None,
+                 schedule_slots = None):
+        self.market = market
+        self.times = times # time slot of every course, -1 if unscheduled
+        self.state = state # matching: {held_students, held_courses, pointers, eligible}
+        self.rng_state = rng_state # (np.random state, random state) right after the market was generated
+        self.schedule = schedule # settings the times were made with: n_slots, scheduler, seed, slot_search...
+        self.schedule_slots = schedule_slots # the scheduler's slots, before any slot search
+
+    def __repr__(self):
+        return f"Snapshot({self.market!r}, times={self.times is not None}, state={self.state is not None})"
+
+    def restore_rng(self):
+        # continue the random streams exactly where the run that saved the snapshot was
+        if self.rng_state is not None:
+            np_state, py_state = self.rng_state
+            np.random.set_state(np_state)
+            random.setstate(py_state)
+
+    def to_objects(self, compact = False, with_times = True, with_state = True):
+        student_list, course_list = self.market.to_objects(compact = compact)
+        if with_times and self.times is not None:
+            for c, t in zip(course_list, self.times.tolist()):
+                if t >= 0:
+                    c.set_time(t)
+        if with_state and self.state is not None:
+            apply_state(student_list, course_list, self.state, self.market.priority_ranks)
+        return student_list, course_list
+
+
+def capture_rng():
+    return np.random.get_state(), random.getstate()
+
+
+def capture_state(student_list, course_list):
+    # matching state of the objects as arrays (enrolled pairs, proposal pointers, eligibility)
+    held_students = np.repeat(np.arange(len(student_list)), [len(s.course_enroll) for s in student_list])
+    held_courses = np.array([c for s in student_list for c in s.course_enroll], dtype = np.int64)
+    return {'held_students': held_students,
+            'held_courses': held_courses,
+            'pointers': np.array([s.current_course_propose for s in student_list], dtype = np.int64),
+            'eligible': np.array([s.eligible for s in student_list], dtype = bool)}
+
+
+def apply_state(student_list, course_list, state, priority_ranks = None):
+    if priority_ranks is None:
+        priority_ranks = preference_arrays(student_list, course_list)[1]
+    write_enrollment(student_list, course_list, np.asarray(state['held_students']),
+                     np.asarray(state['held_courses']), priority_ranks)
+    for s, pointer, eligible in zip(student_list, state['pointers'].tolist(), state['eligible'].tolist()):
+        s.current_course_propose = pointer
+        s.eligible = eligible
+    return student_list, course_list
+
+
+def course_times(course_list):
+    return np.array([-1 if c.time is None else c.time for c in course_list], dtype = np.int64)
+
+# =============================================================================== #
+
+def save_snapshot(path, market, times = None, state = None, rng_state = None, overwrite = True,
+                  schedule = None, schedule_slots = None):
+    # written to a temporary directory and renamed, so readers never see a partial snapshot;
+    # with overwrite = False an existing snapshot (e.g. saved meanwhile by another process) is kept.
+    # schedule: the settings (JSON values) that produced times and schedule_slots
+    tmp_path = f"{path.rstrip('/')}.tmp{os.getpid()}"
+    os.makedirs(tmp_path, exist_ok = True)
+    arrays = {field: getattr(market, field) for field in MARKET_FIELDS}
+    if times is not None:
+        arrays['times'] = times
+    if schedule_slots is not None:
+        arrays['schedule_slots'] = schedule_slots
+    if state is not None:
+        arrays.update({field: state[field] for field in STATE_FIELDS})
+    for name, values in arrays.items():
+        np.save(os.path.join(tmp_path, f"{name}.npy"), np.ascontiguousarray(values))
+
+    meta = {'format': FORMAT_VERSION,
+            'n_students': market.n_students,
+            'n_courses': market.n_courses,
+            'arrays': sorted(arrays)}
+    if schedule is not None:
+        meta['schedule'] = schedule
+    if rng_state is not None:
+        (name, keys, pos, has_gauss, cached_gaussian), py_state = rng_state
+        meta['np_random_state'] = [name, keys.tolist(), pos, has_gauss, cached_gaussian]
+        meta['random_state'] = [py_state[0], list(py_state[1]), py_state[2]]
+    # meta.json marks a complete snapshot, so it is only in place once fully written
+    with open(os.path.join(tmp_path, 'meta.json.tmp'), 'w') as f:
+        json.dump(meta, f)
+    os.replace(os.path.join(tmp_path, 'meta.json.tmp'), os.path.join(tmp_path, 'meta.json'))
+
+    if os.path.exists(path):
+        if not overwrite:
+            shutil.rmtree(tmp_path)
+            return path
+        shutil.rmtree(path)
+    try:
+        os.replace(tmp_path, path)
+    except OSError:
+        # another process renamed its snapshot into place first
+        if overwrite or not snapshot_exists(path):
+            raise
+        shutil.rmtree(tmp_path)
+    return path
+
+
+def snapshot_exists(path):
+    return os.path.exists(os.path.join(path, 'meta.json'))
+
+
+def load_snapshot(path, mmap_mode = 'r'):
+    # arrays are memory-mapped read-only by default: loading is O(1) and processes that load the
+    # same snapshot share its pages through the page cache (mmap_mode = None reads them into memory)
+    with open(os.path.join(path, 'meta.json')) as f:
+        meta = json.load(f)
+    arrays = {name: np.load(os.path.join(path, f"{name}.npy"), mmap_mode = mmap_mode)
+              for name in meta['arrays']}
+
+    market = Market(*[arrays[field] for field in MARKET_FIELDS])
+    state = None
+    if all(field in arrays for field in STATE_FIELDS):
+        state = {field: arrays[field] for field in STATE_FIELDS}
+    rng_state = None
+    if 'np_random_state' in meta:
+        name, keys, pos, has_gauss, cached_gaussian = meta['np_random_state']
+        version, internal, gauss_next = meta['random_state']
+        rng_state = ((name, np.array(keys, dtype = np.uint32), pos, has_gauss, cached_gaussian),
+                     (version, tuple(internal), gauss_next))
+    return Snapshot(market, times = arrays.get('times'), state = state, rng_state = rng_state,
+                    schedule = meta.get('schedule'), schedule_slots = arrays.get('schedule_slots'))
+
+
+def snapshot_objects(path, student_list, course_list, rng_state = None):
+    # snapshot of a market held as objects, with its time slots and matching state
+    return save_snapshot(path, Market.from_objects(student_list, course_list),
+                         times = course_times(course_list),
+                         state = capture_state(student_list, course_list),
+                         rng_state = rng_state)
@@ -0,0 +1,240 @@
+import os
+# one process per run: keep every worker's BLAS single-threaded (must be set before numpy loads)
+for _var in ['OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS']:
+    os.environ.setdefault(_var, '1')
+
+import argparse
+import json
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from itertools import product
+
+import numpy as np
+import pandas as pd
+
+from experiment import run_experiment, figure_suffix
+from plots import plot_histogram
+from simulate import generate_market
+from schedule import use_tree_cache
+from snapshot import capture_rng, save_snapshot, snapshot_exists, load_snapshot
+
+
+# columns identifying a run; a configuration already in the results file is not run again
+PARAMS = ['n_students', 'n_courses', 'n_depts', 'credit_limit', 'enroll_limit', 'n_slots',
+          'scheduler', 'engine', 'seed']
+STAGES = ['match', 'resolve', 'baseline']
+# per-run distributions, stored as list columns so the histograms can be drawn afterwards
+LIST_COLUMNS = [f'{kind}_{stage}' for kind in ['utility_counts', 'course_sizes'] for stage in STAGES]
+# columns identifying a generated market: runs differing only in slots, scheduler or engine share it
+MARKET_PARAMS = ['n_students', 'n_courses', 'n_depts', 'credit_limit', 'enroll_limit', 'seed']
+
+
+def parameter_grid(n_students = [5000], n_courses = [100], n_depts = [15], credit_limit = [4],
+                   enroll_limit = [80], n_slots = [12], scheduler = ['gomory_hu'], engine = ['array'],
+                   seed = [0]):
+    values = [n_students, n_courses, n_depts, credit_limit, enroll_limit, n_slots, scheduler, engine, seed]
+    return [dict(zip(PARAMS, config)) for config in product(*values)]
+
+
+def run_config(config, market_dir = None, tree_dir = None):
+    start = time.time()
+    if tree_dir is not None:
+        use_tree_cache(tree_dir)
+    snapshot = market_snapshot(config, market_dir) if market_dir is not None else None
+    results = run_experiment(**config, verbose = False, snapshot = snapshot)
+    return metrics_row(config, results, time.time() - start)
+
+
+def market_snapshot(config, market_dir):
+    # the market of a configuration, generated once and memory-mapped by every run that shares it
+    path = os.path.join(market_dir, '_'.join(f"{p}{config[p]}" for p in MARKET_PARAMS))
+    if not snapshot_exists(path):
+        market = generate_market(*[config[p] for p in MARKET_PARAMS[:-1]], seed = config['seed'])
+        save_snapshot(path, market, rng_state = capture_rng(), overwrite = False)
+    return load_snapshot(path)
+
+
+def metrics_row(config, results, runtime):
+    row = dict(config)
+    for stage in STAGES:
+        utilities = results['utilities'][stage]
+        course_sizes = results['course_sizes'][stage]
+        row[f'welfare_{stage}'] = float(np.mean(utilities))
+        row[f'course_size_mean_{stage}'] = float(course_sizes.mean())
+        row[f'course_size_min_{stage}'] = int(course_sizes.min())
+        row[f'course_size_max_{stage}'] = int(course_sizes.max())
+        row[f'utility_counts_{stage}'] = np.bincount(utilities).tolist()
+        row[f'course_sizes_{stage}'] = course_sizes.tolist()
+    row['welfare_gain'] = row['welfare_resolve'] - row['welfare_baseline']
+    row['n_conflicts'] = results['n_conflicts']
+    row['n_conflicts_baseline'] = results['n_conflicts_baseline']
+    row['runtime'] = runtime
+    return row
+
+# =============================================================================== #
+
+def has_parquet():
+    try:
+        pd.io.parquet.get_engine('auto')
+    except ImportError:
+        return False
+    return True
+
+
+def default_results_path():
+    # Parquet needs pyarrow or fastparquet; without them the same table is written as CSV
+    return "results/sweep.parquet" if has_parquet() else "results/sweep.csv"
+
+
+def read_results(path):
+    if not os.path.exists(path):
+        return pd.DataFrame(columns = PARAMS)
+    if path.endswith('.parquet'):
+        results = pd.read_parquet(path)
+        for column in LIST_COLUMNS:
+            results[column] = results[column].map(list)
+        return results
+    results = pd.read_csv(path)
+    for column in LIST_COLUMNS:
+        results[column] = results[column].map(json.loads)
+    return results
+
+
+def write_results(results, path):
+    os.makedirs(os.path.dirname(path) or '.', exist_ok = True)
+    tmp_path = path + '.tmp'
+    if path.endswith('.parquet'):
+        results.to_parquet(tmp_path, index = False)
+    else:
+        results = results.copy()
+        for column in LIST_COLUMNS:
+            results[column] = results[column].map(json.dumps)
+        results.to_csv(tmp_path, index = False)
+    os.replace(tmp_path, path)
+
+
+def run_keys(results):
+    return set(results[PARAMS].itertuples(index = False, name = None))
+
+
+def sweep(grid, results_path = None, max_workers = None, checkpoint = 30, market_dir = None, tree_dir = None,
+          verbose = True):
+    # run every configuration of the grid that is not in the results file yet, fanned out over
+    # a process pool; the file is rewritten every `checkpoint` seconds and at the end.
+    # With market_dir, markets are cached there as snapshots (see market_snapshot); with
+    # tree_dir, Gomory-Hu trees (runs differing only in n_slots share their conflict graph)
+    results_path = results_path or default_results_path()
+    results = read_results(results_path)
+    done = run_keys(results)
+    todo = [config for config in grid if tuple(config[p] for p in PARAMS) not in done]
+    if verbose:
+        print(f"{len(grid) - len(todo)} of {len(grid)} runs already in {results_path}")
+    if not todo:
+        return results
+
+    rows = []
+    last_write = time.time()
+    with ProcessPoolExecutor(max_workers = max_workers) as pool:
+        futures = {pool.submit(run_config, config, market_dir, tree_dir): config for config in todo}
+        for i, future in enumerate(as_completed(futures)):
+            config = futures[future]
+            try:
+                rows.append(future.result())
+            except Exception as e:
+                print(f"run {config} failed: {e!r}")
+                continue
+            if verbose:
+                print(f"[{i + 1}/{len(todo)}] {config} welfare gain {rows[-1]['welfare_gain']:.2f} "
+                      f"({rows[-1]['runtime']:.1f}s)")
+            if time.time() - last_write > checkpoint:
+                write_results(append_rows(results, rows), results_path)
+                last_write = time.time()
+
+    results = append_rows(results, rows)
+    write_results(results, results_path)
+    return results
+
+
+def append_rows(results, rows):
+    if len(results) == 0:
+        return pd.DataFrame(rows)
+    return pd.concat([results, pd.DataFrame(rows)], ignore_index = True)
+
+# =============================================================================== #
+
+def render_figures(results, fig_dir = "results/fig"):
+    # per-configuration histograms (pooled over seeds, same file names as experiment.py) and
+    # welfare gain / conflicts against every swept parameter
+    import matplotlib.pyplot as plt
+    import seaborn as sns
+    os.makedirs(fig_dir, exist_ok = True)
+    configs = [p for p in PARAMS if p not in ('seed', 'engine')]
+    for key, runs in results.groupby(configs):
+        config = dict(zip(configs, key))
+        suffix = figure_suffix(*[config[p] for p in PARAMS[:6]])
+        if config['scheduler'] != 'gomory_hu':
+            suffix += f"_{config['scheduler']}"
+        for stage in STAGES:
+            counts = sum_counts(runs[f'utility_counts_{stage}'])
+            utilities = np.repeat(np.arange(len(counts)), counts)
+            plot_histogram(utilities, "Student utiltities", f"{fig_dir}/utils_{stage}_{suffix}")
+            sizes = np.concatenate([np.asarray(s) for s in runs[f'course_sizes_{stage}']])
+            plot_histogram(sizes, "Course sizes", f"{fig_dir}/csizes_{stage}_{suffix}")
+
+    swept = [p for p in PARAMS[:6] if results[p].nunique() > 1]
+    hue = 'scheduler' if results['scheduler'].nunique() > 1 else None
+    for param in swept:
+        for metric in ['welfare_gain', 'n_conflicts']:
+            plt.clf()
+            sns.lineplot(data = results, x = param, y = metric, hue = hue, marker = 'o')
+            plt.savefig(f"{fig_dir}/sweep_{metric}_{param}")
+
+
+def sum_counts(counts):
+    total = np.zeros(max(len(c) for c in counts), dtype = np.int64)
+    for c in counts:
+        total[:len(c)] += c
+    return total
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = 'Run experiment.py over a grid of parameters and seeds')
+    parser.add_argument('--n_students', type = int, nargs = '+', default = [5000])
+    parser.add_argument('--n_courses', type = int, nargs = '+', default = [100])
+    parser.add_argument('--n_depts', type = int, nargs = '+', default = [15])
+    parser.add_argument('--credit_limit', type = int, nargs = '+', default = [4])
+    parser.add_argument('--enroll_limit', type = int, nargs = '+', default = [80])
+    parser.add_argument('--n_slots', type = int, nargs = '+', default = [12])
+    parser.add_argument('--scheduler', nargs = '+', choices = ['gomory_hu', 'greedy', 'spectral'],
+                        default = ['gomory_hu'])
+    parser.add_argument('--engine', nargs = '+', choices = ['array', 'object'], default = ['array'])
+    parser.add_argument('--seeds', type = int, nargs = '+', default = [0],
+                        help = 'Seeds to run for every configuration')
+    parser.add_argument('--workers', type = int, default = None,
+                        help = 'Worker processes (default: one per CPU)')
+    parser.add_argument('--results', default = None,
+                        help = 'Results file, .parquet or .csv (default: results/sweep.parquet if available)')
+    parser.add_argument('--market_dir', default = "results/markets",
+                        help = 'Cache of generated markets shared across slots, schedulers and engines')
+    parser.add_argument('--no_market_cache', action = 'store_true', help = 'Generate every market in its run')
+    parser.add_argument('--tree_dir', default = "results/cut_trees",
+                        help = 'Cache of Gomory-Hu trees shared across slot counts')
+    parser.add_argument('--no_tree_cache', action = 'store_true', help = 'Compute the tree in every run')
+    parser.add_argument('--fig_dir', default = "results/fig")
+    parser.add_argument('--no_figures', action = 'store_true', help = 'Only compute and store the runs')
+    parser.add_argument('--figures_only', action = 'store_true', help = 'Only render figures from stored runs')
+    args = parser.parse_args()
+
+    results_path = args.results or default_results_path()
+    if args.figures_only:
+        results = read_results(results_path)
+    else:
+        grid = parameter_grid(n_students = args.n_students, n_courses = args.n_courses, n_depts = args.n_depts,
+                              credit_limit = args.credit_limit, enroll_limit = args.enroll_limit,
+                              n_slots = args.n_slots, scheduler = args.scheduler, engine = args.engine,
+                              seed = args.seeds)
+        results = sweep(grid, results_path = results_path, max_workers = args.workers,
+                        market_dir = None if args.no_market_cache else args.market_dir,
+                        tree_dir = None if args.no_tree_cache else args.tree_dir)
+    if not args.no_figures:
+        render_figures(results, fig_dir = args.fig_dir)
@@ -0,0 +1,32 @@
+import pytest
+
+from agent import Student, CompactStudent
+
+
+@pytest.mark.parametrize('student_class', [Student, CompactStudent])
+def test_course_prefs_are_read_only(student_class):
+    s = student_class(0, 4, course_prefs = [2, 0, 3, 1])
+    with pytest.raises((TypeError, AttributeError)):
+        s.course_prefs[0] = 1
+    with pytest.raises(ValueError):
+        s.course_ranks[0] = 1
+    # assigning a new list rebuilds the ranks
+    s.course_prefs = [1, 3, 0, 2]
+    assert list(s.course_ranks) == [2, 0, 3, 1]
+    assert s.get_utilities_from_courses([1, 3]) == 4 + 3
+
+
+def test_default_classes_keep_ad_hoc_attributes():
+    from simulate import generate_data
+    student_list, course_list = generate_data(5, 3, seed = 0)
+    student_list[0].note = 'transfer'
+    course_list[0].room = 'A1'
+    assert (student_list[0].note, course_list[0].room) == ('transfer', 'A1')
+
+
+def test_compact_course_only_slots_what_it_fills():
+    from agent import CompactCourse
+    from simulate import generate_data
+    student_list, course_list = generate_data(5, 3, seed = 0, compact = True)
+    assert 'student_prefs' not in CompactCourse.__slots__
+    assert [s.student_id for s in course_list[0].student_prefs] == course_list[0].student_ids.tolist()
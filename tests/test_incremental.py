@@ -0,0 +1,65 @@
+import numpy as np
+import pytest
+
+from agent import Student, Course, CompactStudent
+from incremental import IncrementalMatching
+from matching import find_matching
+from simulate import generate_market
+from tests.test_matching import enrollments, truncated_objects
+
+
+def fresh_matching(incremental, withdrawn):
+    # find_matching from scratch on copies of the current market (withdrawn students rank nothing)
+    n_courses = len(incremental.course_list)
+    student_list = [Student(s.student_id, n_courses, s.year, s.dept, s.credit_limit,
+                            course_prefs = [] if s.student_id in withdrawn else list(s.course_prefs))
+                    for s in incremental.student_list]
+    course_list = [Course(c.course_id, [], c.dept, c.enroll_limit,
+                          student_prefs = [student_list[s] for s in np.asarray(c.get_student_ids()).tolist()])
+                   for c in incremental.course_list]
+    return enrollments(*find_matching(student_list, course_list))
+
+
+@pytest.mark.parametrize('seed', range(6))
+@pytest.mark.parametrize('compact', [False, True])
+def test_random_edits_match_fresh_find_matching(seed, compact):
+    n_courses = 8
+    market = generate_market(120, n_courses, 3, 3, 15, seed = seed)
+    incremental = IncrementalMatching(*market.to_objects(compact = compact))
+    student_class = CompactStudent if compact else Student
+    rng = np.random.default_rng(seed)
+    withdrawn = set()
+    for _ in range(12):
+        for _ in range(rng.integers(1, 6)):
+            edit = rng.choice(['add', 'withdraw', 'limit', 'prefs'])
+            student_id = int(rng.integers(len(incremental.student_list)))
+            if edit == 'add':
+                incremental.add_student(student_class(len(incremental.student_list), n_courses,
+                                                      int(rng.integers(4)), int(rng.integers(3)), 3,
+                                                      course_prefs = rng.permutation(n_courses).tolist()))
+            elif edit == 'withdraw':
+                incremental.withdraw_student(student_id)
+                withdrawn.add(student_id)
+            elif edit == 'limit':
+                incremental.set_enroll_limit(int(rng.integers(n_courses)), int(rng.integers(5, 25)))
+            else:
+                incremental.update_preferences(student_id, rng.permutation(n_courses).tolist())
+                withdrawn.discard(student_id)
+        incremental.update()
+
+        assert enrollments(incremental.student_list, incremental.course_list) == \
+            fresh_matching(incremental, withdrawn)
+        students, courses = incremental.matching()
+        expected_students, expected_courses, _, _ = incremental.rematch()
+        assert sorted(zip(students.tolist(), courses.tolist())) == \
+            sorted(zip(expected_students.tolist(), expected_courses.tolist()))
+
+
+def test_truncated_lists_are_rejected():
+    with pytest.raises(ValueError):
+        IncrementalMatching(*truncated_objects(20, 5, seed = 0))
+    incremental = IncrementalMatching(*generate_market(20, 5, 2, 2, 5, seed = 0).to_objects())
+    with pytest.raises(ValueError):
+        incremental.update_preferences(0, [1, 0])
+    with pytest.raises(ValueError):
+        incremental.add_student(Student(20, 5, course_prefs = [0, 1, 2, 3, 3]))
@@ -0,0 +1,99 @@
+import numpy as np
+import pytest
+
+from agent import Student, Course, CompactStudent, CompactCourse
+from matching import (find_matching, find_matching_fast, resolve_conflicts, determine_conflicts_fast,
+                      resolve_conflicts_fast)
+from schedule import assign_times
+from simulate import generate_market
+
+
+def enrollments(student_list, course_list):
+    # rosters as sets: find_matching keeps arrival order in a course that never filled up,
+    # the array engines keep priority order
+    return ([sorted(s.course_enroll) for s in student_list],
+            [sorted(s.student_id for s in c.student_enroll) for c in course_list])
+
+
+def truncated_objects(n_students, n_courses, seed, compact = False, enroll_limit = 3, credit_limit = 3):
+    # students listing a few courses each, courses ranking a random subset of the students
+    rng = np.random.default_rng(seed)
+    student_class, course_class = (CompactStudent, CompactCourse) if compact else (Student, Course)
+    student_list = [student_class(i, n_courses, int(rng.integers(4)), int(rng.integers(3)), credit_limit,
+                                  course_prefs = rng.permutation(n_courses)[: rng.integers(0, n_courses + 1)].tolist())
+                    for i in range(n_students)]
+    course_list = []
+    for c in range(n_courses):
+        ranked = rng.permutation(n_students)[: rng.integers(n_students // 2, n_students + 1)]
+        prefs = ranked if compact else [student_list[s] for s in ranked.tolist()]
+        course_list.append(course_class(c, student_list if compact else [], int(rng.integers(3)), enroll_limit,
+                                        student_prefs = prefs))
+    return student_list, course_list
+
+
+def tight_market(seed):
+    # as many seats as credits (60 x 2 = 12 x 10): every seat is contested at the limit
+    return generate_market(60, 12, 3, 2, 10, seed = seed)
+
+
+def markets(seed):
+    # (label, builder of a fresh object market)
+    full = generate_market(300, 20, 4, 4, 25, seed = seed)
+    tight = tight_market(seed)
+    return [('full', lambda compact: full.to_objects(compact = compact)),
+            ('capacity', lambda compact: tight.to_objects(compact = compact)),
+            ('truncated', lambda compact: truncated_objects(80, 15, seed, compact = compact))]
+
+
+def resolved_objects(student_list, course_list, slots, engine, n_workers = None):
+    assign_times(course_list, slots)
+    if engine == 'object':
+        for s in student_list:
+            s.determine_conflicts(course_list)
+        return resolve_conflicts(student_list, course_list)
+    student_list, course_list = determine_conflicts_fast(student_list, course_list)
+    return resolve_conflicts_fast(student_list, course_list, n_workers = n_workers)
+
+# =============================================================================== #
+
+@pytest.mark.parametrize('seed', [0, 1, 2, 3])
+@pytest.mark.parametrize('compact', [False, True])
+def test_find_matching_fast_matches_objects(seed, compact):
+    for label, build in markets(seed):
+        reference = find_matching(*build(False))
+        fast = find_matching_fast(*build(compact))
+        assert enrollments(*fast) == enrollments(*reference), label
+        assert [s.current_course_propose for s in fast[0]] == [s.current_course_propose for s in reference[0]]
+        assert [s.eligible for s in fast[0]] == [s.eligible for s in reference[0]]
+
+
+@pytest.mark.parametrize('seed', [0, 1, 2, 3])
+def test_resolve_conflicts_fast_matches_objects(seed):
+    for label, build in markets(seed):
+        n_courses = len(build(False)[1])
+        slots = np.random.default_rng(seed).integers(4, size = n_courses)
+        reference = resolved_objects(*find_matching(*build(False)), slots, 'object')
+        fast = resolved_objects(*find_matching_fast(*build(True)), slots, 'array')
+        assert enrollments(*fast) == enrollments(*reference), label
+
+
+def test_capacity_is_filled_exactly():
+    # seats equal credits and every list is complete: every course ends full
+    student_list, course_list = find_matching_fast(*tight_market(0).to_objects())
+    assert all(len(c.student_enroll) == c.enroll_limit for c in course_list)
+    assert all(len(s.course_enroll) == s.credit_limit for s in student_list)
+
+
+def test_single_seat_goes_to_top_priority():
+    # every student proposes to course 0 first; each one-seat course keeps its most preferred student
+    order = [3, 5, 0, 1, 2, 4]
+
+    def build():
+        student_list = [Student(i, 2, credit_limit = 1, course_prefs = [0, 1]) for i in range(len(order))]
+        course_list = [Course(0, [], 0, 1, student_prefs = [student_list[s] for s in order]),
+                       Course(1, [], 0, 1, student_prefs = [student_list[s] for s in order[::-1]])]
+        return student_list, course_list
+
+    fast = enrollments(*find_matching_fast(*build()))
+    assert fast == enrollments(*find_matching(*build()))
+    assert fast[1] == [[3], [4]]
@@ -0,0 +1,58 @@
+import numpy as np
+import pytest
+
+from market import SparseRanks
+from matching import deferred_acceptance, find_matching_fast, preference_arrays, preference_lengths
+from parallel import deferred_acceptance_parallel, department_shards
+from simulate import generate_market
+from tests.test_matching import enrollments, resolved_objects, truncated_objects
+
+# 4 departments in both markets: 6 workers is more shards than departments
+WORKERS = [1, 2, 6]
+
+
+def dense_objects(seed):
+    return generate_market(300, 20, 4, 4, 25, seed = seed).to_objects()
+
+
+def sparse_objects(seed):
+    return truncated_objects(80, 15, seed)
+
+
+MARKETS = {'dense': dense_objects, 'truncated': sparse_objects}
+
+# =============================================================================== #
+
+@pytest.mark.parametrize('n_workers', WORKERS)
+@pytest.mark.parametrize('label', sorted(MARKETS))
+def test_parallel_rounds_match_serial(label, n_workers):
+    student_list, course_list = MARKETS[label](0)
+    course_prefs, priority_ranks, enroll_limits, credit_limits = preference_arrays(student_list, course_list)
+    assert isinstance(priority_ranks, SparseRanks) == (label == 'truncated')
+    pref_lengths = preference_lengths(student_list)
+    student_shards, course_shards = department_shards([s.dept for s in student_list],
+                                                      [c.dept for c in course_list], n_workers)
+    assert student_shards.max() + 1 == min(n_workers, len({s.dept for s in student_list}))
+
+    expected = deferred_acceptance(course_prefs, priority_ranks, enroll_limits, credit_limits,
+                                   pref_lengths = pref_lengths)
+    result = deferred_acceptance_parallel(course_prefs, priority_ranks, enroll_limits, credit_limits,
+                                          student_shards, course_shards, pref_lengths = pref_lengths)
+    assert sorted(zip(result[0].tolist(), result[1].tolist())) == sorted(zip(expected[0].tolist(),
+                                                                             expected[1].tolist()))
+    assert np.array_equal(result[2], expected[2]) and np.array_equal(result[3], expected[3])
+
+
+@pytest.mark.parametrize('n_workers', WORKERS)
+@pytest.mark.parametrize('label', sorted(MARKETS))
+def test_parallel_engine_matches_serial(label, n_workers):
+    build = MARKETS[label]
+    serial = find_matching_fast(*build(1))
+    parallel = find_matching_fast(*build(1), n_workers = n_workers)
+    assert enrollments(*parallel) == enrollments(*serial)
+    assert [s.current_course_propose for s in parallel[0]] == [s.current_course_propose for s in serial[0]]
+    assert [s.eligible for s in parallel[0]] == [s.eligible for s in serial[0]]
+
+    slots = np.random.default_rng(1).integers(4, size = len(serial[1]))
+    expected = resolved_objects(*serial, slots, 'array')
+    assert enrollments(*resolved_objects(*parallel, slots, 'array', n_workers = n_workers)) == enrollments(*expected)
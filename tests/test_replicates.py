@@ -0,0 +1,50 @@
+import numpy as np
+import pytest
+
+from market import enrollment_matrix
+from matching import deferred_acceptance, resolve_pairs
+from replicates import STAGES, generate_markets, run_replicates
+from schedule import SCHEDULERS, conflict_matrix, conflict_nodes, count_conflicts
+
+SIZES = {'n_students': 200, 'n_courses': 15, 'n_depts': 3, 'credit_limit': 3, 'enroll_limit': 30}
+N_SLOTS = 4
+
+
+def utilities_of(students, courses, market):
+    ranks = market.course_ranks[students, courses]
+    return np.bincount(students, weights = market.n_courses - ranks, minlength = market.n_students).astype(np.int64)
+
+
+def single_market_results(market, scheduler, seed):
+    # the stages of run_replicates on one market alone
+    held_students, held_courses, _, _ = deferred_acceptance(market.course_prefs, market.priority_ranks,
+                                                            market.enroll_limits, market.credit_limits)
+    matched = enrollment_matrix(held_students, held_courses, market.n_students, market.n_courses).tocsr()
+    conflicts = conflict_matrix(matched)
+    nodes = conflict_nodes(matched) if scheduler == 'gomory_hu' else None
+    slots = SCHEDULERS[scheduler](conflicts, N_SLOTS, nodes, seed)
+    n_conflicts = count_conflicts(conflicts, slots)
+    resolved = resolve_pairs(matched, np.where(slots >= 0, slots, N_SLOTS), market.course_prefs,
+                             market.course_ranks, market.priority_ranks, market.enroll_limits, market.credit_limits)
+    index_order = np.broadcast_to(np.arange(market.n_courses, dtype = np.int32), market.course_prefs.shape)
+    baseline = deferred_acceptance(index_order, market.priority_ranks, market.enroll_limits,
+                                   market.credit_limits)[:2]
+    pairs = {'match': (held_students, held_courses), 'resolve': resolved, 'baseline': baseline}
+    return {'utilities': {stage: utilities_of(*pairs[stage], market) for stage in pairs},
+            'course_sizes': {stage: np.bincount(pairs[stage][1], minlength = market.n_courses) for stage in pairs},
+            'n_conflicts': n_conflicts}
+
+# =============================================================================== #
+
+@pytest.mark.parametrize('scheduler', ['gomory_hu', 'greedy'])
+@pytest.mark.parametrize('seed', [0, 1])
+def test_replicate_blocks_match_single_markets(seed, scheduler):
+    results = run_replicates(3, n_slots = N_SLOTS, seed = seed, scheduler = scheduler, verbose = False, **SIZES)
+    # run_replicates draws its markets first, from the same seed
+    batch = generate_markets(3, seed = seed, **SIZES)
+    for r in range(3):
+        expected = single_market_results(batch.market(r), scheduler, seed)
+        for stage in STAGES:
+            assert np.array_equal(results['utilities'][stage][r], expected['utilities'][stage]), (r, stage)
+            assert np.array_equal(results['course_sizes'][stage][r], expected['course_sizes'][stage]), (r, stage)
+        assert results['n_conflicts'][r] == expected['n_conflicts'], r
@@ -0,0 +1,193 @@
+import os
+from collections import defaultdict
+from itertools import combinations
+
+import numpy as np
+import pytest
+import scipy.sparse as sp
+
+from schedule import (CutTreeCache, SlotSearch, conflict_matrix, conflict_nodes, count_conflicts, gomory_hu_partitions,
+                      gomory_hu_slots, slot_weight_matrix)
+
+
+def random_conflicts(seed, n_students = 60, n_courses = 15, per_student = 3):
+    rng = np.random.default_rng(seed)
+    rows = np.repeat(np.arange(n_students), per_student)
+    cols = np.concatenate([rng.choice(n_courses, per_student, replace = False) for _ in range(n_students)])
+    enrollment = sp.csr_matrix((np.ones(len(rows), dtype = np.int64), (rows, cols)),
+                               shape = (n_students, n_courses))
+    return conflict_matrix(enrollment)
+
+
+def enrollment_from_lists(course_lists, n_courses):
+    rows = np.repeat(np.arange(len(course_lists)), [len(courses) for courses in course_lists])
+    cols = np.array([c for courses in course_lists for c in courses], dtype = np.int64)
+    return sp.csr_matrix((np.ones(len(rows), dtype = np.int64), (rows, cols)), shape = (len(course_lists), n_courses))
+
+
+def networkx_slots(course_lists, n_courses, n_slots):
+    # the original scheduling code of experiment.py (networkx Gomory-Hu k-cut); courses outside
+    # the conflict graph get slot -1
+    nx = pytest.importorskip('networkx')
+    conflict_counts = defaultdict(int)
+    for courses in course_lists:
+        for c1, c2 in combinations(sorted(courses), 2):
+            conflict_counts[(c1, c2)] += 1
+    graph = nx.Graph()
+    graph.add_weighted_edges_from([(c[0], c[1], n * (-1) + max(conflict_counts.values()))
+                                   for c, n in conflict_counts.items()])
+    T = nx.gomory_hu_tree(graph, capacity = 'weight')
+    min_weight_k_edges = sorted([e for e in T.edges(data = True)], key = lambda x: x[2]['weight'])[: n_slots - 1]
+    T.remove_edges_from(min_weight_k_edges)
+    slots = np.full(n_courses, -1)
+    for t, comp in enumerate(nx.connected_components(T)):
+        slots[list(comp)] = t
+    return slots
+
+
+def random_course_lists(seed, n_students, courses, per_student = 3):
+    rng = np.random.default_rng(seed)
+    return [rng.choice(courses, per_student, replace = False).tolist() for _ in range(n_students)]
+
+
+def conflict_graphs(seed):
+    # (label, course lists, n_courses)
+    rng = np.random.default_rng(seed)
+    connected = random_course_lists(seed, 60, np.arange(15))
+    # courses 15-19 taken alone or by nobody
+    isolated = random_course_lists(seed, 60, np.arange(15)) + [[15], [17], [17]]
+    # two groups of students on disjoint courses
+    disconnected = (random_course_lists(seed, 30, np.arange(8)) +
+                    random_course_lists(seed + 1, 30, np.arange(8, 16)))
+    return [('connected', connected, 15), ('isolated', isolated, 20), ('disconnected', disconnected, 16),
+            ('sparse', [rng.choice(20, 2, replace = False).tolist() for _ in range(12)], 20)]
+
+# =============================================================================== #
+
+def test_cache_hits_and_misses():
+    cache = CutTreeCache()
+    first = gomory_hu_slots(random_conflicts(0), 4, cache = cache)
+    assert (cache.hits, cache.misses) == (0, 1)
+    # same graph with another slot count reuses the tree
+    gomory_hu_slots(random_conflicts(0), 6, cache = cache)
+    assert (cache.hits, cache.misses) == (1, 1)
+    assert np.array_equal(gomory_hu_slots(random_conflicts(0), 4, cache = cache), first)
+    gomory_hu_slots(random_conflicts(1), 4, cache = cache)
+    assert (cache.hits, cache.misses) == (2, 2)
+    assert len(cache.trees) == 2
+
+
+def test_cache_evicts_least_recently_used():
+    cache = CutTreeCache(max_entries = 2)
+    for seed in [0, 1]:
+        gomory_hu_slots(random_conflicts(seed), 4, cache = cache)
+    gomory_hu_slots(random_conflicts(0), 4, cache = cache)
+    gomory_hu_slots(random_conflicts(2), 4, cache = cache)
+    assert len(cache.trees) == 2 and cache.misses == 3
+    # seed 1 was the least recently used and is rebuilt, seed 0 is still cached
+    gomory_hu_slots(random_conflicts(0), 4, cache = cache)
+    assert cache.misses == 3
+    gomory_hu_slots(random_conflicts(1), 4, cache = cache)
+    assert cache.misses == 4
+
+
+def test_cache_reloads_from_directory(tmp_path):
+    cache_dir = str(tmp_path / 'trees')
+    expected = gomory_hu_slots(random_conflicts(0), 5, cache = CutTreeCache(cache_dir))
+    files = os.listdir(cache_dir)
+    assert len(files) == 1 and files[0].endswith('.npy')
+
+    cache = CutTreeCache(cache_dir)
+    assert np.array_equal(gomory_hu_slots(random_conflicts(0), 5, cache = cache), expected)
+    assert (cache.disk_hits, cache.misses) == (1, 0)
+    gomory_hu_slots(random_conflicts(0), 5, cache = cache)
+    assert (cache.hits, cache.disk_hits) == (1, 1)
+
+
+@pytest.mark.parametrize('seed', [0, 1, 2])
+def test_partitions_match_separate_calls(seed):
+    conflicts = random_conflicts(seed)
+    slot_counts = [2, 4, 7, 30]
+    partitions = gomory_hu_partitions(conflicts, slot_counts, cache = CutTreeCache())
+    assert sorted(partitions) == slot_counts
+    for n_slots in slot_counts:
+        assert np.array_equal(partitions[n_slots], gomory_hu_slots(conflicts, n_slots, cache = CutTreeCache()))
+
+
+@pytest.mark.parametrize('seed', [0, 1, 2, 3])
+@pytest.mark.parametrize('n_slots', [2, 4, 6])
+def test_gomory_hu_slots_match_networkx(seed, n_slots):
+    for label, course_lists, n_courses in conflict_graphs(seed):
+        enrollment = enrollment_from_lists(course_lists, n_courses)
+        slots = gomory_hu_slots(conflict_matrix(enrollment), n_slots, nodes = conflict_nodes(enrollment),
+                                cache = CutTreeCache())
+        assert np.array_equal(slots, networkx_slots(course_lists, n_courses, n_slots)), label
+        if label == 'isolated':
+            assert (slots[15:] == -1).all()
+
+
+
+def random_search(seed, n_slots = 5):
+    # courses 15-17 have no slot
+    conflicts = random_conflicts(seed, n_courses = 18)
+    slots = np.random.default_rng(seed).integers(n_slots, size = 18)
+    slots[15:] = -1
+    return SlotSearch(conflicts, slots, n_slots)
+
+
+@pytest.mark.parametrize('seed', [0, 1, 2])
+def test_slot_search_stays_consistent(seed):
+    search = random_search(seed)
+    rng = np.random.default_rng(seed)
+    for step in range(200):
+        c, d = rng.choice(15, 2, replace = False).tolist()
+        if step % 3:
+            search.move(c, int(rng.integers(search.n_slots)))
+        else:
+            search.swap(c, d)
+        if step % 20:
+            continue
+        assert np.array_equal(search.weights, slot_weight_matrix(search.conflicts, search.slots, search.n_slots))
+        assert search.cost == count_conflicts(search.conflicts, search.slots)
+        # every delta against a full recompute
+        for c in range(15):
+            for t in range(search.n_slots):
+                moved = search.slots.copy()
+                moved[c] = t
+                assert search.move_delta(c, t) == count_conflicts(search.conflicts, moved) - search.cost
+            for d in range(15):
+                if search.slots[c] != search.slots[d]:
+                    swapped = search.slots.copy()
+                    swapped[[c, d]] = swapped[[d, c]]
+                    assert search.swap_delta(c, d) == count_conflicts(search.conflicts, swapped) - search.cost
+    assert (search.slots[15:] == -1).all()
+
+
+@pytest.mark.parametrize('seed', [0, 1, 2])
+def test_descend_never_increases_conflicts(seed):
+    search = random_search(seed)
+    costs = [search.cost]
+    move = search.move
+
+    def recorded_move(c, t):
+        move(c, t)
+        costs.append(search.cost)
+    search.move = recorded_move
+    search.descend()
+    assert len(costs) > 1
+    assert all(after < before for before, after in zip(costs, costs[1:]))
+    assert search.cost == count_conflicts(search.conflicts, search.slots)
+    # a local minimum: no single move helps
+    for c in range(15):
+        assert all(search.move_delta(c, t) >= 0 for t in range(search.n_slots))
+
+
+@pytest.mark.parametrize('seed', [0, 1])
+def test_anneal_ends_consistent(seed):
+    search = random_search(seed)
+    start = search.cost
+    search.anneal(5000, seed = seed, chunk_size = 1000)
+    assert search.cost <= start
+    assert search.cost == count_conflicts(search.conflicts, search.slots)
+    assert np.array_equal(search.weights, slot_weight_matrix(search.conflicts, search.slots, search.n_slots))
+    assert (search.slots[15:] == -1).all()
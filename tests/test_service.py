@@ -0,0 +1,118 @@
+import asyncio
+import json
+
+import numpy as np
+import pytest
+
+import service
+from service import EnrollmentService
+from simulate import generate_market
+
+
+def run(scenario, batch_interval = 0.05, **market_args):
+    # scenario(service, ask) on a thread-executor service over a TCP connection; ask(request)
+    # sends one line and returns the decoded response
+    async def main():
+        market = generate_market(**{'n_students': 200, 'n_courses': 10, 'n_depts': 3, 'credit_limit': 3,
+                                    'enroll_limit': 30, 'seed': 0, **market_args})
+        enrollment = await EnrollmentService(market, batch_interval = batch_interval, executor = 'thread').start()
+        server = await enrollment.serve('127.0.0.1', 0)
+        reader, writer = await asyncio.open_connection(*server.sockets[0].getsockname()[:2])
+
+        async def ask(request):
+            writer.write((request if isinstance(request, str) else json.dumps(request)).encode() + b'\n')
+            return json.loads(await reader.readline())
+
+        try:
+            return await scenario(enrollment, ask)
+        finally:
+            writer.close()
+            server.close()
+            await enrollment.stop()
+    return asyncio.run(main())
+
+
+def served_pairs(index, n_students, n_courses):
+    by_student = {(s, c) for s in range(n_students) for c in index.courses_of(s)}
+    by_course = {(s, c) for c in range(n_courses) for s in index.students_of(c)}
+    assert by_student == by_course
+    return by_student
+
+# =============================================================================== #
+
+def test_queries_and_errors():
+    async def scenario(enrollment, ask):
+        courses = await ask({'op': 'courses', 'student': 4})
+        assert courses['ok'] and courses['round'] == 0
+        roster = await ask({'op': 'roster', 'course': 2})
+        assert roster['ok'] and all(isinstance(s, int) for s in roster['students'])
+        assert (await ask({'op': 'stats'}))['rounds'] == 1
+
+        bad_requests = [{'op': 'courses', 'student': 200}, {'op': 'courses', 'student': True},
+                        {'op': 'roster', 'course': 2.0}, {'op': 'nope'}, 'not json', '[1, 2]',
+                        {'op': 'submit', 'student': 1, 'prefs': [1, 0]},
+                        {'op': 'submit', 'student': 1, 'prefs': [0] * 10},
+                        {'op': 'submit', 'student': 1, 'prefs': [0.7, 1.2] + list(range(2, 10))},
+                        {'op': 'submit', 'student': 1, 'prefs': [2 ** 31] + list(range(1, 10))},
+                        {'op': 'submit', 'student': 1, 'prefs': [False, True] + list(range(2, 10))},
+                        {'op': 'submit', 'student': 1, 'prefs': 'abc'}]
+        for request in bad_requests:
+            response = await ask(request)
+            assert response['ok'] is False and response['error'], request
+        # the connection is still served and nothing was queued
+        assert (await ask({'op': 'stats'}))['submissions'] == 0
+    run(scenario)
+
+
+def test_submissions_are_coalesced_into_one_round():
+    async def scenario(enrollment, ask):
+        rng = np.random.default_rng(0)
+        first, last = rng.permutation(10).tolist(), rng.permutation(10).tolist()
+        other = rng.permutation(10).tolist()
+        assert (await ask({'op': 'submit', 'student': 5, 'prefs': first}))['round'] == 1
+        assert (await ask({'op': 'submit', 'student': 6, 'prefs': other}))['round'] == 1
+        response = await ask({'op': 'submit', 'student': 5, 'prefs': last, 'wait': True})
+        assert response == {'ok': True, 'round': 1}
+
+        stats = await ask({'op': 'stats'})
+        assert (stats['round'], stats['rounds'], stats['submissions'], stats['coalesced']) == (1, 2, 3, 1)
+        engine = service._engine
+        assert list(engine.student_list[5].course_prefs) == last
+        assert list(engine.student_list[6].course_prefs) == other
+        # the served index is the incremental matching, which equals a from-scratch one
+        students, courses, _, _ = engine.rematch()
+        assert served_pairs(enrollment.front, 200, 10) == set(zip(students.tolist(), courses.tolist()))
+        assert set(enrollment.front.courses_of(5)) == set((await ask({'op': 'courses', 'student': 5}))['courses'])
+    run(scenario)
+
+
+def test_failed_round_fails_waiters_and_rejects_submissions(monkeypatch):
+    def broken_round(round_id, edits):
+        raise RuntimeError("engine bug")
+
+    async def scenario(enrollment, ask):
+        before = (await ask({'op': 'courses', 'student': 3}))['courses']
+        monkeypatch.setattr(service, '_engine_round', broken_round)
+        response = await asyncio.wait_for(ask({'op': 'submit', 'student': 3, 'prefs': list(range(10)),
+                                               'wait': True}), 5)
+        assert response['ok'] is False and 'round 1 failed' in response['error']
+        response = await ask({'op': 'submit', 'student': 4, 'prefs': list(range(10))})
+        assert response['ok'] is False
+        stats = await ask({'op': 'stats'})
+        assert stats['error'] and stats['round'] == 0
+        # queries keep reading the last committed matching
+        assert (await ask({'op': 'courses', 'student': 3}))['courses'] == before
+    run(scenario)
+
+
+def test_stop_cancels_waiting_submissions():
+    async def main():
+        enrollment = await EnrollmentService(generate_market(50, 5, 2, 2, 20, seed = 0), batch_interval = 60,
+                                             executor = 'thread').start()
+        round_id = enrollment.submit(1, list(range(5)))
+        waiter = asyncio.ensure_future(enrollment.committed(round_id))
+        await asyncio.sleep(0)
+        await enrollment.stop()
+        with pytest.raises(asyncio.CancelledError):
+            await waiter
+    asyncio.run(main())
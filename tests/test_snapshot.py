@@ -0,0 +1,66 @@
+import json
+import os
+
+import numpy as np
+import pytest
+
+from experiment import run_experiment
+from simulate import generate_market
+from snapshot import MARKET_FIELDS, load_snapshot, save_snapshot, snapshot_exists
+
+SIZES = {'n_students': 300, 'n_courses': 20, 'n_depts': 4, 'credit_limit': 3, 'enroll_limit': 30}
+
+
+def assert_same_results(results, expected):
+    assert results['n_conflicts'] == expected['n_conflicts']
+    assert results['n_conflicts_baseline'] == expected['n_conflicts_baseline']
+    for stage in expected['utilities']:
+        assert np.array_equal(results['utilities'][stage], expected['utilities'][stage]), stage
+        assert np.array_equal(results['course_sizes'][stage], expected['course_sizes'][stage]), stage
+
+
+def test_market_round_trip(tmp_path):
+    market = generate_market(seed = 0, **SIZES)
+    save_snapshot(str(tmp_path / 'snap'), market)
+    loaded = load_snapshot(str(tmp_path / 'snap')).market
+    for field in MARKET_FIELDS:
+        assert np.array_equal(getattr(loaded, field), getattr(market, field)), field
+    assert isinstance(loaded.course_prefs, np.memmap)
+
+
+@pytest.mark.parametrize('slot_search', [None, 'descent'])
+def test_fork_reproduces_the_saved_run(tmp_path, slot_search):
+    path = str(tmp_path / 'snap')
+    saved = run_experiment(seed = 3, verbose = False, snapshot_path = path, slot_search = slot_search, **SIZES)
+    snapshot = load_snapshot(path)
+    assert snapshot.schedule['n_slots'] == 12 and snapshot.schedule['slot_search'] == slot_search
+    forked = run_experiment(seed = 3, verbose = False, snapshot = snapshot, slot_search = slot_search, **SIZES)
+    assert_same_results(forked, saved)
+
+
+def test_fork_with_other_settings_reschedules(tmp_path):
+    path = str(tmp_path / 'snap')
+    run_experiment(seed = 3, verbose = False, snapshot_path = path, **SIZES)
+    forked = run_experiment(seed = 3, verbose = False, snapshot = load_snapshot(path), n_slots = 4, **SIZES)
+    fresh = run_experiment(seed = 3, verbose = False, n_slots = 4, **SIZES)
+    assert_same_results(forked, fresh)
+    forked = run_experiment(seed = 3, verbose = False, snapshot = load_snapshot(path), scheduler = 'greedy', **SIZES)
+    fresh = run_experiment(seed = 3, verbose = False, scheduler = 'greedy', **SIZES)
+    assert_same_results(forked, fresh)
+
+
+def test_interrupted_save_is_not_loaded(tmp_path, monkeypatch):
+    path = str(tmp_path / 'snap')
+
+    def interrupted(*args, **kwargs):
+        raise KeyboardInterrupt
+    monkeypatch.setattr(json, 'dump', interrupted)
+    with pytest.raises(KeyboardInterrupt):
+        save_snapshot(path, generate_market(seed = 0, **SIZES))
+    monkeypatch.undo()
+
+    partial = [name for name in os.listdir(tmp_path) if name.startswith('snap.tmp')]
+    assert partial and not os.path.exists(path)
+    assert not snapshot_exists(path) and not snapshot_exists(str(tmp_path / partial[0]))
+    with pytest.raises(FileNotFoundError):
+        load_snapshot(str(tmp_path / partial[0]))
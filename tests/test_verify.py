@@ -0,0 +1,168 @@
+import numpy as np
+import pytest
+
+from market import enrollment_from_objects
+from matching import (deferred_acceptance, find_matching, preference_arrays, preference_lengths,
+                      resolve_conflicts)
+from schedule import assign_times
+from simulate import generate_market
+from tests.test_matching import markets, tight_market, truncated_objects
+from verify import (blocking_pairs, check_invariants, list_ranks, verify_matching, verify_pairs,
+                    verify_resolved)
+
+
+def stable_pairs(market):
+    students, courses, _, _ = deferred_acceptance(market.course_prefs, market.priority_ranks,
+                                                  market.enroll_limits, market.credit_limits)
+    return students.astype(np.int64), courses.astype(np.int64)
+
+
+def market_report(market, students, courses, enroll_limits = None, slots = None):
+    return verify_pairs(students, courses, market.course_prefs, market.priority_ranks,
+                        market.enroll_limits if enroll_limits is None else enroll_limits,
+                        market.credit_limits, course_ranks = market.course_ranks, slots = slots)
+
+
+def pair_set(students, courses):
+    return sorted(zip(np.asarray(students).tolist(), np.asarray(courses).tolist()))
+
+
+def brute_force_blocking(students, courses, course_prefs, pref_lengths, priority_ranks, enroll_limits,
+                         credit_limits):
+    # the definition, one (student, course) at a time
+    n_students, n_courses = len(credit_limits), len(enroll_limits)
+    held = {s: set() for s in range(n_students)}
+    rosters = {c: set() for c in range(n_courses)}
+    for s, c in zip(students.tolist(), courses.tolist()):
+        held[s].add(c)
+        rosters[c].add(s)
+    ranks = np.asarray(priority_ranks[np.repeat(np.arange(n_courses), n_students),
+                                      np.tile(np.arange(n_students), n_courses)]).reshape(n_courses, n_students)
+    found = []
+    for s in range(n_students):
+        listed = course_prefs[s, : pref_lengths[s]].tolist()
+        for c in listed:
+            if c in held[s] or ranks[c, s] < 0:
+                continue
+            student_wants = (len(held[s]) < credit_limits[s]
+                             or any(listed.index(c) < listed.index(d) for d in held[s]))
+            course_wants = (len(rosters[c]) < enroll_limits[c]
+                            or any(ranks[c, s] < ranks[c, t] for t in rosters[c]))
+            if student_wants and course_wants:
+                found.append((s, c))
+    return sorted(found)
+
+# =============================================================================== #
+
+@pytest.mark.parametrize('seed', [0, 1, 2])
+def test_find_matching_is_clean(seed):
+    for label, build in markets(seed):
+        student_list, course_list = find_matching(*build(False))
+        report = verify_matching(student_list, course_list)
+        assert report.ok, (label, report.summary())
+        assert set(report.checks) >= {'consistency', 'course_capacity', 'credit_limit', 'blocking_pairs'}
+
+
+@pytest.mark.parametrize('seed', [0, 1])
+def test_resolve_conflicts_is_stable(seed):
+    # the resolving round may add several courses of one free slot, so only pairs it added can
+    # be time conflicts
+    for label, build in markets(seed):
+        student_list, course_list = find_matching(*build(False))
+        assign_times(course_list, np.random.default_rng(seed).integers(4, size = len(course_list)))
+        for s in student_list:
+            s.determine_conflicts(course_list)
+        kept = enrollment_from_objects(student_list, course_list)
+        report = verify_resolved(*resolve_conflicts(student_list, course_list), kept)
+        assert set(report.violations) <= {'time_conflicts'}, (label, report.summary())
+        if 'time_conflicts' in report.violations:
+            students, courses = report.violations['time_conflicts']
+            assert not np.asarray(kept[students, courses]).any(), label
+
+
+def test_dropped_pair_blocks():
+    market = tight_market(0)
+    students, courses = stable_pairs(market)
+    assert market_report(market, students, courses).ok
+    keep = np.arange(len(students)) != 7
+    report = market_report(market, students[keep], courses[keep])
+    assert list(report.violations) == ['blocking_pairs']
+    flagged = pair_set(*report.violations['blocking_pairs'])
+    assert (int(students[7]), int(courses[7])) in flagged
+    assert flagged == brute_force_blocking(students[keep], courses[keep], market.course_prefs,
+                                           np.full(market.n_students, market.n_courses), market.priority_ranks,
+                                           market.enroll_limits, market.credit_limits)
+
+
+def test_course_over_its_limit():
+    market = tight_market(1)
+    students, courses = stable_pairs(market)
+    enroll_limits = market.enroll_limits.copy()
+    enroll_limits[3] -= 1
+    report = market_report(market, students, courses, enroll_limits = enroll_limits)
+    assert report.counts()['credit_limit'] == 0 and report.counts()['duplicate_pairs'] == 0
+    flagged = report.violations['course_capacity']
+    assert pair_set(*flagged) == pair_set(students[courses == 3], courses[courses == 3])
+
+
+def test_one_sided_pair():
+    student_list, course_list = find_matching(*tight_market(2).to_objects())
+    assert check_invariants(student_list, course_list).ok
+    course = course_list[student_list[5].course_enroll[0]]
+    course.student_enroll.remove(student_list[5])
+    report = check_invariants(student_list, course_list)
+    assert list(report.violations) == ['consistency']
+    assert pair_set(*report.violations['consistency']) == [(5, course.course_id)]
+
+
+def test_two_courses_in_one_slot():
+    market = generate_market(200, 12, 3, 3, 40, seed = 3)
+    students, courses = stable_pairs(market)
+    slots = np.arange(market.n_courses)
+    assert market_report(market, students, courses, slots = slots).counts()['time_conflicts'] == 0
+    slots[5] = slots[2]
+    report = market_report(market, students, courses, slots = slots)
+    both = np.intersect1d(students[courses == 2], students[courses == 5])
+    assert len(both)
+    expected = sorted([(s, c) for s in both.tolist() for c in [2, 5]])
+    assert pair_set(*report.violations['time_conflicts']) == expected
+    assert [check for check in report.violations] == ['time_conflicts']
+
+
+@pytest.mark.parametrize('seed', [0, 1, 2, 3])
+@pytest.mark.parametrize('truncated', [False, True])
+def test_blocking_pairs_match_brute_force(seed, truncated):
+    if truncated:
+        course_prefs, priority_ranks, enroll_limits, credit_limits = preference_arrays(
+            *truncated_objects(40, 10, seed))
+        pref_lengths = preference_lengths(truncated_objects(40, 10, seed)[0])
+    else:
+        market = generate_market(40, 10, 3, 3, 8, seed = seed)
+        course_prefs, priority_ranks = market.course_prefs, market.priority_ranks
+        enroll_limits, credit_limits = market.enroll_limits, market.credit_limits
+        pref_lengths = np.full(40, 10)
+    course_ranks = list_ranks(course_prefs, pref_lengths, len(enroll_limits))
+    students, courses, _, _ = deferred_acceptance(course_prefs, priority_ranks, enroll_limits, credit_limits,
+                                                  pref_lengths = pref_lengths)
+    students, courses = students.astype(np.int64), courses.astype(np.int64)
+
+    # the stable matching, then random subsets of it with a few other listed pairs added
+    rng = np.random.default_rng(seed)
+    listed = [(s, c) for s in range(40) for c in course_prefs[s, : pref_lengths[s]].tolist()]
+    for trial in range(4):
+        if trial:
+            keep = rng.random(len(students)) < 0.7
+            extra = rng.choice(len(listed), 5, replace = False)
+            pairs = sorted(set(zip(students[keep].tolist(), courses[keep].tolist()))
+                           | {listed[i] for i in extra.tolist()})
+        else:
+            pairs = list(zip(students.tolist(), courses.tolist()))
+        trial_students = np.array([s for s, _ in pairs], dtype = np.int64)
+        trial_courses = np.array([c for _, c in pairs], dtype = np.int64)
+        found = blocking_pairs(trial_students, trial_courses, course_prefs, pref_lengths, course_ranks,
+                               priority_ranks, enroll_limits, credit_limits, block_size = 16)
+        expected = brute_force_blocking(trial_students, trial_courses, course_prefs, pref_lengths,
+                                        priority_ranks, enroll_limits, credit_limits)
+        assert pair_set(*found) == expected, trial
+        if trial == 0:
+            assert expected == []
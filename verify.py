@@ -0,0 +1,229 @@
+import argparse
+import time
+
+import numpy as np
+
+from market import SparseRanks, inverse_permutation
+from matching import (preference_arrays, resolving_preferences, slot_indices, unavailable_slot_matrix)
+
+
+# Checks of a matching given as (student, course) pair arrays, each one vectorized over the
+# whole market:
+#   capacity     no course above its enroll limit, no student above its credit limit, no pair twice
+#   consistency  every pair seen from the student side is seen from the course side (objects only)
+#   time         no student in two courses of the same time slot
+#   stability    no blocking pair: a student and a course ranking each other, not matched together,
+#                where the student has a credit left or ranks the course above one of its courses,
+#                and the course has a seat left or ranks the student above one of its students
+# A matching is checked against the round that produced it: find_matching against the full
+# preferences and limits, resolve_conflicts against its own round (the pairs it added, the limits
+# left after determine_conflicts, each student's available courses in course index order).
+
+
+class Report():
+    # offending (students, courses) pairs of every failed check
+    def __init__(self, stage):
+        self.stage = stage
+        self.checks = []
+        self.violations = {}
+
+    def __repr__(self):
+        return f"Report({self.stage!r}, {self.counts()})"
+
+    def add(self, check, students, courses):
+        self.checks.append(check)
+        if len(students):
+            self.violations[check] = (np.asarray(students), np.asarray(courses))
+
+    @property
+    def ok(self):
+        return len(self.violations) == 0
+
+    def counts(self):
+        return {check: len(self.violations[check][0]) if check in self.violations else 0 for check in self.checks}
+
+    def summary(self, max_pairs = 5):
+        lines = [f"{self.stage}: " + ", ".join(f"{check} {n}" for check, n in self.counts().items())]
+        for check, (students, courses) in self.violations.items():
+            pairs = ", ".join(f"({s}, {c})" for s, c in zip(students[:max_pairs].tolist(), courses[:max_pairs].tolist()))
+            lines.append(f"\t{check}: {pairs}{' ...' if len(students) > max_pairs else ''}")
+        return "\n".join(lines)
+
+
+def pairs_from_objects(student_list, course_list):
+    # enrolled pairs as seen from the students and from the courses
+    student_pairs = (np.repeat(np.arange(len(student_list)), [len(s.course_enroll) for s in student_list]),
+                     np.array([c for s in student_list for c in s.course_enroll], dtype = np.int64))
+    course_pairs = (np.array([s.student_id for c in course_list for s in c.student_enroll], dtype = np.int64),
+                    np.repeat(np.arange(len(course_list)), [len(c.student_enroll) for c in course_list]))
+    return student_pairs, course_pairs
+
+
+def list_ranks(course_prefs, pref_lengths, n_courses):
+    # ranks of the first pref_lengths[s] courses of every row (the rest is padding)
+    if course_prefs.shape[1] == n_courses and (pref_lengths == n_courses).all():
+        return inverse_permutation(course_prefs)
+    return SparseRanks.from_lists([row[:n] for row, n in zip(course_prefs, pref_lengths.tolist())], n_courses)
+
+# =============================================================================== #
+
+def capacity_violations(students, courses, enroll_limits, credit_limits):
+    # pairs of over-full courses and students, and repeated pairs
+    over_courses = np.bincount(courses, minlength = len(enroll_limits)) > enroll_limits
+    over_students = np.bincount(students, minlength = len(credit_limits)) > credit_limits
+    keys = students.astype(np.int64) * len(enroll_limits) + courses
+    _, first = np.unique(keys, return_index = True)
+    repeated = np.ones(len(keys), dtype = bool)
+    repeated[first] = False
+    return {'course_capacity': over_courses[courses],
+            'credit_limit': over_students[students],
+            'duplicate_pairs': repeated}
+
+
+def inconsistent_pairs(student_pairs, course_pairs, n_courses):
+    # pairs that only one side holds
+    student_keys = student_pairs[0].astype(np.int64) * n_courses + student_pairs[1]
+    course_keys = course_pairs[0].astype(np.int64) * n_courses + course_pairs[1]
+    keys = np.setxor1d(student_keys, course_keys)
+    return keys // n_courses, keys % n_courses
+
+
+def time_conflicts(students, courses, slots):
+    # every pair whose student has another course in the same slot
+    groups = students.astype(np.int64) * (int(slots.max(initial = 0)) + 1) + slots[courses]
+    _, inverse, counts = np.unique(groups, return_inverse = True, return_counts = True)
+    return counts[inverse] > 1
+
+
+def blocking_pairs(students, courses, course_prefs, pref_lengths, course_ranks, priority_ranks,
+                   enroll_limits, credit_limits, block_size = 1 << 22):
+    # (students, courses) of the blocking pairs. A student only blocks with courses listed before
+    # its worst course (anywhere in its list if it has a credit left), so these prefixes are the
+    # only candidates; they are enumerated about block_size pairs at a time
+    n_students, n_courses = len(credit_limits), len(enroll_limits)
+    students, courses = students.astype(np.int64), courses.astype(np.int64)
+    worst_course = np.full(n_students, -1, dtype = np.int64)
+    np.maximum.at(worst_course, students, np.asarray(course_ranks[students, courses], dtype = np.int64))
+    full_students = np.bincount(students, minlength = n_students) >= credit_limits
+    prefix = np.where(full_students, worst_course, pref_lengths).clip(0, None)
+
+    # a course accepts students ranked before its worst student, anyone it ranks if it has a seat
+    worst_student = np.full(n_courses, -1, dtype = np.int64)
+    np.maximum.at(worst_student, courses, np.asarray(priority_ranks[courses, students], dtype = np.int64))
+    full_courses = np.bincount(courses, minlength = n_courses) >= enroll_limits
+    threshold = np.where(full_courses, worst_student, n_students)
+
+    enrolled = np.sort(students * n_courses + courses)
+    ends = np.cumsum(prefix)
+    found_students, found_courses = [], []
+    start = 0
+    while start < n_students:
+        stop = max(start + 1, int(np.searchsorted(ends, ends[start] - prefix[start] + block_size, side = 'right')))
+        block = np.arange(start, min(stop, n_students))
+        counts = prefix[block]
+        pair_students = np.repeat(block, counts)
+        positions = np.arange(int(counts.sum())) - np.repeat(np.cumsum(counts) - counts, counts)
+        pair_courses = course_prefs[pair_students, positions].astype(np.int64)
+        keys = pair_students * n_courses + pair_courses
+        found = np.searchsorted(enrolled, keys)
+        matched = found < len(enrolled)
+        matched[matched] = enrolled[found[matched]] == keys[matched]
+        ranks = np.asarray(priority_ranks[pair_courses, pair_students], dtype = np.int64)
+        blocking = ~matched & (ranks >= 0) & (ranks < threshold[pair_courses])
+        found_students.append(pair_students[blocking])
+        found_courses.append(pair_courses[blocking])
+        start = block[-1] + 1
+    empty = [np.zeros(0, dtype = np.int64)]
+    return np.concatenate(found_students + empty), np.concatenate(found_courses + empty)
+
+
+def verify_pairs(students, courses, course_prefs, priority_ranks, enroll_limits, credit_limits,
+                 pref_lengths = None, course_ranks = None, slots = None, stage = 'match', report = None):
+    # capacity, time conflicts (if slots are given) and stability of a matching in array form;
+    # course_prefs are the students' proposal orders, padded after pref_lengths[s] courses
+    students, courses = np.asarray(students, dtype = np.int64), np.asarray(courses, dtype = np.int64)
+    enroll_limits, credit_limits = np.asarray(enroll_limits), np.asarray(credit_limits)
+    if pref_lengths is None:
+        pref_lengths = np.full(len(credit_limits), course_prefs.shape[1])
+    if course_ranks is None:
+        course_ranks = list_ranks(course_prefs, pref_lengths, len(enroll_limits))
+    report = report or Report(stage)
+
+    for check, offending in capacity_violations(students, courses, enroll_limits, credit_limits).items():
+        report.add(check, students[offending], courses[offending])
+    if slots is not None:
+        offending = time_conflicts(students, courses, slots)
+        report.add('time_conflicts', students[offending], courses[offending])
+    report.add('blocking_pairs', *blocking_pairs(students, courses, course_prefs, pref_lengths, course_ranks,
+                                                 priority_ranks, enroll_limits, credit_limits))
+    return report
+
+
+def check_invariants(student_list, course_list):
+    # capacity and consistency of the objects' enrollment (the cheap checks)
+    report = Report('invariants')
+    student_pairs, course_pairs = pairs_from_objects(student_list, course_list)
+    enroll_limits = np.array([c.enroll_limit for c in course_list], dtype = np.int64)
+    credit_limits = np.array([s.credit_limit for s in student_list], dtype = np.int64)
+    report.add('consistency', *inconsistent_pairs(student_pairs, course_pairs, len(course_list)))
+    students, courses = student_pairs
+    for check, offending in capacity_violations(students, courses, enroll_limits, credit_limits).items():
+        report.add(check, students[offending], courses[offending])
+    return report
+
+
+def verify_matching(student_list, course_list):
+    # objects after find_matching
+    report = Report('match')
+    student_pairs, course_pairs = pairs_from_objects(student_list, course_list)
+    report.add('consistency', *inconsistent_pairs(student_pairs, course_pairs, len(course_list)))
+    course_prefs, priority_ranks, enroll_limits, credit_limits = preference_arrays(student_list, course_list)
+    pref_lengths = np.array([len(s.course_prefs) for s in student_list], dtype = np.int64)
+    return verify_pairs(*student_pairs, course_prefs, priority_ranks, enroll_limits, credit_limits,
+                        pref_lengths = pref_lengths, report = report)
+
+
+def verify_resolved(student_list, course_list, kept):
+    # objects after resolve_conflicts; kept is the enrollment matrix right before it (after
+    # determine_conflicts). Time conflicts are checked on the whole enrollment, stability on the
+    # resolving round
+    report = Report('resolve')
+    student_pairs, course_pairs = pairs_from_objects(student_list, course_list)
+    report.add('consistency', *inconsistent_pairs(student_pairs, course_pairs, len(course_list)))
+    students, courses = student_pairs
+    slots = slot_indices(course_list)
+    offending = time_conflicts(students, courses, slots)
+    report.add('time_conflicts', students[offending], courses[offending])
+
+    listed_prefs, priority_ranks, enroll_limits, credit_limits = preference_arrays(student_list, course_list)
+    enroll_limits, credit_limits = enroll_limits.copy(), credit_limits.copy()
+    kept = kept.tocoo()
+    enroll_limits -= np.bincount(kept.col, minlength = len(course_list))
+    credit_limits -= np.bincount(kept.row, minlength = len(student_list))
+    course_prefs, pref_lengths = resolving_preferences(listed_prefs, slots,
+                                                       unavailable_slot_matrix(student_list, course_list))
+    n_courses = len(course_list)
+    added = ~np.isin(students.astype(np.int64) * n_courses + courses,
+                     kept.row.astype(np.int64) * n_courses + kept.col)
+    return verify_pairs(students[added], courses[added], course_prefs, priority_ranks, enroll_limits,
+                        credit_limits, pref_lengths = pref_lengths, report = report)
+
+
+if __name__ == "__main__":
+    # verify the matching saved in a snapshot against its market
+    from snapshot import load_snapshot
+    parser = argparse.ArgumentParser(description = 'Check the saved matching of a snapshot')
+    parser.add_argument('snapshot', help = 'Snapshot directory (saved with --save_snapshot)')
+    parser.add_argument('--max_pairs', type = int, default = 5, help = 'Offending pairs shown per check')
+    args = parser.parse_args()
+
+    start = time.time()
+    snapshot = load_snapshot(args.snapshot)
+    market, state = snapshot.market, snapshot.state
+    if state is None:
+        parser.error(f"{args.snapshot} has no matching state")
+    report = verify_pairs(state['held_students'], state['held_courses'], market.course_prefs,
+                          market.priority_ranks, market.enroll_limits, market.credit_limits,
+                          course_ranks = market.course_ranks)
+    print(report.summary(args.max_pairs))
+    print(f"{'ok' if report.ok else 'FAILED'} ({time.time() - start:.1f}s)")